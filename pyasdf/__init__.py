@@ -10,10 +10,11 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 from .asdf_data_set import ASDFDataSet, ASDFException, ASDFWarning
+from .multi_file import create_master_file, merge
 
 
 __all__ = ["__version__", "ASDFDataSet", "ASDFException", "ASDFWarning",
-           "print_sys_info", "get_sys_info"]
+           "create_master_file", "merge", "print_sys_info", "get_sys_info"]
 
 __version__ = "0.1.x"
 
@@ -15,13 +15,16 @@ from __future__ import (absolute_import, division, print_function,
 # and lxml cannot be loaded anymore afterwards...
 import obspy
 
+import bisect
 import collections
+import functools
 import io
 import itertools
-import math
 import os
+import re
 import sys
-import time
+import threading
+import traceback
 import warnings
 
 import numpy as np
@@ -48,11 +51,21 @@ except AttributeError:
 
 
 from .header import ASDFException, ASDFWarning, COMPRESSIONS, FORMAT_NAME, \
-    FORMAT_VERSION, MSG_TAGS, MAX_MEMORY_PER_WORKER_IN_MB, POISON_PILL
-from .utils import is_mpi_env, StationAccessor, sizeof_fmt, ReceivedMessage,\
-    pretty_receiver_log, pretty_sender_log, JobQueueHelper, StreamBuffer, \
-    AuxiliaryDataGroupAccessor, AuxiliaryDataContainer, get_multiprocessing
+    FORMAT_VERSION, MAX_MEMORY_PER_WORKER_IN_MB, MAX_ASYNC_READ_THREADS, \
+    CONTENT_HASH_ATTRIBUTE, PACKED_DATA_NAME, PACKED_INDEX_NAME
+from .utils import is_mpi_env, StationAccessor, sizeof_fmt, \
+    AuxiliaryDataGroupAccessor, AuxiliaryDataContainer, get_multiprocessing, \
+    split_processing_output, InMemoryWaveformAccessor, prefetch_items, \
+    SharedMemoryPool, AsyncReadAheadIterator, parse_waveform_name, \
+    matches_pattern, to_structured_array, WaveformDetails, get_endtime_ns, \
+    format_waveform_index_line, parse_waveform_index, fletcher32_matches, \
+    get_block_slices, compare_dataset_metadata, compare_dataset_contents, \
+    get_content_hash, get_stored_content_hash, get_dataset_names, \
+    copy_dataset, get_sample_range, get_free_space_settings, \
+    AuxiliaryDataWriter, PackedRecord, format_packed_index_line, \
+    parse_packed_index, escape_pattern
 from .inventory_utils import isolate_and_merge_station, merge_inventories
+from .executors import get_executor, MPIExecutor
 
 
 class ASDFDataSet(object):
@@ -62,7 +75,8 @@ class ASDFDataSet(object):
     Central object of this Python package.
     """
     def __init__(self, filename, compression="gzip-3", debug=False,
-                 mpi=None):
+                 mpi=None, mode="a", deduplicate=False,
+                 track_free_space=False):
         """
         :type filename: str
         :param filename: The filename of the HDF5 file (to be).
@@ -89,8 +103,41 @@ class ASDFDataSet(object):
         :param mpi: Force MPI on/off. Don't touch this unless you have a
             reason.
         :type mpi: bool
-        """
+        :param mode: The mode the file is opened in. Either ``"a"`` to
+            read and write (the default) or ``"r"`` to open an existing
+            file read-only, which, for example, allows multiple processes to
+            read from the same file at the same time.
+        :type mode: str
+        :param deduplicate: If True, waveforms and StationXML files with
+            the same content and attributes as data already in the file are
+            not written again but stored as a hard link to the existing
+            data. This is transparent for all readers. Requires scanning the
+            content hashes of the file once and does nothing with MPI.
+        :type deduplicate: bool
+        :param track_free_space: If True, a newly created file keeps track
+            of the space of deleted data also after it has been closed and
+            reuses it whenever it is opened again. Without it, the space is
+            only reused as long as the file stays open, see :meth:`repack`
+            to get rid of it. Such files use the file format of HDF5 1.10
+            and can no longer be read with older versions of HDF5. Does
+            nothing for existing files, with MPI, or if h5py or HDF5 are too
+            old.
+        :type track_free_space: bool
+        """
+        if mode not in ("a", "r"):
+            raise ValueError("Mode must be either 'a' or 'r'.")
         self.__force_mpi = mpi
+        # Thread pool for the asynchronous read API. Created on demand.
+        self.__async_executor = None
+        self.__deduplicate = deduplicate
+        # Maps content hashes to the names of datasets. Built on demand.
+        self.__content_hash_map = None
+        # Index of all waveforms. Built on demand.
+        self.__waveform_index = None
+        self.__waveform_details = {}
+        self.__waveform_table = None
+        # Parsed indices of packed auxiliary data types. Read on demand.
+        self.__packed_indices = {}
         self.debug = debug
 
         # Deal with compression settings.
@@ -108,15 +155,23 @@ class ASDFDataSet(object):
             warnings.warn(msg, ASDFWarning)
             self.__compression = COMPRESSIONS[None]
 
-        # Open file or take an already open HDF5 file object.
+        # Open file or take an already open HDF5 file object. Persistent
+        # free space tracking is not done for parallel I/O which does not
+        # support it with many HDF5 versions.
         if not self.mpi:
-            self.__file = h5py.File(filename, "a")
+            if mode == "a" and not os.path.exists(filename):
+                self.__file = h5py.File(
+                    filename, "w-", **(get_free_space_settings()
+                                       if track_free_space else {}))
+            else:
+                self.__file = h5py.File(filename, mode)
         else:
-            self.__file = h5py.File(filename, "a", driver="mpio",
+            self.__file = h5py.File(filename, mode, driver="mpio",
                                     comm=self.mpi.comm)
 
         # Workaround to HDF5 only storing the relative path by default.
         self.__original_filename = os.path.abspath(filename)
+        self.__mode = mode
 
         # Write file format and version information to the file.
         if "file_format" in self.__file.attrs:
@@ -137,6 +192,9 @@ class ASDFDataSet(object):
                            self.__file.attrs["file_format_version"],
                            FORMAT_VERSION))
                 warnings.warn(msg, ASDFWarning)
+        elif mode == "r":
+            msg = "Not a '%s' file." % FORMAT_NAME
+            raise ASDFException(msg)
         else:
             self.__file.attrs["file_format"] = \
                 self._zeropad_ascii_string(FORMAT_NAME)
@@ -144,11 +202,11 @@ class ASDFDataSet(object):
                 self._zeropad_ascii_string(FORMAT_VERSION)
 
         # Create the waveform and provenance groups.
-        if "Waveforms" not in self.__file:
+        if "Waveforms" not in self.__file and mode != "r":
             self.__file.create_group("Waveforms")
-        if "Provenance" not in self.__file:
+        if "Provenance" not in self.__file and mode != "r":
             self.__file.create_group("Provenance")
-        if "AuxiliaryData" not in self.__file:
+        if "AuxiliaryData" not in self.__file and mode != "r":
             self.__file.create_group("AuxiliaryData")
 
         # Easy access to the waveforms.
@@ -156,7 +214,7 @@ class ASDFDataSet(object):
         self.auxiliary_data = AuxiliaryDataGroupAccessor(self)
 
         # Create the QuakeML data set if it does not exist.
-        if "QuakeML" not in self.__file:
+        if "QuakeML" not in self.__file and mode != "r":
             self.__file.create_dataset("QuakeML", dtype=np.dtype("byte"),
                                        shape=(0,), maxshape=(None,),
                                        fletcher32=not bool(self.mpi))
@@ -175,7 +233,9 @@ class ASDFDataSet(object):
         try:
             self._flush()
             self._close()
-        except (ValueError, TypeError, AttributeError):
+        # Newer h5py versions raise a RuntimeError if the file is already
+        # closed.
+        except (ValueError, TypeError, AttributeError, RuntimeError):
             pass
 
     def __eq__(self, other):
@@ -183,30 +243,241 @@ class ASDFDataSet(object):
         More or less comprehensive equality check. Potentially quite slow as
         it checks all data.
 
+        The cheap metadata of all datasets is compared first, the data is
+        then read in blocks with bounded memory. Stops at the first
+        difference.
+
         :type other:`~pyasdf.asdf_data_set.ASDFDDataSet`
         """
         if type(self) != type(other):
             return False
-        if self._waveform_group.keys() != other._waveform_group.keys():
-            return False
-        if self._provenance_group.keys() != other._provenance_group.keys():
-            return False
-        if self.events != other.events:
-            return False
-        for station, group in self._waveform_group.items():
-            other_group = other._waveform_group[station]
-            for tag, data_set in group.items():
-                other_data_set = other_group[tag]
-                try:
-                    if tag == "StationXML":
-                        np.testing.assert_array_equal(data_set.value,
-                                                      other_data_set.value)
-                    else:
-                        np.testing.assert_allclose(
-                            data_set.value, other_data_set.value)
-                except AssertionError:
-                    return False
-        return True
+        return next(self._iter_differences(other), None) is None
+
+    def compare(self, other):
+        """
+        Compare two data sets and report all differences. Compares the
+        waveforms, station information, auxiliary data, provenance
+        records, and events.
+
+        Returns a dictionary with the following keys:
+
+        * ``"only_in_self"``: Datasets only present in this data set.
+        * ``"only_in_other"``: Datasets only present in the other data set.
+        * ``"different"``: ``(name, reason)`` tuples of the datasets present
+          in both but with different contents.
+        * ``"is_equal"``: True if no differences have been found.
+
+        :param other: The data set to compare to.
+        :type other: :class:`~pyasdf.asdf_data_set.ASDFDataSet`
+        """
+        report = {"only_in_self": [], "only_in_other": [], "different": []}
+        for kind, name, reason in self._iter_differences(other):
+            if kind == "different":
+                report[kind].append((name, reason))
+            else:
+                report[kind].append(name)
+        report["is_equal"] = not any(report.values())
+        return report
+
+    def _iter_differences(self, other):
+        """
+        Generator yielding ``(kind, name, reason)`` tuples for all
+        differences to another data set, the cheap ones first. ``kind`` is
+        one of ``"only_in_self"``, ``"only_in_other"``, and
+        ``"different"``.
+
+        :param other: The data set to compare to.
+        :type other: :class:`~pyasdf.asdf_data_set.ASDFDataSet`
+        """
+        records = self._get_comparable_names()
+        other_records = other._get_comparable_names()
+        names = set(records)
+        other_names = set(other_records)
+        for name in sorted(names - other_names):
+            yield "only_in_self", name, None
+        for name in sorted(other_names - names):
+            yield "only_in_other", name, None
+
+        candidates = []
+        packed_candidates = []
+        for name in sorted(names & other_names):
+            # Packed records are compared one by one as their position in
+            # the packed data is irrelevant.
+            if records[name] is not None or other_records[name] is not None:
+                packed_candidates.append(name)
+                continue
+            reason = compare_dataset_metadata(self.__file[name],
+                                              other.__file[name])
+            if reason:
+                yield "different", name, reason
+                continue
+            # Different content hashes are proof enough for data that has
+            # to be exactly equal. Matching hashes are not as the data might
+            # have been modified with other tools.
+            if not self._is_approximately_compared(name):
+                content_hash = get_stored_content_hash(self.__file[name])
+                other_hash = get_stored_content_hash(other.__file[name])
+                if content_hash and other_hash and \
+                        content_hash != other_hash:
+                    yield "different", name, "Content hashes differ."
+                    continue
+            candidates.append(name)
+
+        # Only parse the events if the raw QuakeML differs.
+        if not np.array_equal(self.__file["QuakeML"].value,
+                              other.__file["QuakeML"].value) and \
+                self.events != other.events:
+            yield "different", "QuakeML", "The events differ."
+
+        for name in packed_candidates:
+            reason = self._compare_auxiliary_data(
+                other, name, records[name], other_records[name])
+            if reason:
+                yield "different", name, reason
+
+        for name in candidates:
+            reason = compare_dataset_contents(
+                self.__file[name], other.__file[name],
+                approximate=self._is_approximately_compared(name))
+            if reason:
+                yield "different", name, reason
+
+    def _compare_auxiliary_data(self, other, name, record, other_record):
+        """
+        Compare a piece of auxiliary data of which at least one is a packed
+        record. Returns a message describing the first difference or
+        ``None`` if they match.
+
+        :param other: The data set to compare to.
+        :type other: :class:`~pyasdf.asdf_data_set.ASDFDataSet`
+        :param name: The full name of the auxiliary data.
+        :type name: str
+        :param record: The packed record in this data set, if any.
+        :type record: :class:`~pyasdf.utils.PackedRecord`
+        :param other_record: The packed record in the other data set, if
+            any.
+        :type other_record: :class:`~pyasdf.utils.PackedRecord`
+        """
+        data_type, tag = name.split("/", 2)[1:]
+        first = self._get_auxiliary_data(data_type, tag)
+        second = other._get_auxiliary_data(data_type, tag)
+        if first.data.shape != second.data.shape:
+            return "Shapes differ: %s != %s" % (first.data.shape,
+                                                second.data.shape)
+        if first.data.dtype != second.data.dtype:
+            return "Data types differ: %s != %s" % (first.data.dtype,
+                                                    second.data.dtype)
+        if set(first.parameters) != set(second.parameters):
+            return "Attributes differ: %s != %s" % (
+                sorted(first.parameters), sorted(second.parameters))
+        for key in first.parameters:
+            if not np.array_equal(np.asarray(first.parameters[key]),
+                                  np.asarray(second.parameters[key])):
+                return "Attribute '%s' differs." % key
+        content_hash = record.content_hash if record is not None else \
+            get_stored_content_hash(self.__file[name])
+        other_hash = other_record.content_hash \
+            if other_record is not None else \
+            get_stored_content_hash(other.__file[name])
+        if content_hash and other_hash and content_hash != other_hash:
+            return "Content hashes differ."
+        # Packed records are small enough to be read at once.
+        if not np.array_equal(first.data[()], second.data[()]):
+            return "Data differs."
+        return None
+
+    @staticmethod
+    def _is_approximately_compared(name):
+        """
+        Processed waveforms only need to be almost equal.
+
+        :param name: The full name of the dataset.
+        :type name: str
+        """
+        return name.startswith("Waveforms/") and \
+            not name.endswith("/StationXML")
+
+    def diff(self, other):
+        """
+        Quickly find the differences to another data set by only comparing
+        the content hashes stored with each waveform, StationXML, and
+        auxiliary data dataset. No data is read. Packed auxiliary data is
+        compared record by record through the hashes in its index.
+
+        Returns a dictionary with the following keys:
+
+        * ``"added"``: Datasets only present in the other data set.
+        * ``"removed"``: Datasets only present in this data set.
+        * ``"changed"``: Datasets with different content hashes.
+        * ``"unknown"``: Datasets in both data sets where at least one has
+          no content hash, e.g. because it has been written by another
+          tool. Use :meth:`compare` to compare them.
+
+        :param other: The data set to compare to.
+        :type other: :class:`~pyasdf.asdf_data_set.ASDFDataSet`
+        """
+        hashes = self._get_content_hashes()
+        other_hashes = other._get_content_hashes()
+        report = {
+            "added": sorted(set(other_hashes) - set(hashes)),
+            "removed": sorted(set(hashes) - set(other_hashes)),
+            "changed": [], "unknown": []}
+        for name in sorted(set(hashes) & set(other_hashes)):
+            if hashes[name] is None or other_hashes[name] is None:
+                report["unknown"].append(name)
+            elif hashes[name] != other_hashes[name]:
+                report["changed"].append(name)
+        return report
+
+    def _get_content_hashes(self):
+        """
+        Returns a dictionary mapping the full names of all waveform,
+        station, auxiliary data, and provenance datasets to their stored
+        content hashes or ``None`` if they have none.
+        """
+        hashes = {}
+        for name, record in self._get_comparable_names().items():
+            if record is not None:
+                hashes[name] = record.content_hash
+            else:
+                hashes[name] = get_stored_content_hash(self.__file[name])
+        return hashes
+
+    def _get_comparable_names(self):
+        """
+        Returns a dictionary mapping the full names of all waveform,
+        station, auxiliary data, and provenance datasets to ``None``. The
+        datasets of packed auxiliary data types are replaced by the names
+        of their records which map to their
+        :class:`~pyasdf.utils.PackedRecord` objects.
+        """
+        names = {}
+        for name in self._get_dataset_names():
+            if name.startswith("AuxiliaryData/"):
+                data_type, _, data_name = name[len("AuxiliaryData/"):]\
+                    .partition("/")
+                index = self._get_packed_index(data_type)
+                if index is not None:
+                    if data_name == PACKED_INDEX_NAME:
+                        for tag, record in index.items():
+                            names["AuxiliaryData/%s/%s" % (
+                                data_type, tag)] = record
+                    continue
+            names[name] = None
+        return names
+
+    def _get_dataset_names(self):
+        """
+        Returns the full names of all waveform, station, auxiliary data,
+        and provenance datasets in the file.
+        """
+        names = []
+        for group_name in ("Waveforms", "AuxiliaryData", "Provenance"):
+            if group_name not in self.__file:
+                continue
+            names.extend("%s/%s" % (group_name, _i) for _i in
+                         get_dataset_names(self.__file[group_name]))
+        return names
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -221,8 +492,54 @@ class ASDFDataSet(object):
         """
         Close the underlying HDF5 file.
         """
+        # Wait for pending asynchronous reads.
+        if self.__async_executor is not None:
+            self.__async_executor.shutdown(wait=True)
+            self.__async_executor = None
         self.__file.close()
 
+    def _reopen(self):
+        """
+        Open the file again after it has been closed with :meth:`_close`.
+        """
+        compression = self.__compression
+        ASDFDataSet.__init__(self, self.__original_filename,
+                             debug=self.debug, mpi=self.__force_mpi,
+                             mode=self.__mode, deduplicate=self.__deduplicate)
+        # Already validated and possibly turned off for parallel I/O.
+        self.__compression = compression
+
+    def _get_executor(self, executor):
+        """
+        Returns the executor to run jobs with, see
+        :func:`~pyasdf.executors.get_executor`.
+
+        :param executor: The name of an executor, an executor instance, or
+            ``None`` for the default one.
+        """
+        executor = get_executor(executor, mpi=bool(self.mpi),
+                                debug=self.debug)
+        # Collective operations on the file involve all processes it has
+        # been opened by.
+        if isinstance(executor, MPIExecutor) and \
+                executor.comm.Compare(self.mpi.comm) not in (
+                    self.mpi.MPI.IDENT, self.mpi.MPI.CONGRUENT):
+            msg = "The communicator of the MPI executor must contain the " \
+                  "same processes as the one the file has been opened with."
+            raise ValueError(msg)
+        return executor
+
+    def _get_async_executor(self):
+        """
+        Returns the bounded thread pool the blocking reads of the
+        asynchronous API are offloaded to.
+        """
+        if self.__async_executor is None:
+            import concurrent.futures
+            self.__async_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_ASYNC_READ_THREADS)
+        return self.__async_executor
+
     def _zeropad_ascii_string(self, text):
         """
         Returns a zero padded ASCII string in the most compatible way possible.
@@ -347,9 +664,119 @@ class ASDFDataSet(object):
 
         self.__file["QuakeML"].resize(data.shape)
         self.__file["QuakeML"][:] = data
+        # Allows counting the events without parsing the QuakeML.
+        self.__file["QuakeML"].attrs["event_count"] = len(cat)
+
+    def _get_event_count(self):
+        """
+        Returns the number of events without parsing the QuakeML.
+        """
+        data = self.__file["QuakeML"]
+        if "event_count" in data.attrs:
+            return int(data.attrs["event_count"])
+        # Files written by other tools.
+        if not len(data):
+            return 0
+        return len(re.findall(br"<(?:\w+:)?event[\s>]",
+                              data.value.tostring()))
+
+    def _get_completed_jobs(self):
+        """
+        Returns the set of ``(station_name, tag)`` jobs recorded as completed
+        by the :meth:`process` method.
+        """
+        if "ProcessingCheckpoint" not in self.__file:
+            return set()
+        data = self.__file["ProcessingCheckpoint"].value.tostring().decode()
+        return set(tuple(_i.split("/", 1)) for _i in data.splitlines())
+
+    def _add_completed_jobs(self, station_tags):
+        """
+        Record a number of ``(station_name, tag)`` jobs as completed.
+
+        Must be called collectively with the same jobs on all ranks when
+        running with MPI.
+
+        :param station_tags: The finished jobs.
+        :type station_tags: list of tuples
+        """
+        self._append_lines("ProcessingCheckpoint", [
+            "%s/%s\n" % (station, tag) for station, tag in station_tags])
+
+    def _get_job_outputs(self):
+        """
+        Returns a dictionary mapping the ``(station_name, tag)`` jobs of the
+        :meth:`process` method to the sets of full names of the waveforms
+        they write.
+        """
+        outputs = collections.defaultdict(set)
+        if "ProcessingOutputs" not in self.__file:
+            return outputs
+        data = self.__file["ProcessingOutputs"].value.tostring().decode()
+        for line in data.splitlines():
+            job, name = line.split("\t")
+            outputs[tuple(job.split("/", 1))].add(name)
+        return outputs
+
+    def _add_job_outputs(self, outputs):
+        """
+        Record the waveforms jobs are about to write so whatever an
+        unfinished job wrote can be removed when resuming.
+
+        Must be called collectively with the same outputs on all ranks when
+        running with MPI.
+
+        :param outputs: ``((station_name, tag), name)`` tuples with the
+            full names of the waveforms.
+        :type outputs: list of tuples
+        """
+        self._append_lines("ProcessingOutputs", [
+            "%s/%s\t%s\n" % (station, tag, name)
+            for (station, tag), name in outputs])
+
+    def _append_lines(self, name, lines):
+        """
+        Append lines of text to a resizable byte dataset in the file. The
+        dataset is created if it does not yet exist.
+
+        Must be called collectively with the same lines on all ranks when
+        running with MPI.
+
+        :param name: The name of the dataset.
+        :type name: str
+        :param lines: The lines including their line endings.
+        :type lines: list of str
+        """
+        if name not in self.__file:
+            self.__file.create_dataset(
+                name, dtype=np.dtype("byte"), shape=(0,),
+                maxshape=(None,), fletcher32=not bool(self.mpi))
+        if not lines:
+            return
+
+        data = np.frombuffer("".join(lines).encode(),
+                             dtype=np.dtype("byte"))
+        self._append_data(self.__file[name], data)
+
+    def _append_data(self, dataset, data):
+        """
+        Append data to a resizable one-dimensional dataset. Returns the
+        index of the first appended element.
+
+        Must be called collectively with the same data on all ranks when
+        running with MPI.
+
+        :type dataset: :class:`h5py.Dataset`
+        :type data: :class:`numpy.ndarray`
+        """
+        old_size = dataset.shape[0]
+        dataset.resize((old_size + len(data),))
+        if not self.mpi or self.mpi.rank == 0:
+            dataset[old_size:] = data
+        return old_size
 
     def add_auxiliary_data(self, data, data_type, tag, parameters,
-                           provenance=None):
+                           provenance=None, overwrite=False, packed=False):
         """
         Adds auxiliary data to the file.
 
@@ -358,28 +785,57 @@ class ASDFDataSet(object):
         :param tag: The tag of the data. Must be unique per data_type.
         :param parameters: Any additional options, as a Python dictionary.
         :param provenance:
+        :param overwrite: If True, existing data with the same data type
+            and tag is replaced. Otherwise a warning is raised and the data
+            is not added.
+        :type overwrite: bool
+        :param packed: Store the data of the data type packed together in a
+            single dataset with an index instead of one dataset per tag.
+            Much faster and more compact for many small records, e.g.
+            windows picked per station and component. Can only be chosen
+            for new data types and must then be given for all data of the
+            data type. All records must have the same data type. Reading is
+            the same for packed and unpacked data.
+        :type packed: bool
         :return:
         """
+        if packed:
+            self._add_packed_auxiliary_data(data, data_type, tag, parameters,
+                                            overwrite=overwrite)
+            return
+
         # Complicated multi-step process but it enables one to use
         # parallel I/O with the same functions.
         info = self._add_auxiliary_data_get_collective_information(
-            data, data_type, tag, parameters, provenance)
+            data, data_type, tag, parameters, provenance,
+            overwrite=overwrite)
         if info is None:
             return
         self._add_auxiliary_data_write_collective_information(info)
         self._add_auxiliary_data_write_independent_information(info, data)
 
     def _add_auxiliary_data_get_collective_information(
-            self, data, data_type, tag, parameters, provenance=None):
+            self, data, data_type, tag, parameters, provenance=None,
+            overwrite=False, shape=None, dtype=None, chunks=None):
         """
         The information required for the collective part of adding some
         auxiliary data.
 
         This will extract the group name, the parameters of the dataset to
         be created, and the attributes of the dataset.
+
+        The data can be ``None`` if it will be written later on. The shape,
+        the data type, and optionally the chunk shape then have to be given.
         """
+        if self._get_packed_index(data_type) is not None:
+            msg = ("Auxiliary data type '%s' is packed. Use packed=True to "
+                   "add data to it." % data_type)
+            raise ValueError(msg)
+        if data is not None:
+            shape, dtype = data.shape, data.dtype
         group_name = "%s/%s" % (data_type, tag)
-        if group_name in self._auxiliary_data_group:
+        exists = group_name in self._auxiliary_data_group
+        if exists and not overwrite:
             msg = "Data '%s' already exists in file. Will not be added!" % \
                   group_name
             warnings.warn(msg, ASDFWarning)
@@ -397,17 +853,253 @@ class ASDFDataSet(object):
             "data_type": data_type,
             "dataset_creation_params": {
                 "name": tag,
-                "shape": data.shape,
-                "dtype": data.dtype,
+                "shape": shape,
+                "dtype": dtype,
                 "compression": self.__compression[0],
                 "compression_opts": self.__compression[1],
                 "fletcher32": fletcher32,
-                "maxshape": (None,)
+                "maxshape": (None,) + tuple(shape[1:]) if shape else None
             },
-            "dataset_attrs": parameters,
+            "dataset_attrs": dict(parameters),
+            "overwrite": exists
         }
+        if chunks is not None:
+            info["dataset_creation_params"]["chunks"] = chunks
+        if data is not None:
+            info["dataset_attrs"][CONTENT_HASH_ATTRIBUTE] = \
+                self._zeropad_ascii_string(get_content_hash(data))
         return info
 
+    def _add_packed_auxiliary_data(self, data, data_type, tag, parameters,
+                                   overwrite=False):
+        """
+        Appends a record to a packed auxiliary data type. See
+        :meth:`add_auxiliary_data`.
+        """
+        index = self._get_packed_index(data_type)
+        if index is not None and tag in index:
+            if not overwrite:
+                msg = "Data '%s/%s' already exists in file. Will not be " \
+                      "added!" % (data_type, tag)
+                warnings.warn(msg, ASDFWarning)
+                return
+            self._remove_packed_records(data_type, [tag])
+        self._add_packed_records(data_type, [(tag, data, parameters)])
+
+    def _add_packed_records(self, data_type, records):
+        """
+        Appends records to a packed auxiliary data type which is created if
+        it does not yet exist. The data of all records is written at once.
+
+        :type data_type: str
+        :param records: ``(tag, data, parameters)`` tuples. No record with
+            any of the tags may exist.
+        :type records: list of tuples
+        """
+        records = [(tag, np.asarray(data), parameters)
+                   for tag, data, parameters in records]
+        if not records:
+            return
+        for tag, _, _ in records:
+            if "\t" in tag or "\n" in tag:
+                msg = "Tags of packed auxiliary data must not contain tabs " \
+                    "or line breaks."
+                raise ValueError(msg)
+
+        index_name = "AuxiliaryData/%s/%s" % (data_type, PACKED_INDEX_NAME)
+        index = self._get_packed_index(data_type)
+        if index is None:
+            if data_type in self._auxiliary_data_group:
+                msg = ("Auxiliary data type '%s' already exists and is not "
+                       "packed." % data_type)
+                raise ValueError(msg)
+            group = self._auxiliary_data_group.create_group(data_type)
+            group.create_dataset(
+                PACKED_DATA_NAME, shape=(0,), dtype=records[0][1].dtype,
+                maxshape=(None,), chunks=True,
+                compression=self.__compression[0],
+                compression_opts=self.__compression[1],
+                fletcher32=not bool(self.mpi))
+            self._append_lines(index_name, [])
+            index = self.__packed_indices[data_type] = \
+                collections.OrderedDict()
+
+        # Values must read back exactly as they have been written.
+        dataset = self._auxiliary_data_group[data_type][PACKED_DATA_NAME]
+        native_dtype = dataset.dtype.newbyteorder(str("="))
+        for _, data, _ in records:
+            if data.dtype.newbyteorder(str("=")) != native_dtype:
+                msg = ("Data of type %s cannot be stored in the packed "
+                       "auxiliary data type '%s' of type %s." % (
+                           data.dtype, data_type, dataset.dtype))
+                raise ValueError(msg)
+
+        offset = self._append_data(dataset, np.concatenate(
+            [_i[1].ravel() for _i in records]))
+        lines = []
+        for tag, data, parameters in records:
+            lines.append(format_packed_index_line(tag, PackedRecord(
+                offset=offset, shape=data.shape, parameters=dict(parameters),
+                content_hash=get_content_hash(data))))
+            offset += data.size
+        self._append_lines(index_name, lines)
+        index.update(parse_packed_index("".join(lines)))
+        # Allows counting the records without parsing the index.
+        self.__file[index_name].attrs["record_count"] = len(index)
+
+    def _get_packed_index(self, data_type):
+        """
+        Returns the index of a packed auxiliary data type as an ordered
+        dictionary mapping the tags to :class:`~pyasdf.utils.PackedRecord`
+        objects or ``None`` if the data type does not exist or is not
+        packed.
+
+        :type data_type: str
+        """
+        if data_type not in self._auxiliary_data_group or \
+                PACKED_INDEX_NAME not in \
+                self._auxiliary_data_group[data_type]:
+            self.__packed_indices.pop(data_type, None)
+            return None
+        if data_type not in self.__packed_indices:
+            self.__packed_indices[data_type] = parse_packed_index(
+                self._auxiliary_data_group[data_type][PACKED_INDEX_NAME]
+                .value.tostring().decode())
+        return self.__packed_indices[data_type]
+
+    def _remove_packed_records(self, data_type, tags):
+        """
+        Remove records from a packed auxiliary data type. They are only
+        marked as removed in the index. Their data and index entries stay in
+        the file until it is repacked with :meth:`repack`.
+
+        :type data_type: str
+        :type tags: list of str
+        """
+        index = self._get_packed_index(data_type)
+        for tag in tags:
+            del index[tag]
+        index_name = "AuxiliaryData/%s/%s" % (data_type, PACKED_INDEX_NAME)
+        self._append_lines(index_name, [
+            format_packed_index_line(_i) for _i in tags])
+        self.__file[index_name].attrs["record_count"] = len(index)
+
+    def _get_auxiliary_data_tags(self, data_type):
+        """
+        Returns the tags of all data of an auxiliary data type.
+
+        :type data_type: str
+        """
+        index = self._get_packed_index(data_type)
+        if index is not None:
+            return list(index.keys())
+        return list(self._auxiliary_data_group[data_type].keys())
+
+    def _get_auxiliary_data_count(self, data_type):
+        """
+        Returns the number of items of an auxiliary data type without
+        listing the group or parsing the index of packed data.
+
+        :type data_type: str
+        """
+        group = self._auxiliary_data_group[data_type]
+        if PACKED_INDEX_NAME not in group:
+            return len(group)
+        attrs = group[PACKED_INDEX_NAME].attrs
+        if "record_count" in attrs:
+            return int(attrs["record_count"])
+        # Files written by other tools.
+        return len(self._get_packed_index(data_type))
+
+    def auxiliary_data_writer(self, data_type, tag, shape, dtype,
+                              parameters, chunks=None, overwrite=False):
+        """
+        Adds auxiliary data to the file that is written block by block, e.g.
+        because it is produced incrementally and does not fit in memory.
+
+        Returns a context manager with a ``write(selection, block)``
+        method. The dataset is created up front. If an exception is raised
+        within the context the incomplete data is removed again. Writing
+        whole rows in order avoids reading the data again to compute its
+        content hash.
+
+        Must be called collectively when running with MPI. Each rank can
+        then write its own blocks.
+
+        :param data_type: The type of data, think of it like a subfolder.
+        :param tag: The tag of the data. Must be unique per data_type.
+        :param shape: The shape of the data.
+        :type shape: tuple
+        :param dtype: The data type of the data.
+        :param parameters: Any additional options, as a Python dictionary.
+        :param chunks: The shape of the chunks. Ideally the blocks that are
+            written consist of whole chunks. Chosen automatically by
+            default.
+        :type chunks: tuple
+        :param overwrite: If True, existing data with the same data type
+            and tag is replaced once the new data has been written
+            successfully. Otherwise a ``ValueError`` is raised.
+        :type overwrite: bool
+
+        >>> with data_set.auxiliary_data_writer(
+        ...         "CrossCorrelationStacks", "IU_ANMO", shape=(100000, 2000),
+        ...         dtype=np.float64, parameters={"a": 1}) as writer:
+        ...     for i in range(0, 100000, 1000):
+        ...         writer.write(slice(i, i + 1000), compute_stack(i))
+        """
+        group_name = "%s/%s" % (data_type, tag)
+        final_name = None
+        if group_name in self._auxiliary_data_group:
+            if not overwrite:
+                msg = "Data '%s' already exists in file." % group_name
+                raise ValueError(msg)
+            # Keep the existing data until the new one is complete.
+            final_name = group_name
+            tag = "%s__incomplete" % tag
+            group_name = "%s/%s" % (data_type, tag)
+        info = self._add_auxiliary_data_get_collective_information(
+            None, data_type, tag, parameters, overwrite=True,
+            shape=tuple(shape), dtype=np.dtype(dtype),
+            chunks=chunks if chunks is not None else True)
+        self._add_auxiliary_data_write_collective_information(info)
+        return AuxiliaryDataWriter(group_name, self, shape=shape,
+                                   dtype=dtype, final_name=final_name)
+
+    def _finish_auxiliary_data_writer(self, data_name, success,
+                                      content_hash=None, final_name=None):
+        """
+        Called once all data has been written with an
+        :class:`~pyasdf.utils.AuxiliaryDataWriter`.
+
+        :param data_name: The name of the data in the auxiliary data group.
+        :type data_name: str
+        :param success: False if writing the data failed.
+        :type success: bool
+        :param content_hash: The content hash of the data if it could be
+            computed while writing it.
+        :type content_hash: str
+        :param final_name: If given, the data replaces the data with this
+            name.
+        :type final_name: str
+        """
+        # The file is modified collectively so all ranks have to agree.
+        if self.mpi:
+            success = self.mpi.comm.allreduce(success, op=self.mpi.MPI.LAND)
+        if not success:
+            self.remove_auxiliary_data(*data_name.split("/", 1))
+            return
+        # Attributes can only be written collectively and the content hash
+        # requires all data, so it is skipped with MPI.
+        if not self.mpi:
+            dataset = self._auxiliary_data_group[data_name]
+            if content_hash is None:
+                content_hash = get_content_hash(dataset)
+            dataset.attrs[CONTENT_HASH_ATTRIBUTE] = \
+                self._zeropad_ascii_string(content_hash)
+        if final_name is not None:
+            del self._auxiliary_data_group[final_name]
+            self._auxiliary_data_group.move(data_name, final_name)
+
     def _add_auxiliary_data_write_independent_information(self, info, data):
         """
         Writes the independent part of auxiliary data to the file.
@@ -429,6 +1121,8 @@ class ASDFDataSet(object):
         if data_type not in self._auxiliary_data_group:
             self._auxiliary_data_group.create_group(data_type)
         group = self._auxiliary_data_group[data_type]
+        if info.get("overwrite"):
+            del group[info["dataset_creation_params"]["name"]]
 
         ds = group.create_dataset(**info["dataset_creation_params"])
         for key, value in info["dataset_attrs"].items():
@@ -504,6 +1198,46 @@ class ASDFDataSet(object):
         inv = getattr(station, "StationXML")
         return st, inv
 
+    def aget_data_for_tag(self, station_name, tag):
+        """
+        Awaitable counterpart of :meth:`get_data_for_tag` for use with
+        :mod:`asyncio`.
+
+        The blocking read runs in a small thread pool so the event loop
+        keeps running in the meanwhile.
+
+        :param station_name: A string with network id and station id,
+            e.g. ``"IU.ANMO"``
+        :type station_name: str
+        :param tag: The tag of the waveform.
+        :type tag: str
+
+        >>> async def main():
+        ...     st, inv = await ds.aget_data_for_tag("IU.ANMO",
+        ...                                          "raw_recording")
+        """
+        import asyncio
+        return asyncio.get_event_loop().run_in_executor(
+            self._get_async_executor(), self.get_data_for_tag,
+            station_name, tag)
+
+    def aget_waveforms(self, station_name, tag):
+        """
+        Awaitable returning the waveforms of a station with a certain tag,
+        e.g. ``await ds.aget_waveforms("IU.ANMO", "raw_recording")`` is the
+        non-blocking version of ``ds.waveforms.IU_ANMO.raw_recording``.
+
+        :param station_name: A string with network id and station id,
+            e.g. ``"IU.ANMO"``
+        :type station_name: str
+        :param tag: The tag of the waveform.
+        :type tag: str
+        """
+        import asyncio
+        return asyncio.get_event_loop().run_in_executor(
+            self._get_async_executor(), getattr,
+            getattr(self.waveforms, station_name.replace(".", "_")), tag)
+
     def _get_waveform(self, waveform_name):
         """
         Retrieves the waveform for a certain tag name as a Trace object. For
@@ -538,34 +1272,111 @@ class ASDFDataSet(object):
         return tr
 
     def _get_auxiliary_data(self, data_type, tag):
+        index = self._get_packed_index(data_type)
+        if index is not None:
+            record = index[tag]
+            size = int(np.prod(record.shape))
+            data = self._auxiliary_data_group[data_type][PACKED_DATA_NAME][
+                record.offset:record.offset + size].reshape(record.shape)
+            return AuxiliaryDataContainer(
+                data=data, data_type=data_type, tag=tag,
+                parameters=dict(record.parameters))
         group = self._auxiliary_data_group[data_type][tag]
         return AuxiliaryDataContainer(
             data=group, data_type=data_type, tag=tag,
-            parameters={i: j for i, j in group.attrs.items()})
+            parameters={i: j for i, j in group.attrs.items()
+                        if i != CONTENT_HASH_ATTRIBUTE})
+
+    def summary(self, waveforms=True):
+        """
+        Summarize the contents of the data set.
+
+        Only cheap metadata is used. No data is read and the QuakeML is not
+        parsed. Using an index stored in the file (see
+        :meth:`build_waveform_index`) avoids reading the attributes of the
+        waveforms, only their storage sizes are queried.
+
+        :param waveforms: If False, skip all keys requiring a listing of the
+            waveforms. The summary then takes constant time.
+        :type waveforms: bool
+
+        Returns a dictionary with the following keys:
+
+        * ``"file_size"``: The size of the file in bytes.
+        * ``"event_count"``: The number of events.
+        * ``"station_count"``: The number of stations.
+        * ``"waveform_count"``: The number of waveforms.
+        * ``"total_samples"``: The number of samples of all waveforms.
+        * ``"waveform_bytes"``: The uncompressed size of all waveforms in
+          bytes.
+        * ``"waveform_storage_bytes"``: The size of all waveforms in the
+          file in bytes, i.e. after compression.
+        * ``"stations"``, ``"tags"``, ``"channels"``: Dictionaries with
+          the number of waveforms per station, tag, and channel.
+        * ``"auxiliary_data"``: Dictionary with the number of items per
+          auxiliary data type.
+        """
+        summary = {
+            "file_size": os.path.getsize(self.filename),
+            "event_count": self._get_event_count(),
+            "station_count": len(self._waveform_group),
+            "auxiliary_data": {
+                name: self._get_auxiliary_data_count(name) for name in
+                self._auxiliary_data_group.keys()}}
+        if not waveforms:
+            return summary
+
+        stations = collections.defaultdict(int)
+        tags = collections.defaultdict(int)
+        channels = collections.defaultdict(int)
+        total_samples = 0
+        waveform_bytes = 0
+        names = []
+        for entry in self._get_waveform_index():
+            names.append(entry.name)
+            details = self._get_waveform_details(entry.name)
+            stations["%s.%s" % (entry.network, entry.station)] += 1
+            tags[entry.tag] += 1
+            channels[entry.channel] += 1
+            total_samples += details.npts
+            waveform_bytes += details.npts * np.dtype(details.dtype).itemsize
+
+        summary.update({
+            "waveform_count": sum(stations.values()),
+            "total_samples": total_samples,
+            "waveform_bytes": waveform_bytes,
+            "waveform_storage_bytes": int(
+                self.get_waveform_storage_sizes(names).sum()),
+            "stations": dict(stations),
+            "tags": dict(tags),
+            "channels": dict(channels)})
+        return summary
 
     def __str__(self):
         """
         Pretty string formatting.
         """
-        filesize = sizeof_fmt(os.path.getsize(self.filename))
+        summary = self.summary(waveforms=False)
+        filesize = sizeof_fmt(summary["file_size"])
         ret = "{format} file [format version: {version}]: '{filename}' ({" \
               "size})".format(
                   format=FORMAT_NAME,
                   version=self.asdf_format_version,
                   filename=os.path.relpath(self.filename),
                   size=filesize)
-        ret += "\n\tContains %i event(s)" % len(self.events)
+        ret += "\n\tContains %i event(s)" % summary["event_count"]
         ret += "\n\tContains waveform data from {len} station(s).".format(
-            len=len(self.__file["Waveforms"])
+            len=summary["station_count"]
         )
-        if len(self.auxiliary_data):
+        if summary["auxiliary_data"]:
             ret += "\n\tContains %i type(s) of auxiliary data: %s" % (
-                len(self.auxiliary_data),
-                ", ".join(sorted(dir(self.auxiliary_data))))
+                len(summary["auxiliary_data"]),
+                ", ".join(sorted(summary["auxiliary_data"])))
         return ret
 
     def add_waveforms(self, waveform, tag, event_id=None, origin_id=None,
-                      magnitude_id=None, focal_mechanism_id=None):
+                      magnitude_id=None, focal_mechanism_id=None,
+                      overwrite=False):
         """
         Adds one or more waveforms to the current ASDF file.
 
@@ -598,6 +1409,10 @@ class ASDFDataSet(object):
             data where the mechanism is precisely known.
         :type focal_mechanism_id: :class:`obspy.core.event.FocalMechanism`,
             :class:`obspy.core.event.ResourceIdentifier`, or str
+        :param overwrite: If True, existing waveforms with the same name,
+            e.g. with the same codes, times, and tag, are replaced.
+            Otherwise a warning is raised and they are not added.
+        :type overwrite: bool
 
         .. rubric:: Examples
 
@@ -729,7 +1544,7 @@ class ASDFDataSet(object):
             info = self._add_trace_get_collective_information(
                 trace, tag, event_id=event_id, origin_id=origin_id,
                 magnitude_id=magnitude_id,
-                focal_mechanism_id=focal_mechanism_id)
+                focal_mechanism_id=focal_mechanism_id, overwrite=overwrite)
             if info is None:
                 continue
             self._add_trace_write_collective_information(info)
@@ -743,6 +1558,9 @@ class ASDFDataSet(object):
         :param trace:
         :return:
         """
+        # The data already is in the file.
+        if info.get("is_link"):
+            return
         self._waveform_group[info["data_name"]][:] = trace.data
 
     def _add_trace_write_collective_information(self, info):
@@ -752,25 +1570,51 @@ class ASDFDataSet(object):
         :param info:
         :return:
         """
+        if info.get("overwrite"):
+            self._delete_waveforms([info["data_name"]])
+
         station_name = info["station_name"]
         if station_name not in self._waveform_group:
             self._waveform_group.create_group(station_name)
         group = self._waveform_group[station_name]
 
-        ds = group.create_dataset(**info["dataset_creation_params"])
-        for key, value in info["dataset_attrs"].items():
-            ds.attrs[key] = value
-
-    def _add_trace_get_collective_information(
-            self, trace, tag, event_id=None, origin_id=None,
-            magnitude_id=None, focal_mechanism_id=None):
-        """
-        The information required for the collective part of adding a trace.
-
-        This will extract the group name, the parameters of the dataset to
-        be created, and the attributes of the dataset.
-
-        :param trace: The trace to add.
+        duplicate = self._find_duplicate(info["dataset_attrs"])
+        if duplicate is not None:
+            # Hard link to the existing data.
+            group[info["dataset_creation_params"]["name"]] = duplicate
+            info["is_link"] = True
+        else:
+            ds = group.create_dataset(**info["dataset_creation_params"])
+            for key, value in info["dataset_attrs"].items():
+                ds.attrs[key] = value
+            self._register_content_hash(info["data_name"])
+
+        if self.__waveform_index is not None:
+            bisect.insort(self.__waveform_index,
+                          parse_waveform_name(info["data_name"]))
+        self.__waveform_table = None
+
+        # Keep the index stored in the file up to date.
+        if "WaveformIndex" in self.__file:
+            attrs = info["dataset_attrs"]
+            details = WaveformDetails(
+                starttime=int(attrs["starttime"]),
+                sampling_rate=float(attrs["sampling_rate"]),
+                npts=info["dataset_creation_params"]["shape"][0],
+                dtype=np.dtype(info["dataset_creation_params"]["dtype"]).str,
+                event_id=attrs["event_id"].decode().rstrip("\x00")
+                if "event_id" in attrs else "")
+            self._append_lines("WaveformIndex", [format_waveform_index_line(
+                info["data_name"], details)])
+            self.__waveform_details[info["data_name"]] = details
+
+    @staticmethod
+    def _get_waveform_name(trace, tag):
+        """
+        Returns the full name a trace is stored under, i.e. the name of its
+        station group and the name of the data within it.
+
+        :param trace: The trace.
         :param tag: The tag of the trace.
         """
         station_name = "%s.%s" % (trace.stats.network, trace.stats.station)
@@ -783,9 +1627,24 @@ class ASDFDataSet(object):
             start=trace.stats.starttime.strftime("%Y-%m-%dT%H:%M:%S"),
             end=trace.stats.endtime.strftime("%Y-%m-%dT%H:%M:%S"),
             tag=tag)
+        return "%s/%s" % (station_name, data_name)
+
+    def _add_trace_get_collective_information(
+            self, trace, tag, event_id=None, origin_id=None,
+            magnitude_id=None, focal_mechanism_id=None, overwrite=False):
+        """
+        The information required for the collective part of adding a trace.
+
+        This will extract the group name, the parameters of the dataset to
+        be created, and the attributes of the dataset.
 
-        group_name = "%s/%s" % (station_name, data_name)
-        if group_name in self._waveform_group:
+        :param trace: The trace to add.
+        :param tag: The tag of the trace.
+        """
+        group_name = self._get_waveform_name(trace, tag)
+        station_name, data_name = group_name.split("/")
+        exists = group_name in self._waveform_group
+        if exists and not overwrite:
             msg = "Data '%s' already exists in file. Will not be added!" % \
                   group_name
             warnings.warn(msg, ASDFWarning)
@@ -801,6 +1660,7 @@ class ASDFDataSet(object):
         info = {
             "station_name": station_name,
             "data_name": group_name,
+            "overwrite": exists,
             "dataset_creation_params": {
                 "name": data_name,
                 "shape": (trace.stats.npts,),
@@ -814,7 +1674,9 @@ class ASDFDataSet(object):
                 # Starttime is the epoch time in nanoseconds.
                 "starttime":
                     int(round(trace.stats.starttime.timestamp * 1.0E9)),
-                "sampling_rate": trace.stats.sampling_rate
+                "sampling_rate": trace.stats.sampling_rate,
+                CONTENT_HASH_ATTRIBUTE:
+                    self._zeropad_ascii_string(get_content_hash(trace.data))
             }
         }
 
@@ -870,8 +1732,24 @@ class ASDFDataSet(object):
             self._waveform_group.create_group(station_name)
         station_group = self._waveform_group[station_name]
 
+        attrs = {CONTENT_HASH_ATTRIBUTE:
+                 self._zeropad_ascii_string(get_content_hash(data))}
+
+        # Never modify data shared with other stations or files in place.
+        if "StationXML" in station_group and (
+                isinstance(station_group.get("StationXML", getlink=True),
+                           h5py.ExternalLink) or
+                h5py.h5o.get_info(station_group["StationXML"].id).rc > 1):
+            del station_group["StationXML"]
+
+        duplicate = None
+        if "StationXML" not in station_group:
+            duplicate = self._find_duplicate(attrs)
+
         # If it already exists, overwrite the existing one.
-        if "StationXML" in station_group:
+        if duplicate is not None:
+            station_group["StationXML"] = duplicate
+        elif "StationXML" in station_group:
             station_group["StationXML"].resize(data.shape)
             station_group["StationXML"][:] = data
         else:
@@ -880,6 +1758,57 @@ class ASDFDataSet(object):
                 "StationXML", data=data,
                 maxshape=(None,),
                 fletcher32=True)
+        if duplicate is None:
+            for key, value in attrs.items():
+                station_group["StationXML"].attrs[key] = value
+            self._register_content_hash("%s/StationXML" % station_name)
+
+    def _find_duplicate(self, attrs):
+        """
+        Returns an existing waveform or StationXML dataset with the same
+        content hash and attributes or ``None`` if there is none or
+        deduplication is disabled.
+
+        :param attrs: The attributes of the new dataset including its
+            content hash.
+        :type attrs: dict
+        """
+        if not self.__deduplicate or self.mpi:
+            return None
+        if self.__content_hash_map is None:
+            self.__content_hash_map = collections.defaultdict(list)
+            for name, content_hash in self._get_content_hashes().items():
+                if content_hash and name.startswith("Waveforms/"):
+                    self.__content_hash_map[content_hash].append(
+                        name[len("Waveforms/"):])
+
+        content_hash = bytes(attrs[CONTENT_HASH_ATTRIBUTE]).decode()\
+            .rstrip("\x00")
+        for name in self.__content_hash_map.get(content_hash, []):
+            if name not in self._waveform_group:
+                continue
+            dataset = self._waveform_group[name]
+            # Might have been overwritten in the meanwhile.
+            if get_stored_content_hash(dataset) != content_hash:
+                continue
+            if set(dataset.attrs.keys()) == set(attrs.keys()) and all(
+                    np.array_equal(np.asarray(dataset.attrs[_i]),
+                                   np.asarray(attrs[_i])) for _i in attrs):
+                return dataset
+        return None
+
+    def _register_content_hash(self, name):
+        """
+        Register a newly written dataset as a target for deduplication.
+
+        :param name: The name of the dataset in the waveform group.
+        :type name: str
+        """
+        if self.__content_hash_map is None:
+            return
+        content_hash = get_stored_content_hash(self._waveform_group[name])
+        if content_hash:
+            self.__content_hash_map[content_hash].append(name)
 
     def add_stationxml(self, stationxml):
         """
@@ -929,57 +1858,755 @@ class ASDFDataSet(object):
                         network_id=network_id, station_id=station_id),
                     network_id=network_id, station_id=station_id)
 
-    def validate(self):
-        """
-        Validate and ASDF file. It currently checks that each waveform file
-        has a corresponding station file.
-        """
-        summary = {"no_station_information": 0, "no_waveforms": 0,
-                   "good_stations": 0}
-        for station_id in dir(self.waveforms):
-            station = getattr(self.waveforms, station_id)
-            contents = dir(station)
-            if not contents:
-                continue
-            if "StationXML" not in contents and contents:
+    def validate(self, quick=False, executor=None):
+        """
+        Validate an ASDF file and return a report of all problems found.
+
+        Checks that each station with waveforms has station information
+        and vice versa and that all waveforms are named consistently.
+        Unless ``quick`` is True, it furthermore checks that the station
+        information has a channel epoch covering each waveform and reads
+        every dataset in the file chunk by chunk to verify the fletcher32
+        checksums and that all chunks can be decompressed. The datasets are
+        read in parallel with the given executor. Datasets in other files
+        that are part of the data set via external links, e.g. in a file
+        created with :func:`~pyasdf.multi_file.create_master_file`, are
+        verified as well and links that cannot be resolved are reported as
+        unreadable.
+
+        A short summary is printed as well. Returns a dictionary with the
+        following keys:
+
+        * ``"stations_checked"``: The number of checked stations.
+        * ``"no_station_information"``: Stations with waveforms but
+          without StationXML.
+        * ``"no_waveforms"``: Stations with StationXML but without
+          waveforms.
+        * ``"orphan_waveforms"``: Datasets in station groups which are not
+          valid waveforms of that station.
+        * ``"no_channel_epoch"``: Waveforms without a matching channel
+          epoch in the StationXML.
+        * ``"checksum_failures"``: ``(name, message)`` tuples of datasets
+          whose checksum does not match.
+        * ``"unreadable"``: ``(name, message)`` tuples of datasets that
+          could otherwise not be read.
+        * ``"is_valid"``: True if no problems have been found.
+
+        :param quick: Only check the metadata without reading any data or
+            parsing the station information.
+        :type quick: bool
+        :param executor: The executor used to read the datasets, see
+            :meth:`process`. Defaults to a pool of processes.
+        """
+        report = {
+            "stations_checked": 0, "no_station_information": [],
+            "no_waveforms": [], "orphan_waveforms": [],
+            "no_channel_epoch": [], "checksum_failures": [],
+            "unreadable": []}
+
+        for station_name, group in sorted(self._waveform_group.items()):
+            report["stations_checked"] += 1
+            contents = list(group.keys())
+            waveforms = [_i for _i in contents if _i != "StationXML"]
+            if "StationXML" not in contents and waveforms:
                 print("No station information available for station '%s'" %
-                      station_id)
-                summary["no_station_information"] += 1
+                      station_name)
+                report["no_station_information"].append(station_name)
+            elif "StationXML" in contents and not waveforms:
+                print("Station with no waveforms: '%s'" % station_name)
+                report["no_waveforms"].append(station_name)
+
+            entries = []
+            for name in waveforms:
+                name = "%s/%s" % (station_name, name)
+                entry = parse_waveform_name(name)
+                if entry is None or station_name != "%s.%s" % (
+                        entry.network, entry.station):
+                    report["orphan_waveforms"].append(name)
+                    continue
+                entries.append(entry)
+
+            if quick or "StationXML" not in contents or not entries:
                 continue
-            contents.remove("StationXML")
-            if not contents:
-                print("Station with no waveforms: '%s'" % station_id)
-                summary["no_waveforms"] += 1
+
+            try:
+                inv = self._get_station(station_name)
+                report["no_channel_epoch"].extend(
+                    _i.name for _i in entries
+                    if not self._has_channel_epoch(inv, _i))
+            except Exception:
+                # Unreadable data, e.g. in a missing file linked to, is
+                # reported by the verification of the datasets.
                 continue
-            summary["good_stations"] += 1
 
-        print("\nChecked %i stations:" % len(dir(self.waveforms)))
+        if not quick:
+            for name, checksum_failure, message in \
+                    self._verify_datasets(executor):
+                if checksum_failure:
+                    report["checksum_failures"].append((name, message))
+                else:
+                    report["unreadable"].append((name, message))
+
+        report["is_valid"] = not any(
+            value for key, value in report.items()
+            if key != "stations_checked")
+
+        print("\nChecked %i stations:" % report["stations_checked"])
         print("\t%i stations have no available station information" %
-              summary["no_station_information"])
+              len(report["no_station_information"]))
         print("\t%i stations with no waveforms" %
-              summary["no_waveforms"])
-        print("\t%i good stations" % summary["good_stations"])
+              len(report["no_waveforms"]))
+        print("\t%i orphan waveforms" % len(report["orphan_waveforms"]))
+        if not quick:
+            print("\t%i waveforms without a matching channel epoch" %
+                  len(report["no_channel_epoch"]))
+            print("\t%i datasets with checksum failures" %
+                  len(report["checksum_failures"]))
+            print("\t%i unreadable datasets" % len(report["unreadable"]))
+
+        return report
+
+    def _has_channel_epoch(self, inv, entry):
+        """
+        Returns True if the inventory has a channel epoch covering the
+        waveform.
+
+        :param inv: The station information.
+        :type inv: :class:`~obspy.station.inventory.Inventory`
+        :param entry: The waveform.
+        :type entry: :class:`~pyasdf.utils.WaveformIndexEntry`
+        """
+        details = self._get_waveform_details(entry.name)
+        starttime = obspy.UTCDateTime(details.starttime / 1.0E9)
+        endtime = obspy.UTCDateTime(get_endtime_ns(
+            details.starttime, details.sampling_rate, details.npts) / 1.0E9)
+        for network in inv.select(network=entry.network,
+                                  station=entry.station):
+            for station in network:
+                for channel in station:
+                    if channel.code != entry.channel or \
+                            channel.location_code != entry.location:
+                        continue
+                    if channel.start_date is not None and \
+                            channel.start_date > starttime:
+                        continue
+                    if channel.end_date is not None and \
+                            channel.end_date < endtime:
+                        continue
+                    return True
+        return False
+
+    def _verify_datasets(self, executor=None):
+        """
+        Read all datasets in the file to check their integrity. Returns a
+        list of ``(name, checksum_failure, message)`` tuples for all
+        datasets that could not be read.
 
-    def itertag(self, tag):
+        :param executor: The executor used to read the datasets in
+            parallel.
+        """
+        executor = self._get_executor(executor)
+
+        names = get_dataset_names(self.__file, broken_links=True)
+
+        # Other processes open the file read-only, all other workers share
+        # the already open file.
+        if executor.uses_processes:
+            self._flush()
+            self._close()
+            initargs = (self.filename, None)
+        else:
+            initargs = (self.filename, self)
+        try:
+            failures = [
+                _i for _i in executor.map_unordered(
+                    _verify_dataset, names, initializer=_init_reading_worker,
+                    initargs=initargs)
+                if _i is not None]
+        finally:
+            executor.join()
+            _reading_worker.__dict__.clear()
+            if executor.uses_processes:
+                self._reopen()
+        # Only the first rank gathered the results with MPI.
+        if isinstance(executor, MPIExecutor):
+            failures = executor.comm.bcast(failures, root=0)
+        return sorted(failures)
+
+    def _verify_dataset(self, name):
+        """
+        Read a single dataset chunk by chunk with bounded memory. Returns
+        ``None`` if it could be read, ``(name, checksum_failure, message)``
+        otherwise.
+
+        :param name: The full name of the dataset in the file.
+        :type name: str
+        """
+        try:
+            data = self.__file[name]
+        except Exception as e:
+            return name, False, str(e)
+
+        # HDF5 does not tell checksum errors apart from other filter
+        # failures so verify the checksums of the raw chunks directly.
+        if data.fletcher32 and hasattr(data.id, "get_num_chunks"):
+            try:
+                for _i in range(data.id.get_num_chunks()):
+                    offset = data.id.get_chunk_info(_i).chunk_offset
+                    _, chunk = data.id.read_direct_chunk(offset)
+                    if not fletcher32_matches(chunk):
+                        return name, True, "Checksum mismatch in the " \
+                            "chunk at index %s." % str(offset)
+            except Exception as e:
+                return name, False, str(e)
+
+        for block in get_block_slices(data):
+            try:
+                data[block]
+            except Exception as e:
+                position = "" if block == () else \
+                    " (from index %i)" % block.start
+                return name, False, "%s%s" % (str(e), position)
+        return None
+
+    def itertag(self, tag, prefetch=0):
         """
         Iterate over stations. Yields a tuple of an obspy Stream object and
         an inventory object for the station information. The returned
         inventory object can be None.
 
+        :param tag: The tag of the waveforms. Matched exactly, use
+            :meth:`iterwaveforms` for wildcard patterns.
+        :type tag: str
+        :param prefetch: If larger than zero, the data of up to this many
+            following stations is read in a background thread while the
+            current one is being processed. Overlaps the I/O with the
+            processing of the caller.
+        :type prefetch: int
+
         >>> for st, inv in data_set.itertag("raw_recording"):
         ...     st.detrend("linear")
         """
-        for station in dir(self.waveforms):
-            station = getattr(self.waveforms, station)
-            if tag not in dir(station):
+        return self.iterwaveforms(tag=escape_pattern(tag), prefetch=prefetch)
+
+    def iterwaveforms(self, tag=None, network=None, station=None,
+                      location=None, channel=None, starttime=None,
+                      endtime=None, event_id=None, prefetch=0):
+        """
+        Iterate over all stations with waveforms matching the given
+        criteria. Yields a tuple of an obspy Stream object with only the
+        matching waveforms and an inventory object for the station
+        information. The returned inventory object can be None.
+
+        The waveforms are selected with the index of the file so groups
+        and waveforms not matching the criteria are never touched. See
+        :meth:`get_waveform_list` for the meaning of the parameters.
+
+        :param prefetch: If larger than zero, the data of up to this many
+            following stations is read in a background thread while the
+            current one is being processed.
+        :type prefetch: int
+
+        >>> for st, inv in data_set.iterwaveforms(
+        ...         tag="raw_recording", network="IU", channel="BH?",
+        ...         starttime=obspy.UTCDateTime(2013, 5, 24)):
+        ...     st.detrend("linear")
+        """
+        names = self.get_waveform_list(
+            tag=tag, network=network, station=station, location=location,
+            channel=channel, starttime=starttime, endtime=endtime,
+            event_id=event_id)
+
+        # The list is sorted, thus all waveforms of a station are adjacent.
+        stations = iter([
+            (station_name, list(waveforms)) for station_name, waveforms in
+            itertools.groupby(names, key=lambda x: x.split("/")[0])])
+
+        if prefetch <= 0:
+            for station_name, waveforms in stations:
+                yield self._read_waveforms(station_name, waveforms)
+            return
+
+        for _, data in prefetch_items(
+                lambda: next(stations, None),
+                lambda x: self._read_waveforms(*x), prefetch=prefetch):
+            yield data
+
+    def _read_waveforms(self, station_name, waveform_names):
+        """
+        Read the given waveforms of a single station and its station
+        information.
+
+        :param station_name: A string with network id and station id,
+            e.g. ``"IU.ANMO"``
+        :type station_name: str
+        :param waveform_names: The full names of the waveforms.
+        :type waveform_names: list of str
+        """
+        return self.read_waveforms(waveform_names), \
+            self._get_station(station_name)
+
+    def get_waveform_list(self, tag=None, network=None, station=None,
+                          location=None, channel=None, starttime=None,
+                          endtime=None, event_id=None):
+        """
+        Returns a sorted list with the full names, e.g.
+        ``"STATION_NAME/WAVEFORM_NAME"``, of all waveforms in the file
+        matching the given criteria.
+
+        All criteria are optional. The codes and the tag can be UNIX style
+        wildcard patterns like ``"BH?"`` or a list of such patterns.
+
+        Only the index of the file is used to select the waveforms apart
+        from the time range and the event which are checked against the
+        attributes of the candidate waveforms.
+
+        :param tag: The tag of the waveforms.
+        :param network: The network code.
+        :param station: The station code.
+        :param location: The location code.
+        :param channel: The channel code.
+        :param starttime: Only waveforms with data at or after this time.
+        :type starttime: :class:`~obspy.core.utcdatetime.UTCDateTime`
+        :param endtime: Only waveforms with data at or before this time.
+        :type endtime: :class:`~obspy.core.utcdatetime.UTCDateTime`
+        :param event_id: Only waveforms associated with this event.
+        :type event_id: :class:`obspy.core.event.Event`,
+            :class:`obspy.core.event.ResourceIdentifier`, or str
+        """
+        if event_id is not None:
+            event_id = self._get_event_id(event_id)
+
+        names = []
+        for entry in self._get_waveform_index():
+            if not (matches_pattern(entry.tag, tag) and
+                    matches_pattern(entry.network, network) and
+                    matches_pattern(entry.station, station) and
+                    matches_pattern(entry.location, location) and
+                    matches_pattern(entry.channel, channel)):
                 continue
-            if "StationXML" in dir(station):
-                inv = station.StationXML
-            else:
-                inv = None
-            st = getattr(station, tag)
-            yield st, inv
-        raise StopIteration
+            # The times in the names are rounded down to full seconds.
+            if starttime is not None and \
+                    entry.endtime + 1 < starttime.timestamp:
+                continue
+            if endtime is not None and entry.starttime > endtime.timestamp:
+                continue
+            names.append(entry.name)
+
+        if starttime is None and endtime is None and event_id is None:
+            return names
+
+        # Check the remaining criteria with the attributes.
+        def matches_attributes(name):
+            details = self._get_waveform_details(name)
+            if event_id is not None and details.event_id != event_id:
+                return False
+            start = details.starttime / 1.0E9
+            end = get_endtime_ns(details.starttime, details.sampling_rate,
+                                 details.npts) / 1.0E9
+            if starttime is not None and end < starttime.timestamp:
+                return False
+            if endtime is not None and start > endtime.timestamp:
+                return False
+            return True
+
+        return [_i for _i in names if matches_attributes(_i)]
+
+    @property
+    def waveform_table(self):
+        """
+        A table with one row per waveform in the file as a numpy structured
+        array with the fields ``name`` (the full name of the waveform),
+        ``network``, ``station``, ``location``, ``channel``, ``tag``,
+        ``starttime`` and ``endtime`` (both in nanoseconds since the epoch),
+        ``sampling_rate``, ``npts``, ``dtype``, and ``event_id``. It is
+        built from the waveform index without opening the datasets, see
+        :meth:`get_waveform_storage_sizes` for their sizes on disc.
+
+        Boolean masks over it can be used to select waveforms and to read
+        them with :meth:`read_waveforms`.
+
+        >>> table = ds.waveform_table
+        >>> mask = ((table["sampling_rate"] == 40.0) &
+        ...         (table["tag"] == "raw_recording") &
+        ...         np.char.startswith(table["channel"], "BH"))
+        >>> st = ds.read_waveforms(table[mask])
+
+        If pandas is installed it can directly be converted to a data frame.
+
+        >>> import pandas
+        >>> df = pandas.DataFrame(ds.waveform_table)
+        """
+        if self.__waveform_table is None:
+            rows = []
+            for entry in self._get_waveform_index():
+                details = self._get_waveform_details(entry.name)
+                rows.append((
+                    entry.name, entry.network, entry.station,
+                    entry.location, entry.channel, entry.tag,
+                    details.starttime,
+                    get_endtime_ns(details.starttime, details.sampling_rate,
+                                   details.npts),
+                    details.sampling_rate, details.npts, details.dtype,
+                    details.event_id))
+            self.__waveform_table = to_structured_array(rows, [
+                ("name", str), ("network", str), ("station", str),
+                ("location", str), ("channel", str), ("tag", str),
+                ("starttime", np.int64), ("endtime", np.int64),
+                ("sampling_rate", np.float64), ("npts", np.int64),
+                ("dtype", str), ("event_id", str)])
+        return self.__waveform_table
+
+    def get_waveform_storage_sizes(self, waveforms):
+        """
+        The sizes of waveforms on disc in bytes after compression. Opens
+        every dataset so only ask for the waveforms of interest.
+
+        :param waveforms: The full names of the waveforms, e.g. as returned
+            by :meth:`get_waveform_list`, or rows of the
+            :attr:`waveform_table`.
+        :rtype: :class:`numpy.ndarray`
+
+        >>> table = ds.waveform_table
+        >>> table = table[table["tag"] == "raw_recording"]
+        >>> total = ds.get_waveform_storage_sizes(table).sum()
+        """
+        if isinstance(waveforms, np.ndarray) and waveforms.dtype.names:
+            waveforms = waveforms["name"]
+        return np.array([
+            self._waveform_group[str(_i)].id.get_storage_size()
+            for _i in waveforms], dtype=np.int64)
+
+    def read_waveforms(self, waveforms):
+        """
+        Read many waveforms at once.
+
+        :param waveforms: The full names of the waveforms, e.g. as returned
+            by :meth:`get_waveform_list`, or rows of the
+            :attr:`waveform_table`.
+        :return: All waveforms in the given order.
+        :rtype: :class:`~obspy.core.stream.Stream`
+        """
+        if isinstance(waveforms, np.ndarray) and waveforms.dtype.names:
+            waveforms = waveforms["name"]
+        return obspy.Stream(traces=[
+            self._get_waveform(_i.split("/")[-1]) for _i in waveforms])
+
+    def remove_waveforms(self, waveforms):
+        """
+        Remove waveforms from the file.
+
+        The space of the removed data is reused for data written while the
+        file stays open, see the ``track_free_space`` argument of
+        :class:`ASDFDataSet` to also reuse it later on.
+        Data stored once for more than one waveform with the
+        ``deduplicate`` option is only removed together with the last of
+        them.
+
+        Must be called collectively when running with MPI.
+
+        :param waveforms: The full names of the waveforms, e.g. as returned
+            by :meth:`get_waveform_list`, or rows of the
+            :attr:`waveform_table`.
+
+        >>> data_set.remove_waveforms(data_set.get_waveform_list(
+        ...     tag="preprocessed"))
+        """
+        if isinstance(waveforms, np.ndarray) and waveforms.dtype.names:
+            waveforms = waveforms["name"]
+        names = [str(_i) for _i in waveforms]
+        missing = [_i for _i in names if _i not in self._waveform_group or
+                   _i.split("/")[-1] == "StationXML"]
+        if missing:
+            msg = "Waveform(s) %s not in the file." % ", ".join(missing)
+            raise ValueError(msg)
+        self._delete_waveforms(names)
+
+    def _delete_waveforms(self, names):
+        """
+        Delete waveforms, their station groups if they are empty
+        afterwards, and their entries in the index.
+
+        :param names: The full names of the waveforms.
+        :type names: list of str
+        """
+        for name in names:
+            del self._waveform_group[name]
+        for station_name in set(_i.split("/")[0] for _i in names):
+            if not len(self._waveform_group[station_name]):
+                del self._waveform_group[station_name]
+        self._remove_from_waveform_index(names)
+
+    def remove_auxiliary_data(self, data_type, tag=None):
+        """
+        Remove auxiliary data from the file.
+
+        The space of the removed data is reused for data written while the
+        file stays open, see the ``track_free_space`` argument of
+        :class:`ASDFDataSet` to also reuse it later on.
+
+        Must be called collectively when running with MPI.
+
+        :param data_type: The type of the data.
+        :type data_type: str
+        :param tag: The tag of the data. Removes all data of the given type
+            if not given.
+        :type tag: str
+        """
+        group = self._auxiliary_data_group
+        index = self._get_packed_index(data_type)
+        if index is not None and tag is not None:
+            if tag not in index:
+                msg = "Auxiliary data '%s/%s' not in the file." % (
+                    data_type, tag)
+                raise ValueError(msg)
+            self._remove_packed_records(data_type, [tag])
+            return
+        name = data_type if tag is None else "%s/%s" % (data_type, tag)
+        if name not in group:
+            msg = "Auxiliary data '%s' not in the file." % name
+            raise ValueError(msg)
+        del group[name]
+        if data_type in group and not len(group[data_type]):
+            del group[data_type]
+
+    def get_gather(self, tag, channel=None, stations=None):
+        """
+        Read the waveforms of many stations sharing the same number of
+        samples and sampling rate, e.g. synthetics, into a single 2-D
+        array.
+
+        The data is read directly into a preallocated array without
+        creating any ObsPy objects.
+
+        :param tag: The tag of the waveforms.
+        :type tag: str
+        :param channel: Only waveforms with this channel code. Can be a
+            wildcard pattern or a list of patterns.
+        :param stations: Only waveforms of these stations, e.g.
+            ``["IU.ANMO", "TA.*"]``. All stations if not given.
+        :type stations: list of str
+        :return: An array with shape ``(n_traces, npts)`` and a numpy
+            structured array with the fields ``network``, ``station``,
+            ``location``, ``channel``, ``starttime`` (in nanoseconds since
+            the epoch), and ``sampling_rate`` describing each row.
+
+        >>> data, meta = ds.get_gather("synthetic", channel="MXZ")
+        >>> data.shape
+        (2000, 8001)
+        >>> meta["station"][:3]
+        array(['A001', 'A002', 'A003'], dtype='<U4')
+        """
+        names = [_i for _i in self.get_waveform_list(tag=tag, channel=channel)
+                 if matches_pattern(_i.split("/")[0], stations)]
+        datasets = [self._waveform_group[_i] for _i in names]
+
+        if len(set(_i.shape for _i in datasets)) > 1:
+            msg = "The waveforms do not all have the same number of samples."
+            raise ValueError(msg)
+        if len(set(float(_i.attrs["sampling_rate"])
+                   for _i in datasets)) > 1:
+            msg = "The waveforms do not all have the same sampling rate."
+            raise ValueError(msg)
+
+        npts = datasets[0].shape[0] if datasets else 0
+        dtype = np.result_type(*[_i.dtype for _i in datasets]) \
+            if datasets else np.float64
+
+        data = np.empty((len(datasets), npts), dtype=dtype)
+        rows = []
+        for _i, (name, dataset) in enumerate(zip(names, datasets)):
+            if npts:
+                dataset.read_direct(data, dest_sel=np.s_[_i])
+            entry = parse_waveform_name(name)
+            rows.append((entry.network, entry.station, entry.location,
+                         entry.channel, int(dataset.attrs["starttime"]),
+                         float(dataset.attrs["sampling_rate"])))
+
+        metadata = to_structured_array(rows, [
+            ("network", str), ("station", str), ("location", str),
+            ("channel", str), ("starttime", np.int64),
+            ("sampling_rate", np.float64)])
+        return data, metadata
+
+    def _get_waveform_index(self):
+        """
+        Returns the index of all waveforms in the file as a list of
+        :class:`~pyasdf.utils.WaveformIndexEntry` objects sorted by name.
+
+        Read from the index stored in the file if available. Otherwise
+        built by listing all station groups on first access. Kept up to
+        date by all methods adding waveforms.
+        """
+        if self.__waveform_index is None and "WaveformIndex" in self.__file:
+            self.__waveform_index, self.__waveform_details = \
+                parse_waveform_index(
+                    self.__file["WaveformIndex"].value.tostring().decode())
+            self.__waveform_index.sort()
+        elif self.__waveform_index is None:
+            # Only list the names. Group.visit() would furthermore skip
+            # waveforms stored as hard links to other waveforms.
+            index = []
+            for station_name, group in self._waveform_group.items():
+                for name in group.keys():
+                    entry = parse_waveform_name(
+                        "%s/%s" % (station_name, name))
+                    if entry is not None:
+                        index.append(entry)
+            self.__waveform_index = sorted(index)
+        return self.__waveform_index
+
+    @staticmethod
+    def _get_event_id(event):
+        """
+        Returns the resource id of an event as a string.
+
+        :type event: :class:`obspy.core.event.Event`,
+            :class:`obspy.core.event.ResourceIdentifier`, or str
+        """
+        if isinstance(event, obspy.core.event.Event):
+            event = event.resource_id
+        if isinstance(event, obspy.core.event.ResourceIdentifier):
+            event = event.id
+        return str(event)
+
+    def _get_waveform_details(self, name):
+        """
+        Returns the attributes of a single waveform as a
+        :class:`~pyasdf.utils.WaveformDetails` object. Taken from the index
+        stored in the file if available.
+
+        :param name: The full name of the waveform.
+        :type name: str
+        """
+        self._get_waveform_index()
+        if name in self.__waveform_details:
+            return self.__waveform_details[name]
+        data = self._waveform_group[name]
+        if "event_id" in data.attrs:
+            event_id = data.attrs["event_id"].tostring().decode()
+        else:
+            event_id = ""
+        return WaveformDetails(
+            starttime=int(data.attrs["starttime"]),
+            sampling_rate=float(data.attrs["sampling_rate"]),
+            npts=data.shape[0], dtype=data.dtype.str, event_id=event_id)
+
+    def build_waveform_index(self):
+        """
+        Write an index of all waveforms to the file.
+
+        Listing and selecting waveforms, e.g. with :meth:`get_waveform_list`
+        or :meth:`iterwaveforms`, then only reads the index instead of
+        traversing all groups and datasets in the file which is very slow
+        for large files on parallel file systems. Once written, pyasdf
+        keeps the index up to date.
+
+        Run it again to repair the index if the file has been modified with
+        other tools.
+
+        Must be called collectively when running with MPI.
+        """
+        self.__waveform_index = None
+        self.__waveform_details = {}
+        self.__waveform_table = None
+        if "WaveformIndex" in self.__file:
+            del self.__file["WaveformIndex"]
+
+        lines = [format_waveform_index_line(
+            _i.name, self._get_waveform_details(_i.name))
+            for _i in self._get_waveform_index()]
+        self._append_lines("WaveformIndex", lines)
+
+        # Force reading the new index on the next access.
+        self.__waveform_index = None
+
+    def _has_waveform_index(self):
+        """
+        Returns True if the file has a stored waveform index.
+        """
+        return "WaveformIndex" in self.__file
+
+    def _remove_from_waveform_index(self, names):
+        """
+        Remove waveforms from the in-memory and the stored index after
+        they have been deleted from the file.
+
+        :param names: The full names of the deleted waveforms.
+        :type names: list of str
+        """
+        if not names:
+            return
+        names = set(names)
+        if "WaveformIndex" in self.__file:
+            lines = self.__file["WaveformIndex"].value.tostring().decode()\
+                .splitlines(True)
+            lines = [_i for _i in lines if _i.split("\t")[0] not in names]
+            del self.__file["WaveformIndex"]
+            self._append_lines("WaveformIndex", lines)
+        self.__waveform_index = None
+        self.__waveform_details = {}
+        self.__waveform_table = None
+
+    def aitertag(self, tag, prefetch=2):
+        """
+        Asynchronous version of :meth:`itertag` for use with
+        :mod:`asyncio`.
+
+        The data of the next ``prefetch`` stations is read in the background
+        while the current one is being processed.
+
+        :param tag: The tag of the waveforms.
+        :type tag: str
+        :param prefetch: The number of stations to read ahead.
+        :type prefetch: int
+
+        >>> async def main():
+        ...     async for st, inv in data_set.aitertag("raw_recording"):
+        ...         st.detrend("linear")
+        """
+        return AsyncReadAheadIterator(
+            functools.partial(self.get_data_for_tag, tag=tag),
+            self._get_stations_with_tag(tag),
+            executor=self._get_async_executor(), prefetch=prefetch)
+
+    def _get_stations_with_tag(self, tag):
+        """
+        Returns a sorted list of all stations with waveforms for the given
+        tag.
+
+        :param tag: The tag of the waveforms.
+        :type tag: str
+        """
+        return sorted(set(
+            _i.split("/")[0] for _i in self.get_waveform_list(tag=tag)))
+
+    def _get_waveform_data_size(self, station_name, tag=None):
+        """
+        Estimate the size of the waveform data of a station in bytes.
+
+        Only uses the shape and data type of the datasets, thus no actual
+        data has to be read.
+
+        :param station_name: A string with network id and station id,
+            e.g. ``"IU.ANMO"``
+        :type station_name: str
+        :param tag: Only consider waveforms with this tag. All waveforms
+            if not given.
+        :type tag: str
+        """
+        if station_name not in self._waveform_group:
+            return 0
+        group = self._waveform_group[station_name]
+        size = 0
+        for name in group.keys():
+            if name == "StationXML":
+                continue
+            if tag is not None and not name.endswith("__" + tag):
+                continue
+            data = group[name]
+            size += data.size * data.dtype.itemsize
+        return size
 
     def get_station_list(self):
         """
@@ -987,10 +2614,264 @@ class ASDFDataSet(object):
         """
         return sorted(self.__file["Waveforms"].keys())
 
+    def extract(self, output_filename, stations=None, tags=None,
+                starttime=None, endtime=None, events=None,
+                compression="gzip-3"):
+        """
+        Extract a subset of the data set to a new file.
+
+        Waveforms completely within the time range are copied as they are
+        without decompressing them. Only the samples within the time range
+        are read from all other waveforms and written to the new file. The
+        station information of all selected stations is copied as well.
+        Auxiliary data and provenance records are not extracted.
+
+        :param output_filename: The filename of the new file. Must not yet
+            exist.
+        :type output_filename: str
+        :param stations: The names of the stations, e.g. ``"IU.ANMO"``. Can
+            be UNIX style wildcard patterns or a list of such patterns.
+            Defaults to all stations.
+        :param tags: The tags of the waveforms. Can be UNIX style wildcard
+            patterns or a list of such patterns. Defaults to all tags.
+        :param starttime: Only data at or after this time.
+        :type starttime: :class:`~obspy.core.utcdatetime.UTCDateTime`
+        :param endtime: Only data at or before this time.
+        :type endtime: :class:`~obspy.core.utcdatetime.UTCDateTime`
+        :param events: Only these events are written to the new file and
+            waveforms associated with other events are not extracted.
+            Defaults to all events.
+        :type events: list of :class:`obspy.core.event.Event`,
+            :class:`obspy.core.event.ResourceIdentifier`, or str
+        :param compression: The compression of the waveforms that are cut
+            to the time range. See :class:`ASDFDataSet` for the available
+            choices.
+        :type compression: str
+
+        >>> data_set.extract("subset.h5", stations="IU.*",
+        ...                  tags="raw_recording",
+        ...                  starttime=obspy.UTCDateTime(2013, 5, 24),
+        ...                  endtime=obspy.UTCDateTime(2013, 5, 25))
+        """
+        if os.path.exists(output_filename):
+            msg = "Output file '%s' already exists." % output_filename
+            raise ValueError(msg)
+
+        event_ids = None
+        if events is not None:
+            event_ids = set(self._get_event_id(_i) for _i in events)
+
+        names = [_i for _i in self.get_waveform_list(
+            tag=tags, starttime=starttime, endtime=endtime)
+            if matches_pattern(_i.split("/")[0], stations)]
+
+        output_data_set = ASDFDataSet(output_filename,
+                                      compression=compression, mpi=False)
+        # Keeps data shared between datasets shared.
+        copies = {}
+
+        for station_name in self.get_station_list():
+            if not matches_pattern(station_name, stations) or \
+                    "StationXML" not in self._waveform_group[station_name]:
+                continue
+            copy_dataset(
+                self._waveform_group[station_name]["StationXML"],
+                output_data_set._waveform_group.require_group(station_name),
+                "StationXML", copies)
+
+        for name in names:
+            details = self._get_waveform_details(name)
+            if event_ids is not None and details.event_id.rstrip("\x00") \
+                    and details.event_id.rstrip("\x00") not in event_ids:
+                continue
+            station_name, data_name = name.split("/")
+            data = self._waveform_group[name]
+            first, stop = get_sample_range(details, starttime, endtime)
+            if first == stop:
+                continue
+            if stop - first == details.npts:
+                copy_dataset(data, output_data_set._waveform_group
+                             .require_group(station_name), data_name, copies)
+                continue
+
+            # Only read the samples within the time range.
+            entry = parse_waveform_name(name)
+            tr = obspy.Trace(data=data[first:stop])
+            tr.stats.network = entry.network
+            tr.stats.station = entry.station
+            tr.stats.location = entry.location
+            tr.stats.channel = entry.channel
+            tr.stats.sampling_rate = details.sampling_rate
+            tr.stats.starttime = obspy.UTCDateTime(
+                details.starttime / 1.0E9) + first / details.sampling_rate
+            ids = {_i: data.attrs[_i].tostring().decode().rstrip("\x00")
+                   for _i in ("event_id", "origin_id", "magnitude_id",
+                              "focal_mechanism_id") if _i in data.attrs}
+            output_data_set.add_waveforms(tr, tag=entry.tag, **ids)
+
+        if event_ids is None:
+            # The events do not have to be parsed if all are extracted.
+            del output_data_set.__file["QuakeML"]
+            self.__file.copy(self.__file["QuakeML"], output_data_set.__file,
+                             name="QuakeML")
+        else:
+            cat = obspy.core.event.Catalog(events=[
+                _i for _i in self.events if _i.resource_id.id in event_ids])
+            if len(cat):
+                output_data_set.events = cat
+
+        # Maintain an index of the waveforms if the input has one.
+        if "WaveformIndex" in self.__file:
+            output_data_set.build_waveform_index()
+
+    def repack(self, output_filename, compression="keep", chunking=None):
+        """
+        Write a compact copy of the data set to a new file.
+
+        HDF5 does not return the space of deleted or resized datasets, e.g.
+        of repeatedly updated station information and events, to the file
+        system. The copy only contains the live data. The waveforms are
+        written ordered by station and start time to enable fast
+        sequential reading.
+
+        Data is copied as it is, e.g. without decompressing it, unless the
+        compression or chunking is changed.
+
+        :param output_filename: The filename of the new file. Must not yet
+            exist.
+        :type output_filename: str
+        :param compression: The new compression of the waveforms and the
+            auxiliary data. See :class:`ASDFDataSet` for the available
+            choices. Defaults to ``"keep"`` which keeps the existing
+            compression.
+        :type compression: str
+        :param chunking: The new number of samples per chunk of the
+            waveforms. Defaults to keeping the existing chunking.
+        :type chunking: int
+        """
+        if os.path.exists(output_filename):
+            msg = "Output file '%s' already exists." % output_filename
+            raise ValueError(msg)
+        if compression != "keep" and compression not in COMPRESSIONS:
+            msg = "Unknown compressions '%s'. Available compressions: \n\t%s" \
+                % (compression, "\n\t".join(sorted(
+                    [str(i) for i in COMPRESSIONS.keys()])))
+            raise ValueError(msg)
+
+        storage = {}
+        if compression != "keep":
+            storage["compression"], storage["compression_opts"] = \
+                COMPRESSIONS[compression]
+        waveform_storage = dict(storage)
+        if chunking is not None:
+            waveform_storage["chunks"] = (chunking,)
+
+        output_data_set = ASDFDataSet(output_filename, mpi=False)
+        output_file = output_data_set.__file
+        for key, value in self.__file.attrs.items():
+            output_file.attrs[key] = value
+        # Keeps data shared between datasets shared.
+        copies = {}
+
+        # Waveforms sorted by station and start time.
+        names = sorted(self.get_waveform_list(), key=lambda x: (
+            x.split("/")[0], self._get_waveform_details(x).starttime, x))
+        for station_name, waveforms in itertools.groupby(
+                names, key=lambda x: x.split("/")[0]):
+            group = output_file["Waveforms"].require_group(station_name)
+            station_group = self._waveform_group[station_name]
+            if "StationXML" in station_group:
+                copy_dataset(station_group["StationXML"], group,
+                             "StationXML", copies)
+            for name in waveforms:
+                copy_dataset(self._waveform_group[name], group,
+                             name.split("/")[1], copies, **waveform_storage)
+
+        # Only the live records of packed auxiliary data.
+        for data_type in self._auxiliary_data_group.keys():
+            index = self._get_packed_index(data_type)
+            if index is None:
+                continue
+            source = self._auxiliary_data_group[data_type][PACKED_DATA_NAME]
+            sizes = [int(np.prod(_i.shape)) for _i in index.values()]
+            params = {
+                "shape": (sum(sizes),),
+                "dtype": source.dtype,
+                "maxshape": (None,),
+                "chunks": source.chunks,
+                "compression": source.compression,
+                "compression_opts": source.compression_opts,
+                "fletcher32": source.fletcher32}
+            params.update(storage)
+            data = output_file["AuxiliaryData"].require_group(
+                data_type).create_dataset(PACKED_DATA_NAME, **params)
+            lines = []
+            offset = 0
+            for (tag, record), size in zip(index.items(), sizes):
+                data[offset:offset + size] = \
+                    source[record.offset:record.offset + size]
+                lines.append(format_packed_index_line(
+                    tag, record._replace(offset=offset)))
+                offset += size
+            index_name = "AuxiliaryData/%s/%s" % (data_type,
+                                                  PACKED_INDEX_NAME)
+            output_data_set._append_lines(index_name, lines)
+            output_file[index_name].attrs["record_count"] = len(lines)
+
+        # Everything else.
+        for name, obj in self.__file.items():
+            if name == "Waveforms":
+                names = get_dataset_names(obj)
+            elif isinstance(obj, h5py.Group):
+                names = sorted(get_dataset_names(obj))
+            else:
+                if name in output_file:
+                    del output_file[name]
+                copy_dataset(obj, output_file, name, copies)
+                continue
+            for dataset_name in names:
+                full_name = "%s/%s" % (name, dataset_name)
+                if full_name in output_file:
+                    continue
+                parent, _, dataset_name = full_name.rpartition("/")
+                copy_dataset(
+                    self.__file[full_name], output_file.require_group(parent),
+                    dataset_name, copies,
+                    **(storage if name == "AuxiliaryData" else {}))
+
     def process_two_files_without_parallel_output(self, other_ds,
-                                                  process_function):
-        if not self.mpi:
-            raise ASDFException("Currently only works with MPI.")
+                                                  process_function,
+                                                  executor=None):
+        """
+        Process data in two data sets station by station.
+
+        Mostly useful to compare data in two data sets, e.g. to pick windows
+        or measure misfits between observed and synthetic data. The
+        processing function is called for every station that is part of
+        both data sets and the results are gathered and returned. Nothing
+        will be written to any file.
+
+        Stations are handed out dynamically, the largest ones first. Workers
+        processing one station after the other, i.e. the serial and the MPI
+        executor, read the data of the next station from both files while
+        the current one is being processed.
+
+        :param other_ds: The data set to process together with this one.
+        :type other_ds: :class:`~pyasdf.asdf_data_set.ASDFDataSet`
+        :param process_function: Function taking two arguments: The
+            contents of a station in this and in the other data set. Both
+            behave like the objects returned by ``ds.waveforms.NET_STA``
+            but all of their data has already been read. The returned value
+            must be picklable.
+        :type process_function: function
+        :param executor: How to run the jobs, see :meth:`process`.
+        :type executor: str or :class:`~pyasdf.executors.Executor`
+        :return: A dictionary mapping station names to the values returned
+            by the processing function. Stations for which the processing
+            function raised are reported with a warning and will not be
+            part of it. Returned on all ranks when run with MPI.
+        """
+        executor = self._get_executor(executor)
 
         this_stations = set(self.get_station_list())
         other_stations = set(other_ds.get_station_list())
@@ -998,42 +2879,136 @@ class ASDFDataSet(object):
         # Usable stations are those that are part of both.
         usable_stations = list(this_stations.intersection(other_stations))
 
-        # Divide into chunks, each rank takes their corresponding chunks.
-        def chunks(l, n):
-            """
-            Yield successive n-sized chunks from l.
-            From http://stackoverflow.com/a/312464/1657047
-            """
-            for i in range(0, len(l), n):
-                yield l[i:i+n]
+        # Handing out the largest stations first keeps the tail short.
+        sizes = {_i: self._get_waveform_data_size(_i) +
+                 other_ds._get_waveform_data_size(_i)
+                 for _i in usable_stations}
+        usable_stations.sort(key=lambda x: (-sizes[x], x))
 
-        chunksize = int(math.ceil(len(usable_stations) / self.mpi.size))
-        all_chunks = list(chunks(usable_stations, chunksize))
+        if not self.mpi or self.mpi.rank == 0:
+            print("Launching processing using %s." % executor)
 
-        results = {}
+        # Other processes open both files read-only, all other workers share
+        # the already open files.
+        if executor.uses_processes:
+            self._flush()
+            self._close()
+            other_ds._flush()
+            other_ds._close()
+            initargs = (self.filename, other_ds.filename, process_function)
+        else:
+            initargs = (self.filename, other_ds.filename, process_function,
+                        self, other_ds)
+        outputs = None
+        try:
+            outputs = executor.map_unordered(
+                _run_station_pair_job, usable_stations,
+                initializer=_init_station_pair_worker, initargs=initargs,
+                read=_read_station_pair)
+            results = {station: (result, error)
+                       for station, result, error in outputs}
+        finally:
+            if hasattr(outputs, "close"):
+                outputs.close()
+            executor.join()
+            _station_pair_worker.__dict__.clear()
+            if executor.uses_processes:
+                self._reopen()
+                other_ds._reopen()
+
+        # Only the first rank gathered the results with MPI.
+        if isinstance(executor, MPIExecutor):
+            results = executor.comm.bcast(results, root=0)
+
+        # Unpack and report the failures.
+        for station, (result, error) in sorted(results.items()):
+            if error is None:
+                results[station] = result
+                continue
+            del results[station]
+            msg = "Could not process station '%s' due to: %s" % (station,
+                                                                 error)
+            warnings.warn(msg, ASDFWarning)
+        return results
 
-        for station in all_chunks[self.mpi.rank]:
-            try:
-                result = process_function(
-                    getattr(self.waveforms, station),
-                    getattr(other_ds.waveforms, station))
-            except Exception as e:
-                print("Could not process station '%s' due to: %s" % (
-                    station, str(e)))
-            results[station] = result
+    def _read_station(self, station_name):
+        """
+        Read all waveforms and the station information of a single station
+        to memory.
 
-        # Gather and create a final dictionary of results.
-        gathered_results = self.mpi.comm.allgather(results)
-        results = {}
-        for result in gathered_results:
-            results.update(result)
-        return results
+        :param station_name: A string with network id and station id,
+            e.g. ``"IU.ANMO"``
+        :type station_name: str
+        """
+        station = getattr(self.waveforms, station_name)
+        return InMemoryWaveformAccessor(
+            {_i: getattr(station, _i) for _i in dir(station)})
+
+    def process(self, process_function, output_filename, tag_map,
+                resume=False, executor=None):
+        """
+        Process the contents of an ``ASDF`` file in parallel.
+
+        Applies a function to the contents of the current data set and
+        writes the output to a new ``ASDF`` file. Can be run with and
+        without MPI.
+
+        :param process_function: A function with two arguments:
+            An :class:`obspy.core.stream.Stream` object and an
+            :class:`obspy.station.inventory.Inventory` object. It should
+            return either a :class:`obspy.core.stream.Stream` object which
+            will then be written to the new file or a tuple of such a
+            stream and an arbitrary, small and picklable result object
+            (e.g. a misfit or the number of picked windows). The result
+            objects are gathered and returned. When running with MPI, the
+            input stream, possibly modified in place, is written if the
+            function returns ``None``.
+        :type process_function: function
+        :param output_filename: The output filename. Must not yet exist
+            unless ``resume`` is ``True``.
+        :type output_filename: str
+        :param tag_map: A dictionary mapping the input tags to output tags.
+        :type tag_map: dict
+        :param resume: Resume an interrupted run. Every finished
+            ``(station_name, tag)`` job is recorded in the output file right
+            after its data has been written. If ``True`` and the output
+            file exists, it will be reopened, any partially written output
+            of unfinished jobs will be removed, and only the remaining jobs
+            are processed.
+        :type resume: bool
+        :param executor: How to run the jobs. Either one of ``"serial"``,
+            ``"thread"``, ``"process"``, and ``"mpi"`` or an instance of one
+            of the executors in :mod:`pyasdf.executors`, e.g. to limit the
+            number of workers. Defaults to ``"mpi"`` when running with MPI
+            and ``"process"`` otherwise. All executors share the same job
+            list, order, result gathering, and output writing. The thread
+            and process pools are the ones of :mod:`concurrent.futures` with
+            Python >= 3.7 and of :mod:`multiprocessing` otherwise. Only the
+            MPI executor can be used with MPI and it writes the output with
+            collective parallel I/O. Its communicator must contain the same
+            processes the file has been opened with.
+        :type executor: str or :class:`~pyasdf.executors.Executor`
+        :return: A dictionary mapping ``(station_name, tag)`` tuples to the
+            result objects returned by the processing function. Only
+            returned on the master rank if run with MPI, all other ranks
+            return ``None``. Jobs skipped when resuming have no results.
 
-    def process(self, process_function, output_filename, tag_map):
-        if os.path.exists(output_filename):
+        .. rubric:: Example
+
+        >>> def process_function(st, inv):
+        ...     st.detrend("linear")
+        ...     return st, len(st)
+        >>> results = ds.process(process_function, "output.h5",
+        ...                      tag_map={"raw_recording": "processed"})
+        >>> results[("AE.113A", "raw_recording")]
+        3
+        """
+        if os.path.exists(output_filename) and not resume:
             msg = "Output file '%s' already exists." % output_filename
             raise ValueError(msg)
 
+        executor = self._get_executor(executor)
+
         stations = self.get_station_list()
 
         # Get all possible station and waveform tag combinations and let
@@ -1062,25 +3037,53 @@ class ASDFDataSet(object):
         if not station_tags:
             raise ValueError("No data matching the tag map found.")
 
+        # Dispatch the largest jobs first. Otherwise a single large job
+        # handed out last keeps one worker busy while all others idle.
+        job_sizes = {_i: self._get_waveform_data_size(*_i)
+                     for _i in station_tags}
+        station_tags.sort(key=lambda x: (-job_sizes[x], x))
+
         # Copy the station and event data only on the master process.
         if not self.mpi or (self.mpi and self.mpi.rank == 0):
             # Deactivate MPI even if active to not run into any barriers.
             output_data_set = ASDFDataSet(output_filename, mpi=False)
             for station_name, station_group in self._waveform_group.items():
-                for tag, data in station_group.items():
-                    if tag != "StationXML":
-                        continue
-                    if station_name not in output_data_set._waveform_group:
-                        group = output_data_set._waveform_group.create_group(
-                            station_name)
-                    else:
-                        group = output_data_set[station_name]
-                    station_group.copy(source=data, dest=group,
-                                       name="StationXML")
+                if "StationXML" not in station_group:
+                    continue
+                if station_name not in output_data_set._waveform_group:
+                    group = output_data_set._waveform_group.create_group(
+                        station_name)
+                else:
+                    group = output_data_set._waveform_group[station_name]
+                # Might already be there when resuming.
+                if "StationXML" in group:
+                    continue
+                station_group.copy(source=station_group["StationXML"],
+                                   dest=group, name="StationXML")
 
             # Copy the events.
-            if self.events:
+            if self.events and not output_data_set.events:
                 output_data_set.events = self.events
+
+            # Maintain an index of the waveforms if the input has one.
+            if "WaveformIndex" in self.__file and \
+                    "WaveformIndex" not in output_data_set.__file:
+                output_data_set.build_waveform_index()
+
+            # Remove whatever unfinished jobs of an interrupted run might
+            # have written. Several jobs might write to the same output tag
+            # so only the waveforms recorded for the exact jobs are removed.
+            if resume:
+                completed_jobs = output_data_set._get_completed_jobs()
+                job_outputs = output_data_set._get_job_outputs()
+                completed_outputs = set()
+                for job in completed_jobs:
+                    completed_outputs.update(job_outputs.get(job, []))
+                output_data_set._delete_waveforms(sorted(set(
+                    name for job, names in job_outputs.items()
+                    if job not in completed_jobs for name in names
+                    if name not in completed_outputs and
+                    name in output_data_set._waveform_group)))
             del output_data_set
 
         if self.mpi:
@@ -1088,377 +3091,342 @@ class ASDFDataSet(object):
 
         output_data_set = ASDFDataSet(output_filename)
 
-        # Check for MPI, if yes, dispatch to MPI worker, if not dispatch to
-        # the multiprocessing handler.
+        if resume:
+            completed_jobs = output_data_set._get_completed_jobs()
+            station_tags = [_i for _i in station_tags
+                            if _i not in completed_jobs]
+            if not station_tags:
+                print("All jobs have already been processed.")
+                del output_data_set
+                if self.mpi and self.mpi.rank != 0:
+                    return None
+                return {}
+
+        # MPI requires collective metadata operations, all other executors
+        # write from a single process.
         if self.mpi:
-            self._dispatch_processing_mpi(process_function, output_data_set,
-                                          station_tags, tag_map)
+            return self._dispatch_processing_mpi(
+                executor, process_function, output_data_set, station_tags,
+                tag_map)
         else:
-            self._dispatch_processing_multiprocessing(
-                process_function, output_data_set, station_tags, tag_map)
-
-    def _dispatch_processing_mpi(self, process_function, output_data_set,
-                                 station_tags, tag_map):
-        # Make sure all processes enter here.
-        self.mpi.comm.barrier()
+            # Reuse the sizes of the planning to size the shared memory.
+            return self._dispatch_processing_executor(
+                executor, process_function, output_data_set, station_tags,
+                tag_map,
+                largest_job=max(job_sizes[_i] for _i in station_tags))
+
+    def _dispatch_processing_mpi(self, executor, process_function,
+                                 output_data_set, station_tags, tag_map):
+        # Jobs whose data is being written during the current flush. They
+        # are recorded as completed once it is certain that all of their
+        # data made it to the file.
+        self.__unrecorded_jobs = []
 
         if self.mpi.rank == 0:
-            self._dispatch_processing_mpi_master_node(process_function,
-                                                      output_data_set,
-                                                      station_tags, tag_map)
-        else:
-            self._dispatch_processing_mpi_worker_node(process_function,
-                                                      output_data_set, tag_map)
+            print("Launching processing using %s." % executor)
 
-    def _dispatch_processing_mpi_master_node(self, process_function,
-                                             output_dataset, station_tags,
-                                             tag_map):
+        # The workers use the already open input file. As always with MPI,
+        # functions modifying the stream in place do not have to return it.
+        try:
+            outputs = executor.map_unordered(
+                _run_processing_job, station_tags,
+                initializer=_init_processing_worker,
+                initargs=(self.filename, process_function, None, self, True),
+                flush=functools.partial(self._flush_processing_output,
+                                        output_data_set, tag_map),
+                get_size=lambda x: sum(tr.data.nbytes for tr in x[1] or []))
+            results = {station_tag: result for station_tag, _, result, error
+                       in outputs if error is None}
+        finally:
+            _processing_worker.__dict__.clear()
+
+        # Collectively record the jobs of the final flush.
+        self._record_written_jobs(output_data_set)
+        if self.mpi.rank != 0:
+            return None
+        return results
+
+    def _record_written_jobs(self, output_dataset):
         """
-        The master node. It distributes the jobs and takes care that
-        metadata modifying actions are collective.
+        Flush the output file and record all jobs written during the last
+        flush as completed. Must be called collectively.
         """
-        from mpi4py import MPI
-
-        worker_nodes = range(1, self.mpi.comm.size)
-        workers_requesting_write = []
+        output_dataset._flush()
+        output_dataset._add_completed_jobs(self.__unrecorded_jobs)
+        self.__unrecorded_jobs = []
 
-        jobs = JobQueueHelper(jobs=station_tags,
-                              worker_names=worker_nodes)
+    def _flush_processing_output(self, output_dataset, tag_map, outputs):
+        """
+        Collectively write the output of the processing jobs each rank
+        finished since the last flush. All metadata changing operations
+        must be collective, the data is then written independently.
 
-        __last_print = time.time()
+        Returns the outputs without the streams.
 
-        print("Launching processing using MPI on %i processors." %
-              self.mpi.comm.size)
+        :param output_dataset: The output data set.
+        :param tag_map: A dictionary mapping the input tags to output tags.
+        :param outputs: A ``(station_tag, stream, result, error)`` tuple
+            per job.
+        """
+        infos = []
+        for station_tag, stream, _, _ in outputs:
+            for trace in stream or []:
+                info = output_dataset._add_trace_get_collective_information(
+                    trace, tag_map[station_tag[1]])
+                if info is not None:
+                    infos.append((station_tag, info, trace))
 
-        # Reactive event loop.
-        while not jobs.all_done:
-            time.sleep(0.01)
+        # Failed jobs must not be recorded as completed.
+        sendobj = ([_i[0] for _i in outputs if _i[3] is None],
+                   [_i[:2] for _i in infos])
+        data = self.mpi.comm.allgather(sendobj=sendobj)
 
-            # Informative output.
-            if time.time() - __last_print > 2.0:
-                print(jobs)
-                __last_print = time.time()
+        # All data of the previous flush has been written by now.
+        self._record_written_jobs(output_dataset)
+        self.__unrecorded_jobs = list(itertools.chain.from_iterable(
+            _i[0] for _i in data))
+
+        collective_infos = list(itertools.chain.from_iterable(
+            _i[1] for _i in data))
+        output_dataset._add_job_outputs([
+            (station_tag, info["data_name"])
+            for station_tag, info in collective_infos])
+        for _, info in collective_infos:
+            output_dataset._add_trace_write_collective_information(info)
+        for _, info, trace in infos:
+            output_dataset._add_trace_write_independent_information(
+                info, trace)
 
-            if (len(workers_requesting_write) >= 0.5 * self.mpi.comm.size) or \
-                    (len(workers_requesting_write) and
-                     jobs.all_poison_pills_received):
-                if self.debug:
-                    print("MASTER: initializing metadata synchronization.")
+        return [(station_tag, None, result, error)
+                for station_tag, _, result, error in outputs]
 
-                # Send force write msgs to all workers and block until all
-                # have been sent. Don't use blocking send cause then one
-                # will have to wait each time anew and not just once for each.
-                # The message will ready each worker for a collective
-                # operation once its current operation is ready.
-                requests = [self._send_mpi(None, rank, "MASTER_FORCES_WRITE",
-                                           blocking=False)
-                            for rank in worker_nodes]
-                self.mpi.MPI.Request.waitall(requests)
+    def _apply_processing_function(self, process_function, station_tag,
+                                   in_place=False):
+        """
+        Apply a processing function to the data of a single job.
 
-                self._sync_metadata(output_dataset, tag_map=tag_map)
+        Returns a tuple of the output stream, the result object, and an
+        error message which is ``None`` if everything went fine.
 
-                # Reset workers requesting a write.
-                workers_requesting_write[:] = []
-                if self.debug:
-                    print("MASTER: done with metadata synchronization.")
+        :param process_function: The processing function.
+        :param station_tag: The ``(station_name, tag)`` job.
+        :param in_place: If True and the processing function returns no
+            stream, the input stream, possibly modified in place, is the
+            output.
+        :type in_place: bool
+        """
+        try:
+            stream, inv = self.get_data_for_tag(*station_tag)
+            output_stream, result = split_processing_output(
+                process_function(stream, inv))
+        except Exception as e:
+            print("Error during processing function. Will be "
+                  "skipped: %s" % str(e))
+            return None, None, str(e)
+        if output_stream is None and in_place:
+            output_stream = stream
+        return output_stream, result, None
+
+    def _write_processing_output(self, outputs, tag_map, memory_pool=None):
+        """
+        Write the output of processing jobs to this data set, record the
+        jobs as completed, and gather their results.
+
+        :param outputs: Iterable yielding a ``(station_tag, stream, result,
+            error)`` tuple per job.
+        :param tag_map: A dictionary mapping the input tags to output tags.
+        :param memory_pool: The shared memory pool the streams have been
+            packed with, if any.
+        """
+        results = {}
+        for station_tag, packed_stream, result, error in outputs:
+            if error is not None:
                 continue
+            results[station_tag] = result
+            # Written straight from the shared memory.
+            if memory_pool is not None:
+                output_stream = memory_pool.unpack_stream(packed_stream)
+            else:
+                output_stream = packed_stream
+            if output_stream:
+                tag = tag_map[station_tag[1]]
+                # Persist which waveforms belong to the job before writing
+                # them.
+                self._add_job_outputs([
+                    (station_tag, self._get_waveform_name(tr, tag))
+                    for tr in output_stream])
+                self._flush()
+                self.add_waveforms(output_stream, tag=tag)
+            del output_stream
+            if memory_pool is not None:
+                memory_pool.release(packed_stream)
+            self._add_completed_jobs([station_tag])
+            # Persist the checkpoint.
+            self._flush()
+        return results
 
-            # Retrieve any possible message and "dispatch" appropriately.
-            status = MPI.Status()
-            msg = self.mpi.comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG,
-                                     status=status)
-            tag = MSG_TAGS[status.tag]
-            source = status.source
-
-            if self.debug:
-                pretty_receiver_log(source, self.mpi.rank, status.tag, msg)
-
-            if tag == "WORKER_REQUESTS_ITEM":
-                # Send poison pill if no more work is available. After
-                # that the worker should not request any more jobs.
-                if jobs.queue_empty:
-                    self._send_mpi(POISON_PILL, source, "MASTER_SENDS_ITEM")
-                else:
-                    # And send a new station tag to process it.
-                    station_tag = jobs.get_job_for_worker(source)
-                    self._send_mpi(station_tag, source, "MASTER_SENDS_ITEM")
+    def _dispatch_processing_executor(self, executor, process_function,
+                                      output_data_set, station_tags,
+                                      tag_map, largest_job):
+        input_filename = self.filename
+        output_filename = output_data_set.filename
 
-            elif tag == "WORKER_DONE_WITH_ITEM":
-                station_tag, result = msg
-                jobs.received_job_from_worker(station_tag, result, source)
+        # Make sure all HDF5 file handles are closed before fork() is called.
+        # Might become irrelevant if the HDF5 library sees some changes but
+        # right now it is necessary. The workers open the input file
+        # read-only.
+        self._flush()
+        self._close()
+        output_data_set._flush()
+        output_data_set._close()
+        del output_data_set
 
-            elif tag == "WORKER_REQUESTS_WRITE":
-                workers_requesting_write.append(source)
+        # The sample arrays are handed from worker processes to the writer
+        # via shared memory. Size the blocks so the largest job fits even if
+        # its dtype is upcast by the processing, but stay within the memory
+        # budget of each worker.
+        if executor.uses_processes:
+            memory_pool = SharedMemoryPool(
+                get_multiprocessing(), block_count=2 * executor.max_workers,
+                block_size=min(2 * largest_job,
+                               MAX_MEMORY_PER_WORKER_IN_MB * 1024 ** 2 // 2))
+        else:
+            memory_pool = None
 
-            elif tag == "POISON_PILL_RECEIVED":
-                jobs.poison_pill_received()
+        print("Launching processing using %s." % executor)
 
-            else:
-                raise NotImplementedError
+        outputs = None
+        try:
+            outputs = executor.map_unordered(
+                _run_processing_job, station_tags,
+                initializer=_init_processing_worker,
+                initargs=(input_filename, process_function, memory_pool))
+
+            # This process is the only one writing to the output file.
+            output_data_set = ASDFDataSet(output_filename)
+            results = output_data_set._write_processing_output(
+                outputs, tag_map, memory_pool=memory_pool)
+            del output_data_set
+        finally:
+            # If anything went wrong, skip the remaining jobs, make workers
+            # waiting for a free block raise, and wait for the workers to
+            # release the input file.
+            if hasattr(outputs, "close"):
+                outputs.close()
+            if memory_pool is not None:
+                memory_pool.close()
+            executor.join()
+            # Release the input file in case the workers ran in this thread.
+            _processing_worker.__dict__.clear()
+            self._reopen()
 
-        print("Master done, shutting down workers...")
-        # Shutdown workers.
-        for rank in worker_nodes:
-            self._send_mpi(None, rank, "ALL_DONE")
+        return results
 
-        self.mpi.comm.barrier()
-        print(jobs)
 
-    def _dispatch_processing_mpi_worker_node(self, process_function,
-                                             output_dataset, tag_map):
-        """
-        A worker node. It gets jobs, processes them and periodically waits
-        until a collective metadata update operation has happened.
-        """
-        self.stream_buffer = StreamBuffer()
+# State of the workers of the non-MPI executors running the processing jobs.
+# Thread local so the same functions work for threads and processes.
+_processing_worker = threading.local()
 
-        worker_state = {
-            "poison_pill_received": False,
-            "waiting_for_write": False,
-            "waiting_for_item": False
-        }
+# State of the workers reading a file, e.g. to verify it.
+_reading_worker = threading.local()
 
-        # Loop until the 'ALL_DONE' message has been sent.
-        while not self._get_msg(0, "ALL_DONE"):
-            time.sleep(0.01)
-
-            # Check if master requested a write.
-            if self._get_msg(0, "MASTER_FORCES_WRITE"):
-                self._sync_metadata(output_dataset, tag_map=tag_map)
-                for key, value in self.stream_buffer.items():
-                    for trace in value:
-                        output_dataset.\
-                            _add_trace_write_independent_information(
-                                trace.stats.__info, trace)
-                    self._send_mpi((key, str(value)), 0,
-                                   "WORKER_DONE_WITH_ITEM",
-                                   blocking=False)
-                self.stream_buffer.clear()
-                worker_state["waiting_for_write"] = False
-
-            if worker_state["waiting_for_write"]:
-                continue
 
-            if worker_state["poison_pill_received"]:
-                continue
+class _WorkerState(object):
+    """
+    State of the workers shared by all threads of a process. Needed if
+    workers read the data of the next job in a background thread.
+    """
+    pass
 
-            if not worker_state["waiting_for_item"]:
-                # Send message that the worker requires work.
-                self._send_mpi(None, 0, "WORKER_REQUESTS_ITEM", blocking=False)
-                worker_state["waiting_for_item"] = True
-                continue
 
-            msg = self._get_msg(0, "MASTER_SENDS_ITEM")
-            if msg:
-                station_tag = msg.data
-                worker_state["waiting_for_item"] = False
-
-                # If no more work to be done, store state and keep looping as
-                # stuff still might require to be written.
-                if station_tag == POISON_PILL:
-                    if self.stream_buffer:
-                        self._send_mpi(None, 0, "WORKER_REQUESTS_WRITE",
-                                       blocking=False)
-                        worker_state["waiting_for_write"] = True
-                    worker_state["poison_pill_received"] = True
-                    self._send_mpi(None, 0, "POISON_PILL_RECEIVED",
-                                   blocking=False)
-                    continue
+# State of the workers processing the stations of two files. Thread pools
+# share the already open data sets.
+_station_pair_worker = _WorkerState()
 
-                # Otherwise process the data.
-                stream, inv = self.get_data_for_tag(*station_tag)
-                try:
-                    process_function(stream, inv)
-                except Exception as e:
-                    print("Error during processing function. Will be "
-                          "skipped: %s" % str(e))
-
-                # Add stream to buffer.
-                self.stream_buffer[station_tag] = stream
-
-                # If the buffer is too large, request from the master to stop
-                # the current execution.
-                if self.stream_buffer.get_size() >= \
-                        MAX_MEMORY_PER_WORKER_IN_MB * 1024 ** 2:
-                    self._send_mpi(None, 0, "WORKER_REQUESTS_WRITE",
-                                   blocking=False)
-                    worker_state["waiting_for_write"] = True
-
-        print("Worker %i shutting down..." % self.mpi.rank)
-        self.mpi.comm.barrier()
-
-    def _sync_metadata(self, output_dataset, tag_map):
-        """
-        Method responsible for synchronizing metadata across all processes
-        in the HDF5 file. All metadata changing operations must be collective.
-        """
-        if hasattr(self, "stream_buffer"):
-            sendobj = []
-            for key, stream in self.stream_buffer.items():
-                for trace in stream:
-                    info = \
-                        output_dataset._add_trace_get_collective_information(
-                            trace, tag_map[key[1]])
-                    trace.stats.__info = info
-                    sendobj.append(info)
-        else:
-            sendobj = [None]
 
-        data = self.mpi.comm.allgather(sendobj=sendobj)
-        # Chain and remove None.
-        trace_info = filter(lambda x: x is not None,
-                            itertools.chain.from_iterable(data))
-        # Write collective part.
-        for info in trace_info:
-            output_dataset._add_trace_write_collective_information(info)
+def _init_reading_worker(filename, data_set=None):
+    """
+    Called once in every worker. Opens the file read-only unless an already
+    open data set is passed.
+    """
+    if data_set is None:
+        data_set = ASDFDataSet(filename, mode="r", mpi=False)
+    _reading_worker.data_set = data_set
 
-        # Make sure all remaining write requests are processed before
-        # proceeding.
-        if self.mpi.rank == 0:
-            for rank in range(1, self.mpi.size):
-                msg = self._get_msg(rank, "WORKER_REQUESTS_WRITE")
-                if self.debug and msg:
-                    print("MASTER: Ignoring write request by worker %i" %
-                          rank)
 
-        self.mpi.comm.barrier()
+def _verify_dataset(name):
+    """
+    Verify a single dataset in a worker.
+    """
+    return _reading_worker.data_set._verify_dataset(name)
 
-    def _dispatch_processing_multiprocessing(
-            self, process_function, output_data_set, station_tags, tag_map):
-        multiprocessing = get_multiprocessing()
 
-        input_filename = self.filename
-        output_filename = output_data_set.filename
+def _init_station_pair_worker(this_filename, other_filename,
+                              process_function, this_ds=None, other_ds=None):
+    """
+    Called once in every worker processing stations of two files. Unless
+    already open data sets are passed, both files are opened read-only and
+    stay open for the whole lifetime of the worker.
+    """
+    if this_ds is None:
+        this_ds = ASDFDataSet(this_filename, mode="r")
+        other_ds = ASDFDataSet(other_filename, mode="r")
+    _station_pair_worker.this_ds = this_ds
+    _station_pair_worker.other_ds = other_ds
+    _station_pair_worker.process_function = process_function
 
-        # Make sure all HDF5 file handles are closed before fork() is called.
-        # Might become irrelevant if the HDF5 library sees some changes but
-        # right now it is necessary.
-        self._flush()
-        self._close()
-        output_data_set._flush()
-        output_data_set._close()
-        del output_data_set
 
-        # Lock for input and output files. Probably not needed for the input
-        # files but better be safe.
-        input_file_lock = multiprocessing.Lock()
-        output_file_lock = multiprocessing.Lock()
-
-        cpu_count = min(multiprocessing.cpu_count(), len(station_tags))
-
-        # Create the input queue containing the jobs.
-        input_queue = multiprocessing.JoinableQueue(
-            maxsize=int(math.ceil(1.1 * (len(station_tags) + cpu_count))))
-
-        for _i in station_tags:
-            input_queue.put(_i)
-
-        # Put some poison pills.
-        for _ in range(cpu_count):
-            input_queue.put(POISON_PILL)
-
-        # Give a short time for the queues to play catch-up.
-        time.sleep(0.1)
-
-        # The output queue will collect the reports from the jobs.
-        output_queue = multiprocessing.Queue()
-
-        class Process(multiprocessing.Process):
-            def __init__(self, in_queue, out_queue, in_filename,
-                         out_filename, in_lock, out_lock,
-                         processing_function):
-                super(Process, self).__init__()
-                self.input_queue = in_queue
-                self.output_queue = out_queue
-                self.input_filename = in_filename
-                self.output_filename = out_filename
-                self.input_file_lock = in_lock
-                self.output_file_lock = out_lock
-                self.processing_function = processing_function
-
-            def run(self):
-                while True:
-                    stationtag = self.input_queue.get(timeout=1)
-                    if stationtag == POISON_PILL:
-                        self.input_queue.task_done()
-                        break
-                    import time
-                    print("Processing!!!", time.time())
-
-                    station, tag = stationtag
-
-                    with self.input_file_lock:
-                        input_data_set = ASDFDataSet(self.input_filename)
-                        stream, inv = \
-                            input_data_set.get_data_for_tag(station, tag)
-                        input_data_set._flush()
-                        del input_data_set
-
-                    output_stream = self.processing_function(stream, inv)
-
-                    if output_stream:
-                        with self.output_file_lock:
-                            output_data_set = ASDFDataSet(self.output_filename)
-                            output_data_set.add_waveforms(
-                                output_stream, tag=tag_map[tag])
-                            del output_data_set
-
-                    self.input_queue.task_done()
-
-        # Create n processes, with n being the number of available CPUs.
-        processes = []
-        for _ in range(cpu_count):
-            processes.append(Process(input_queue, output_queue,
-                                     input_filename, output_filename,
-                                     input_file_lock, output_file_lock,
-                                     process_function))
-
-        print("Launching processing using multiprocessing on %i cores." %
-              cpu_count)
-
-        for process in processes:
-            process.start()
-
-        for process in processes:
-            process.join()
-
-        ASDFDataSet.__init__(self, self.__original_filename)
-
-        return
-
-    def _get_msg(self, source, tag):
-        """
-        Helper method to get a message if available, returns a
-        ReceivedMessage instance in case a message is available, None
-        otherwise.
-        """
-        tag = MSG_TAGS[tag]
-        if not self.mpi.comm.Iprobe(source=source, tag=tag):
-            return
-        msg = ReceivedMessage(self.mpi.comm.recv(source=source, tag=tag))
-        if self.debug:
-            pretty_receiver_log(source, self.mpi.rank, tag, msg.data)
-        return msg
+def _read_station_pair(station):
+    """
+    Read a station from both files in a worker. Returns the data and
+    ``None`` or ``None`` and the formatted traceback.
+    """
+    try:
+        return (_station_pair_worker.this_ds._read_station(station),
+                _station_pair_worker.other_ds._read_station(station)), None
+    except Exception:
+        return None, traceback.format_exc()
 
-    def _send_mpi(self, obj, dest, tag, blocking=True):
-        """
-        Helper method to send a message via MPI.
-        """
-        tag = MSG_TAGS[tag]
-        if blocking:
-            value = self.mpi.comm.send(obj=obj, dest=dest, tag=tag)
-        else:
-            value = self.mpi.comm.isend(obj=obj, dest=dest, tag=tag)
-        if self.debug:
-            pretty_sender_log(dest, self.mpi.rank, tag, obj)
-        return value
 
-    def _recv_mpi(self, source, tag):
-        """
-        Helper method to receive a message via MPI.
-        """
-        tag = MSG_TAGS[tag]
-        msg = self.mpi.comm.recv(source=source, tag=tag)
-        if self.debug:
-            pretty_receiver_log(source, self.mpi.rank, tag, msg)
-        return msg
+def _run_station_pair_job(station, data):
+    """
+    Process a single station of two files in a worker. Returns the station,
+    the result, and the formatted traceback if anything went wrong.
+    """
+    data, error = data
+    result = None
+    if error is None:
+        try:
+            result = _station_pair_worker.process_function(*data)
+        except Exception:
+            error = traceback.format_exc()
+    return station, result, error
+
+
+def _init_processing_worker(input_filename, process_function, memory_pool,
+                            data_set=None, in_place=False):
+    """
+    Called once in every worker. Unless an already open data set is passed,
+    the input file is opened read-only and stays open for the whole
+    lifetime of the worker.
+    """
+    if data_set is None:
+        data_set = ASDFDataSet(input_filename, mode="r")
+    _processing_worker.data_set = data_set
+    _processing_worker.process_function = process_function
+    _processing_worker.memory_pool = memory_pool
+    _processing_worker.in_place = in_place
+
+
+def _run_processing_job(station_tag):
+    """
+    Run a single processing job in a worker.
+    """
+    output_stream, result, error = \
+        _processing_worker.data_set._apply_processing_function(
+            _processing_worker.process_function, station_tag,
+            in_place=_processing_worker.in_place)
+    if _processing_worker.memory_pool is not None:
+        output_stream = _processing_worker.memory_pool.pack_stream(
+            output_stream)
+    return station_tag, output_stream, result, error
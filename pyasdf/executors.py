@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Executors running independent jobs either serially, with a pool of threads,
+a pool of processes, or distributed with MPI.
+
+All executors offer the same interface so the code scheduling the jobs,
+gathering the results, and writing the output is the same for all of them.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2015
+:license:
+    BSD 3-Clause ("BSD New" or "BSD Simplified")
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import functools
+import multiprocessing
+import multiprocessing.pool
+import sys
+import time
+import warnings
+
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None
+
+from .header import ASDFException, ASDFWarning, MSG_TAGS, POISON_PILL, \
+    MAX_MEMORY_PER_WORKER_IN_MB
+from .utils import is_multiprocessing_problematic, prefetch_items, \
+    JobQueueHelper, ReceivedMessage, pretty_receiver_log, pretty_sender_log
+
+
+# The pools of concurrent.futures only accept an initializer starting with
+# Python 3.7. The pools of the multiprocessing module are used otherwise.
+HAS_FUTURES_INITIALIZER = concurrent is not None and \
+    sys.version_info >= (3, 7)
+
+
+class Executor(object):
+    """
+    Base class of all executors.
+    """
+    #: True if the jobs run in separate processes. Open HDF5 files have to be
+    #: closed before starting them and data should be passed via shared
+    #: memory.
+    uses_processes = False
+
+    def __init__(self, max_workers=None):
+        """
+        :param max_workers: The maximum number of workers. Defaults to the
+            number of available cores.
+        :type max_workers: int
+        """
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+
+    def __str__(self):
+        return "%s with %i worker(s)" % (self.__class__.__name__,
+                                         self.max_workers)
+
+    def map_unordered(self, function, jobs, initializer=None, initargs=(),
+                      read=None):
+        """
+        Run a function for every job and return an iterator over the
+        return values in the order in which the jobs complete.
+
+        Jobs are started in the given order. If the consumer of the
+        iterator stops early, e.g. due to an exception, the iterator has to
+        be closed to not wait for the remaining jobs. Use :meth:`join` to
+        wait until the workers exited in that case.
+
+        :param function: The function called with each job as its single
+            argument. Must be a module level function for process based
+            executors.
+        :param jobs: The arguments to the function.
+        :type jobs: list
+        :param initializer: If given, called once in each worker before it
+            runs any job. Useful to open files only once per worker.
+        :param initargs: The arguments passed to the initializer.
+        :type initargs: tuple
+        :param read: If given, called with each job in the worker before
+            the function, which is then called with the job and whatever
+            this returned. Executors running the jobs of a worker in a loop
+            read the data of the next job while the current one is being
+            processed.
+        """
+        raise NotImplementedError
+
+    def join(self):
+        """
+        Wait until all workers of iterators that have not been exhausted
+        exited. Jobs that are already running are finished first.
+        """
+        pass
+
+
+class SerialExecutor(Executor):
+    """
+    Runs all jobs one after the other in the current process.
+    """
+    def __init__(self):
+        super(SerialExecutor, self).__init__(max_workers=1)
+
+    def map_unordered(self, function, jobs, initializer=None, initargs=(),
+                      read=None):
+        if initializer is not None:
+            initializer(*initargs)
+        if read is None:
+            return (function(job) for job in jobs)
+        jobs = iter(jobs)
+        return (function(job, data) for job, data in
+                prefetch_items(lambda: next(jobs, None), read))
+
+
+def _read_and_run(function, read, job):
+    """
+    Run a job whose data has to be read first in a worker of a pool.
+    """
+    return function(job, read(job))
+
+
+class _PoolExecutor(Executor):
+    """
+    Base class for the executors based on the pools of
+    :mod:`concurrent.futures` or, with Python < 3.7, of
+    :mod:`multiprocessing`.
+    """
+    def __init__(self, max_workers=None):
+        super(_PoolExecutor, self).__init__(max_workers=max_workers)
+        # Pools of failed or closed iterators whose workers might still run.
+        self._abandoned_pools = []
+
+    def _get_pool(self, initializer, initargs):
+        """
+        Returns an executor of :mod:`concurrent.futures`.
+        """
+        raise NotImplementedError
+
+    def _get_fallback_pool(self, initializer, initargs):
+        """
+        Returns a pool of :mod:`multiprocessing`.
+        """
+        raise NotImplementedError
+
+    def map_unordered(self, function, jobs, initializer=None, initargs=(),
+                      read=None):
+        if read is not None:
+            function = functools.partial(_read_and_run, function, read)
+        if not HAS_FUTURES_INITIALIZER:
+            pool = self._get_fallback_pool(initializer, initargs)
+            return self._iter_fallback_results(
+                pool, pool.imap_unordered(function, jobs))
+        # Submit all jobs right away so the workers are started before the
+        # iterator is first consumed.
+        pool = self._get_pool(initializer, initargs)
+        futures = [pool.submit(function, job) for job in jobs]
+        return self._iter_results(pool, futures)
+
+    def join(self):
+        while self._abandoned_pools:
+            pool = self._abandoned_pools.pop()
+            if HAS_FUTURES_INITIALIZER:
+                pool.shutdown(wait=True)
+            else:
+                pool.join()
+
+    def _iter_results(self, pool, futures):
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        except BaseException:
+            # Do not wait for the running jobs here. They might never
+            # finish, e.g. if they wait for the failed consumer. The pool
+            # is shut down by join().
+            for future in futures:
+                future.cancel()
+            self._abandoned_pools.append(pool)
+            raise
+        pool.shutdown(wait=True)
+
+    def _iter_fallback_results(self, pool, results):
+        try:
+            for result in results:
+                yield result
+        except BaseException:
+            pool.terminate()
+            self._abandoned_pools.append(pool)
+            raise
+        pool.close()
+        pool.join()
+
+
+class ThreadPoolExecutor(_PoolExecutor):
+    """
+    Runs the jobs with a pool of threads. Mainly useful if the processing
+    releases the GIL or is dominated by I/O.
+    """
+    def _get_pool(self, initializer, initargs):
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers, initializer=initializer,
+            initargs=initargs)
+
+    def _get_fallback_pool(self, initializer, initargs):
+        return multiprocessing.pool.ThreadPool(
+            processes=self.max_workers, initializer=initializer,
+            initargs=initargs)
+
+
+class ProcessPoolExecutor(_PoolExecutor):
+    """
+    Runs the jobs with a pool of processes.
+    """
+    uses_processes = True
+
+    def _get_pool(self, initializer, initargs):
+        # Use fork() if available so the initialization arguments do not
+        # have to be picklable.
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = None
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=context,
+            initializer=initializer, initargs=initargs)
+
+    def _get_fallback_pool(self, initializer, initargs):
+        return multiprocessing.Pool(
+            processes=self.max_workers, initializer=initializer,
+            initargs=initargs)
+
+
+class MPIExecutor(Executor):
+    """
+    Distributes the jobs to all MPI ranks but the first one. The first rank
+    hands out one job at a time to whichever rank requests work and only
+    it will receive the results, the iterator on all other ranks is empty.
+
+    Must be entered collectively by all ranks and the returned iterators
+    have to be exhausted on all of them.
+    """
+    def __init__(self, comm=None, debug=False):
+        """
+        :param comm: The MPI communicator. Defaults to ``COMM_WORLD``.
+        :param debug: If True, print all messages. Potentially very verbose.
+        :type debug: bool
+        """
+        if comm is None:
+            from mpi4py import MPI
+            comm = MPI.COMM_WORLD
+        self.comm = comm
+        self.debug = debug
+        super(MPIExecutor, self).__init__()
+        self.max_workers = comm.size - 1
+
+    def map_unordered(self, function, jobs, initializer=None, initargs=(),
+                      read=None, flush=None, get_size=None):
+        """
+        Unlike the other executors, the workers can also keep the results
+        until all ranks collectively flush them, e.g. to write them with
+        parallel I/O.
+
+        :param flush: If given, called collectively on all ranks whenever
+            the first rank initiates it with the list of results kept on
+            each rank, an empty list on the first rank. Returns a list with
+            the values that are sent to the first rank instead of the
+            results. Workers request a flush once their results exceed
+            :data:`~pyasdf.header.MAX_MEMORY_PER_WORKER_IN_MB` and after
+            their last job. It happens once half of the ranks or all
+            workers still running jobs requested it.
+        :param get_size: Function returning the size of a result in bytes.
+            Required with ``flush``.
+        """
+        if self.comm.size < 2:
+            msg = "The MPI executor requires at least two ranks."
+            raise ASDFException(msg)
+        if self.comm.rank == 0:
+            return self._master(jobs, flush)
+        if flush is None:
+            return self._worker(function, initializer, initargs, read)
+        return self._flushing_worker(function, initializer, initargs, read,
+                                     flush, get_size)
+
+    def _master(self, jobs, flush):
+        """
+        The first rank hands out the jobs, initiates the flushes, and
+        collects the results.
+        """
+        from mpi4py import MPI
+
+        workers = range(1, self.comm.size)
+        jobs = JobQueueHelper(jobs=jobs, worker_names=workers)
+        # Workers waiting for a flush and those that will not request any
+        # further jobs.
+        requesting_flush = set()
+        finished_workers = set()
+        last_print = time.time()
+
+        while not jobs.all_done or not jobs.all_poison_pills_received:
+            # Informative output.
+            if time.time() - last_print > 2.0:
+                print(jobs)
+                last_print = time.time()
+
+            if requesting_flush and (
+                    len(requesting_flush) >= 0.5 * self.comm.size or
+                    len(requesting_flush | finished_workers) ==
+                    len(workers)):
+                # Ready all workers for the collective operation once their
+                # current job is done.
+                MPI.Request.waitall([
+                    self._send(None, rank, "MASTER_FORCES_WRITE",
+                               blocking=False) for rank in workers])
+                flush([])
+                # Requests sent in the meantime are served by this flush.
+                for rank in workers:
+                    self._get_msg(rank, "WORKER_REQUESTS_WRITE")
+                self.comm.barrier()
+                requesting_flush.clear()
+                continue
+
+            status = MPI.Status()
+            msg = self.comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG,
+                                 status=status)
+            tag = MSG_TAGS[status.tag]
+            source = status.source
+
+            if self.debug:
+                pretty_receiver_log(source, self.comm.rank, status.tag, msg)
+
+            if tag == "WORKER_REQUESTS_ITEM":
+                if jobs.queue_empty:
+                    self._send(POISON_PILL, source, "MASTER_SENDS_ITEM")
+                    finished_workers.add(source)
+                else:
+                    self._send(jobs.get_job_for_worker(source), source,
+                               "MASTER_SENDS_ITEM")
+
+            elif tag == "WORKER_DONE_WITH_ITEM":
+                # Workers report all results of a flush in a single message.
+                for job, result in msg:
+                    jobs.received_job_from_worker(job, result, source)
+                    yield result
+
+            elif tag == "WORKER_REQUESTS_WRITE":
+                requesting_flush.add(source)
+
+            elif tag == "POISON_PILL_RECEIVED":
+                jobs.poison_pill_received()
+
+            else:
+                raise NotImplementedError
+
+        for rank in workers:
+            self._send(None, rank, "ALL_DONE")
+        self.comm.barrier()
+        print(jobs)
+
+    def _worker(self, function, initializer, initargs, read):
+        """
+        Requests jobs until it receives the poison pill and sends each
+        result right away.
+        """
+        if initializer is not None:
+            initializer(*initargs)
+
+        def get_next_job():
+            self._send(None, 0, "WORKER_REQUESTS_ITEM")
+            job = self._recv(0, "MASTER_SENDS_ITEM")
+            if job == POISON_PILL:
+                self._send(None, 0, "POISON_PILL_RECEIVED")
+                return None
+            return job
+
+        if read is None:
+            results = ((job, function(job))
+                       for job in iter(get_next_job, None))
+        else:
+            results = ((job, function(job, data)) for job, data in
+                       prefetch_items(get_next_job, read))
+        for job, result in results:
+            self._send([(job, result)], 0, "WORKER_DONE_WITH_ITEM")
+
+        self._recv(0, "ALL_DONE")
+        self.comm.barrier()
+        # Nothing to yield on the workers.
+        return
+        yield
+
+    def _flushing_worker(self, function, initializer, initargs, read, flush,
+                         get_size):
+        """
+        Requests jobs and keeps the results until the first rank initiates
+        a flush. Polls for messages so it can always join the collective
+        flushes.
+        """
+        from mpi4py import MPI
+
+        if initializer is not None:
+            initializer(*initargs)
+
+        jobs = []
+        results = []
+        size = 0
+        # Outstanding non-blocking sends.
+        requests = []
+        poison_pill_received = False
+        waiting_for_flush = False
+        waiting_for_job = False
+
+        # Loop until the first rank is done.
+        while not self._get_msg(0, "ALL_DONE"):
+            time.sleep(0.01)
+
+            if self._get_msg(0, "MASTER_FORCES_WRITE"):
+                values = flush(results)
+                self.comm.barrier()
+                requests.append(self._send(
+                    list(zip(jobs, values)), 0, "WORKER_DONE_WITH_ITEM",
+                    blocking=False))
+                jobs, results, size = [], [], 0
+                waiting_for_flush = False
+
+            if waiting_for_flush or poison_pill_received:
+                continue
+
+            if not waiting_for_job:
+                requests.append(self._send(None, 0, "WORKER_REQUESTS_ITEM",
+                                           blocking=False))
+                waiting_for_job = True
+                continue
+
+            msg = self._get_msg(0, "MASTER_SENDS_ITEM")
+            if not msg:
+                continue
+            waiting_for_job = False
+
+            # Whatever is left still has to be flushed.
+            if msg.data == POISON_PILL:
+                poison_pill_received = True
+                if results:
+                    requests.append(self._send(
+                        None, 0, "WORKER_REQUESTS_WRITE", blocking=False))
+                    waiting_for_flush = True
+                requests.append(self._send(None, 0, "POISON_PILL_RECEIVED",
+                                           blocking=False))
+                continue
+
+            job = msg.data
+            if read is None:
+                result = function(job)
+            else:
+                result = function(job, read(job))
+            jobs.append(job)
+            results.append(result)
+            size += get_size(result)
+
+            if size >= MAX_MEMORY_PER_WORKER_IN_MB * 1024 ** 2:
+                requests.append(self._send(None, 0, "WORKER_REQUESTS_WRITE",
+                                           blocking=False))
+                waiting_for_flush = True
+
+        # The first rank only finishes once it received everything so this
+        # will not block.
+        MPI.Request.waitall(requests)
+        self.comm.barrier()
+        # Nothing to yield on the workers.
+        return
+        yield
+
+    def _get_msg(self, source, tag):
+        """
+        Returns a :class:`~pyasdf.utils.ReceivedMessage` if a message is
+        available and ``None`` otherwise.
+        """
+        tag = MSG_TAGS[tag]
+        if not self.comm.Iprobe(source=source, tag=tag):
+            return
+        msg = ReceivedMessage(self.comm.recv(source=source, tag=tag))
+        if self.debug:
+            pretty_receiver_log(source, self.comm.rank, tag, msg.data)
+        return msg
+
+    def _send(self, obj, dest, tag, blocking=True):
+        tag = MSG_TAGS[tag]
+        if blocking:
+            value = self.comm.send(obj, dest=dest, tag=tag)
+        else:
+            value = self.comm.isend(obj, dest=dest, tag=tag)
+        if self.debug:
+            pretty_sender_log(dest, self.comm.rank, tag, obj)
+        return value
+
+    def _recv(self, source, tag):
+        tag = MSG_TAGS[tag]
+        msg = self.comm.recv(source=source, tag=tag)
+        if self.debug:
+            pretty_receiver_log(source, self.comm.rank, tag, msg)
+        return msg
+
+
+EXECUTORS = {
+    "serial": SerialExecutor,
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor,
+    "mpi": MPIExecutor
+}
+
+
+def get_executor(executor=None, mpi=False, debug=False):
+    """
+    Get an executor instance.
+
+    :param executor: The name of an executor (``"serial"``, ``"thread"``,
+        ``"process"``, or ``"mpi"``), an executor instance, or ``None`` to
+        choose ``"mpi"`` if running with MPI and ``"process"`` otherwise.
+    :param mpi: Whether or not the current environment is an MPI
+        environment. The MPI executor has to be used if and only if it is.
+    :type mpi: bool
+    :param debug: Passed to the MPI executor if it is created here.
+    :type debug: bool
+    """
+    if executor is None:
+        executor = "mpi" if mpi else "process"
+    if not isinstance(executor, Executor) and executor not in EXECUTORS:
+        msg = "Unknown executor '%s'. Available executors: %s" % (
+            executor, ", ".join(sorted(EXECUTORS.keys())))
+        raise ValueError(msg)
+    if (executor == "mpi" or isinstance(executor, MPIExecutor)) != \
+            bool(mpi):
+        msg = "The MPI executor must be used if and only if running with " \
+              "MPI."
+        raise ASDFException(msg)
+    if isinstance(executor, Executor):
+        return executor
+    if executor == "process" and is_multiprocessing_problematic():
+        msg = ("Multiprocessing is problematic on this platform. Will use "
+               "threads instead.")
+        warnings.warn(msg, ASDFWarning)
+        executor = "thread"
+    if executor == "mpi":
+        return MPIExecutor(debug=debug)
+    return EXECUTORS[executor]()
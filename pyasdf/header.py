@@ -83,3 +83,15 @@ POISON_PILL = "POISON_PILL"
 
 
 MAX_MEMORY_PER_WORKER_IN_MB = 256
+
+# Name of the attribute storing the content hash of a dataset.
+CONTENT_HASH_ATTRIBUTE = "content_hash"
+
+# Number of threads the blocking reads of the asyncio API are offloaded to.
+# HDF5 serializes all access, more threads mainly add overhead.
+MAX_ASYNC_READ_THREADS = 2
+
+# Names of the datasets holding the data and the index of a packed
+# auxiliary data type.
+PACKED_DATA_NAME = "PackedData"
+PACKED_INDEX_NAME = "PackedIndex"
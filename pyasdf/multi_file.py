@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tools dealing with more than one ASDF file at a time.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2015
+:license:
+    BSD 3-Clause ("BSD New" or "BSD Simplified")
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import warnings
+
+import h5py
+import obspy
+
+from .asdf_data_set import ASDFDataSet
+from .header import ASDFWarning, PACKED_DATA_NAME, PACKED_INDEX_NAME
+from .inventory_utils import merge_inventories
+from .utils import copy_dataset, get_dataset_names, \
+    get_stored_content_hash
+
+
+def create_master_file(filenames, output_filename):
+    """
+    Creates a lightweight master file exposing the contents of many ASDF
+    files as a single data set.
+
+    The waveforms, station information, auxiliary data, and provenance
+    records of all files are not copied but stored as HDF5 external links
+    to the member files so the master file can be opened with
+    :class:`~pyasdf.asdf_data_set.ASDFDataSet` like any other file. The
+    links are relative to the directory of the master file. Only the events
+    of all files, which are stored as a single QuakeML document, and
+    StationXML files for stations with differing information in more than
+    one file are merged and written to the master file. Packed auxiliary
+    data is copied as well as the records of all files are stored in a
+    single dataset.
+
+    If the same waveform or auxiliary data is contained in more than one
+    file, the first one wins.
+
+    Open the master file with ``mode="r"`` unless the member files should
+    be modified through it.
+
+    :param filenames: The filenames of the member files.
+    :type filenames: list of str
+    :param output_filename: The filename of the master file. Must not yet
+        exist.
+    :type output_filename: str
+    """
+    directory = os.path.dirname(os.path.abspath(output_filename))
+
+    def link(member, source, target, name):
+        _link_dataset(target, name, os.path.relpath(
+            os.path.abspath(member.filename), directory),
+            "%s/%s" % (source.name, name))
+
+    _combine_files(filenames, output_filename, link)
+
+
+def merge(filenames, output_filename):
+    """
+    Merges many ASDF files into a single new one.
+
+    Unlike reading all data and writing it again, the waveforms, auxiliary
+    data, and provenance records are copied on the HDF5 level. Their
+    compressed data is thus copied as is without decompressing and
+    compressing it again, and data stored once with hard links in a file
+    is also stored once in the merged file. Events are merged by their
+    resource ids and differing StationXML files for the same station are
+    merged. The records of packed auxiliary data of all files are copied
+    to a single packed dataset per data type.
+
+    If the same waveform or auxiliary data is contained in more than one
+    file, the first one wins.
+
+    :param filenames: The filenames of the files to merge.
+    :type filenames: list of str
+    :param output_filename: The filename of the merged file. Must not yet
+        exist.
+    :type output_filename: str
+    """
+    # Maps hard linked datasets in the files to the names of their copies.
+    copies = {}
+
+    def copy(member, source, target, name):
+        _copy_dataset(source, target, name, member.filename, copies)
+
+    _combine_files(filenames, output_filename, copy)
+
+
+def _combine_files(filenames, output_filename, add_dataset):
+    """
+    Combines many ASDF files into a new one.
+
+    The events and differing station information of all files are merged,
+    everything else is handed to a function adding it to the new file.
+
+    :param add_dataset: Called with the data set of the file and the
+        source group, the target group, and the name of every dataset
+        relative to the group.
+    """
+    if os.path.exists(output_filename):
+        msg = "Output file '%s' already exists." % output_filename
+        raise ValueError(msg)
+
+    output = ASDFDataSet(output_filename, compression=None, mpi=False)
+    cat = obspy.core.event.Catalog()
+    resource_ids = set()
+    # The content hashes and files of all added StationXML files and the
+    # merged station information of stations that differ between files.
+    # Data already added is not read again as it might be a link to a file
+    # that is open read-only.
+    station_sources = {}
+    merged_inventories = {}
+    has_waveform_index = False
+
+    for filename in filenames:
+        member = ASDFDataSet(filename, mode="r", mpi=False)
+        has_waveform_index |= member._has_waveform_index()
+
+        for event in member.events:
+            if event.resource_id.id in resource_ids:
+                continue
+            resource_ids.add(event.resource_id.id)
+            cat.append(event)
+
+        for name in get_dataset_names(member._waveform_group):
+            station_name, data_name = name.split("/", 1)
+            if data_name != "StationXML":
+                add_dataset(member, member._waveform_group,
+                            output._waveform_group, name)
+                continue
+            content_hash = get_stored_content_hash(
+                member._waveform_group[name])
+            if station_name not in station_sources:
+                station_sources[station_name] = (content_hash, filename)
+                add_dataset(member, member._waveform_group,
+                            output._waveform_group, name)
+                continue
+            # Identical station information does not have to be merged.
+            if content_hash is not None and \
+                    content_hash == station_sources[station_name][0]:
+                continue
+            network_id, station_id = station_name.split(".")
+            if station_name not in merged_inventories:
+                first = ASDFDataSet(station_sources[station_name][1],
+                                    mode="r", mpi=False)
+                merged_inventories[station_name] = \
+                    first._get_station(station_name)
+                del first
+            merged_inventories[station_name] = merge_inventories(
+                inv_a=merged_inventories[station_name],
+                inv_b=member._get_station(station_name),
+                network_id=network_id, station_id=station_id)
+
+        packed_types = set()
+        for data_type in member._auxiliary_data_group.keys():
+            if member._get_packed_index(data_type) is not None:
+                packed_types.add(data_type)
+                _add_packed_records(member, output, data_type)
+        for name in get_dataset_names(member._auxiliary_data_group):
+            data_type = name.split("/")[0]
+            if data_type in packed_types:
+                continue
+            if output._get_packed_index(data_type) is not None:
+                _warn_skipped(output._auxiliary_data_group.name, name,
+                              filename, "is packed in the output file")
+                continue
+            add_dataset(member, member._auxiliary_data_group,
+                        output._auxiliary_data_group, name)
+        for name in get_dataset_names(member._provenance_group):
+            add_dataset(member, member._provenance_group,
+                        output._provenance_group, name)
+        del member
+
+    for station_name, inv in merged_inventories.items():
+        del output._waveform_group[station_name]["StationXML"]
+        network_id, station_id = station_name.split(".")
+        output._add_inventory_object(inv, network_id, station_id)
+
+    if len(cat):
+        output.events = cat
+    if has_waveform_index:
+        output.build_waveform_index()
+    del output
+
+
+def _add_packed_records(member, output, data_type):
+    """
+    Copies the records of a packed auxiliary data type to the output file.
+    Records already in the output file are not replaced.
+    """
+    source = member._auxiliary_data_group[data_type][PACKED_DATA_NAME]
+    group_name = output._auxiliary_data_group.name
+    if data_type not in output._auxiliary_data_group:
+        # Keep the storage settings, the records are compressed again.
+        group = output._auxiliary_data_group.create_group(data_type)
+        group.create_dataset(
+            PACKED_DATA_NAME, shape=(0,), dtype=source.dtype,
+            maxshape=(None,), chunks=source.chunks or True,
+            compression=source.compression,
+            compression_opts=source.compression_opts,
+            fletcher32=source.fletcher32)
+        output._append_lines("AuxiliaryData/%s/%s" % (
+            data_type, PACKED_INDEX_NAME), [])
+    index = output._get_packed_index(data_type)
+    if index is None:
+        _warn_skipped(group_name, data_type, member.filename,
+                      "is not packed in the output file")
+        return
+    if output._auxiliary_data_group[data_type][PACKED_DATA_NAME].dtype != \
+            source.dtype:
+        _warn_skipped(group_name, data_type, member.filename,
+                      "has a different data type in the output file")
+        return
+
+    records = []
+    for tag in member._get_packed_index(data_type):
+        if tag in index:
+            _warn_skipped(group_name, "%s/%s" % (data_type, tag),
+                          member.filename)
+            continue
+        aux_data = member._get_auxiliary_data(data_type, tag)
+        records.append((tag, aux_data.data, aux_data.parameters))
+        # Bounded memory.
+        if len(records) == 1000:
+            output._add_packed_records(data_type, records)
+            records = []
+    output._add_packed_records(data_type, records)
+
+
+def _link_dataset(group, name, filename, path):
+    """
+    Creates an external link to a dataset in another file, including all
+    intermediate groups. Existing data is not replaced.
+    """
+    if _exists(group, name, filename):
+        return
+    parent, _, data_name = name.rpartition("/")
+    if parent:
+        group = group.require_group(parent)
+    group[data_name] = h5py.ExternalLink(filename, path)
+
+
+def _copy_dataset(source, target, name, filename, copies):
+    """
+    Copies a dataset to another file, including all intermediate groups.
+    Existing data is not replaced.
+    """
+    if _exists(target, name, filename):
+        return
+    parent, _, data_name = name.rpartition("/")
+    if parent:
+        target = target.require_group(parent)
+    copy_dataset(source[name], target, data_name, copies)
+
+
+def _exists(group, name, filename):
+    """
+    Warns and returns True if the dataset already exists in the group.
+    """
+    # Only check for the link, the linked file might not be accessible.
+    if group.get(name, getlink=True) is None:
+        return False
+    _warn_skipped(group.name, name, filename)
+    return True
+
+
+def _warn_skipped(group_name, name, filename,
+                  reason="already exists in the output file"):
+    """
+    Warns that data of a file is not added to the output file.
+    """
+    msg = "'%s/%s' %s. The one in '%s' will be skipped." % (
+        group_name, name, reason, filename)
+    warnings.warn(msg, ASDFWarning)
@@ -9,19 +9,25 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import collections
 import glob
 import inspect
 import io
 import shutil
 import os
+import warnings
 
 import h5py
 import numpy as np
 import obspy
 import pytest
 
-from pyasdf import ASDFDataSet
+import pyasdf.asdf_data_set
+from pyasdf import ASDFDataSet, ASDFException
+from pyasdf import executors
 from pyasdf.header import FORMAT_VERSION, FORMAT_NAME
+from pyasdf.utils import get_content_hash, get_free_space_settings, \
+    get_stored_content_hash
 
 
 data_dir = os.path.join(os.path.dirname(os.path.abspath(
@@ -165,6 +171,47 @@ def test_equality_checks(example_data_set):
     assert data_set_1 != data_set_2
 
 
+def test_comparing_data_sets(example_data_set):
+    """
+    Tests the detailed comparison of two data sets.
+    """
+    filename_1 = example_data_set.filename
+    filename_2 = os.path.join(example_data_set.tmpdir, "new.h5")
+    shutil.copyfile(filename_1, filename_2)
+
+    data_set_1 = ASDFDataSet(filename_1)
+    data_set_2 = ASDFDataSet(filename_2)
+
+    assert data_set_1.compare(data_set_2) == {
+        "only_in_self": [], "only_in_other": [], "different": [],
+        "is_equal": True}
+
+    names = data_set_2.get_waveform_list()
+    data_set_2._waveform_group[names[0]][5] += 1.0
+    data_set_2._waveform_group[names[1]].attrs["sampling_rate"] = 1.0
+    del data_set_2._waveform_group[names[2]]
+    data_set_2.add_auxiliary_data(data=np.zeros(10), data_type="RandomArray",
+                                  tag="test", parameters={})
+    events = data_set_2.events
+    events[0].comments = []
+    events[0].resource_id = "smi:local/other"
+    data_set_2.events = events
+
+    report = data_set_1.compare(data_set_2)
+    assert not report["is_equal"]
+    assert report["only_in_self"] == ["Waveforms/" + names[2]]
+    assert report["only_in_other"] == ["AuxiliaryData/RandomArray/test"]
+    assert [_i[0] for _i in report["different"]] == [
+        "Waveforms/" + names[1], "QuakeML", "Waveforms/" + names[0]]
+    assert "sampling_rate" in report["different"][0][1]
+    assert "index 0" in report["different"][2][1]
+    assert data_set_1 != data_set_2
+
+    report = data_set_2.compare(data_set_1)
+    assert report["only_in_self"] == ["AuxiliaryData/RandomArray/test"]
+    assert report["only_in_other"] == ["Waveforms/" + names[2]]
+
+
 def test_adding_same_event_twice_raises(tmpdir):
     """
     Adding the same event twice raises.
@@ -437,6 +484,442 @@ def test_tag_iterator(example_data_set):
         count += 1
     assert count == 0
 
+    # Tags are matched exactly, even if they contain wildcards.
+    st = data_set.waveforms.AE_113A.raw_recording
+    data_set.add_waveforms(st, tag="synth_*")
+    data_set.add_waveforms(st, tag="synth_1")
+    data_set.add_waveforms(st.select(channel="BHZ"), tag="synth_[12]")
+    for tag, count in (("synth_*", 3), ("synth_1", 3), ("synth_[12]", 1),
+                       ("synth_?", 0)):
+        assert sum(len(_i[0]) for _i in data_set.itertag(tag)) == count
+
+
+def test_tag_iterator_with_prefetching(example_data_set):
+    """
+    Prefetching does not change what the tag iterator yields.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+
+    expected = list(data_set.itertag("raw_recording"))
+    assert len(expected) == 2
+
+    for prefetch in (1, 2, 10):
+        assert list(data_set.itertag(
+            "raw_recording", prefetch=prefetch)) == expected
+        assert list(data_set.itertag("random", prefetch=prefetch)) == []
+
+    # Breaking out of the loop early is fine.
+    for st, inv in data_set.itertag("raw_recording", prefetch=1):
+        break
+    assert (st, inv) == expected[0]
+
+
+def test_content_hashes_and_diff(example_data_set):
+    """
+    Tests the content hashes written with all data and the diff based on
+    them.
+    """
+    filename_1 = example_data_set.filename
+    filename_2 = os.path.join(example_data_set.tmpdir, "new.h5")
+    shutil.copyfile(filename_1, filename_2)
+
+    data_set_1 = ASDFDataSet(filename_1)
+    data_set_2 = ASDFDataSet(filename_2)
+
+    hashes = data_set_1._get_content_hashes()
+    assert len(hashes) == 8
+    assert all(hashes.values())
+    st = data_set_1.waveforms.AE_113A.raw_recording
+    names = data_set_1.get_waveform_list()
+    assert hashes["Waveforms/" + names[0]] == get_content_hash(st[0].data)
+    assert data_set_1.diff(data_set_2) == {
+        "added": [], "removed": [], "changed": [], "unknown": []}
+
+    # Hashes do not depend on the byte order.
+    assert get_content_hash(np.arange(10, dtype=">i4")) == \
+        get_content_hash(np.arange(10, dtype="<i4"))
+    assert get_content_hash(np.arange(10, dtype="i4")) != \
+        get_content_hash(np.arange(10, dtype="f4"))
+
+    # Change some data, add and remove some.
+    tr = st[0].copy()
+    del data_set_2._waveform_group[names[0]]
+    tr.data[0] += 1
+    data_set_2.add_waveforms(tr, tag="raw_recording")
+    del data_set_2._waveform_group[names[1]]
+    data_set_2.add_auxiliary_data(data=np.zeros(10), data_type="RandomArray",
+                                  tag="test", parameters={"a": 1})
+    data_set_2.add_stationxml(data_set_1.waveforms.TA_POKR.StationXML)
+    del data_set_2._waveform_group[names[2]].attrs["content_hash"]
+
+    assert data_set_1.diff(data_set_2) == {
+        "added": ["AuxiliaryData/RandomArray/test"],
+        "removed": ["Waveforms/" + names[1]],
+        "changed": ["Waveforms/" + names[0]],
+        "unknown": ["Waveforms/" + names[2]]}
+
+    # The hash is not part of the parameters of auxiliary data.
+    assert data_set_2.auxiliary_data.RandomArray.test.parameters == {"a": 1}
+
+
+def test_deduplication_with_hard_links(tmpdir):
+    """
+    Identical data is only stored once if deduplication is enabled.
+    """
+    filename = os.path.join(tmpdir.strpath, "test.h5")
+    data_path = os.path.join(data_dir, "small_sample_data_set")
+    data_set = ASDFDataSet(filename, deduplicate=True)
+    data_set.add_stationxml(os.path.join(data_path, "AE.113A..BH*.xml"))
+    st = obspy.read(os.path.join(data_path, "AE.113A*.mseed"))
+
+    def link_count(name):
+        return h5py.h5o.get_info(data_set._waveform_group[name].id).rc
+
+    data_set.add_waveforms(st, tag="raw_recording")
+    data_set.add_waveforms(st, tag="copy")
+    names = data_set.get_waveform_list()
+    assert len(names) == 6
+    assert all(link_count(_i) == 2 for _i in names)
+    assert data_set.waveforms.AE_113A.copy == \
+        data_set.waveforms.AE_113A.raw_recording
+
+    # Different attributes or data are not deduplicated.
+    data_set.add_waveforms(st, tag="with_event", event_id="smi:local/a")
+    st[0].data[0] += 1
+    data_set.add_waveforms(st, tag="changed")
+    names = data_set.get_waveform_list(tag="with_event") + \
+        data_set.get_waveform_list(tag="changed", channel="BHE")
+    assert all(link_count(_i) == 1 for _i in names)
+    assert link_count(data_set.get_waveform_list(
+        tag="changed", channel="BHN")[0]) == 3
+
+    # The same StationXML in another station group.
+    inv = data_set.waveforms.AE_113A.StationXML
+    data_set._add_inventory_object(inv, "XX", "A")
+    assert link_count("XX.A/StationXML") == 2
+    assert data_set.waveforms.XX_A.StationXML == inv
+
+    # Overwriting shared station information does not change the other
+    # station.
+    data_set.add_stationxml(os.path.join(data_path, "TA.POKR..BH*.xml"))
+    other_inv = data_set.waveforms.TA_POKR.StationXML
+    data_set._add_inventory_object(other_inv, "XX", "A")
+    assert data_set.waveforms.XX_A.StationXML == other_inv
+    assert data_set.waveforms.AE_113A.StationXML == inv
+
+    # Not enabled by default.
+    del data_set
+    data_set = ASDFDataSet(filename)
+    data_set.add_waveforms(st, tag="another_copy")
+    assert all(link_count(_i) == 1 for _i in
+               data_set.get_waveform_list(tag="another_copy"))
+
+
+def test_filtered_waveform_iteration(example_data_set):
+    """
+    Tests selecting waveforms with the index of the file.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+    event = data_set.events[0]
+
+    all_names = data_set.get_waveform_list()
+    assert len(all_names) == 6
+    assert all_names == sorted(all_names)
+    assert all_names[0].startswith("AE.113A/AE.113A..BHE__")
+
+    assert len(data_set.get_waveform_list(network="TA")) == 3
+    assert len(data_set.get_waveform_list(channel="BH[NZ]")) == 4
+    assert len(data_set.get_waveform_list(channel=["BHE", "BHN"],
+                                          station="POKR")) == 2
+    assert data_set.get_waveform_list(tag="random") == []
+    assert data_set.get_waveform_list(event_id=event) == all_names
+    assert data_set.get_waveform_list(
+        event_id=str(event.resource_id.id)) == all_names
+    assert data_set.get_waveform_list(event_id="smi:local/random") == []
+
+    traces = data_set.waveforms.AE_113A.raw_recording + \
+        data_set.waveforms.TA_POKR.raw_recording
+    last_end = max(_i.stats.endtime for _i in traces)
+    first_start = min(_i.stats.starttime for _i in traces)
+    assert data_set.get_waveform_list(starttime=last_end)
+    assert data_set.get_waveform_list(starttime=last_end + 0.001) == []
+    assert data_set.get_waveform_list(endtime=first_start)
+    assert data_set.get_waveform_list(endtime=first_start - 0.001) == []
+    assert data_set.get_waveform_list(
+        starttime=first_start, endtime=last_end) == all_names
+
+    items = list(data_set.iterwaveforms(network="AE", channel="BHZ"))
+    assert len(items) == 1
+    st, inv = items[0]
+    assert [_i.id for _i in st] == ["AE.113A..BHZ"]
+    assert inv == data_set.waveforms.AE_113A.StationXML
+
+    # The index is updated when adding new waveforms.
+    new_tr = data_set.waveforms.AE_113A.raw_recording[0]
+    new_tr.stats.network = "XX"
+    data_set.add_waveforms(new_tr, tag="synthetic")
+    assert len(data_set.get_waveform_list()) == 7
+    assert data_set.get_waveform_list(tag="synth*") == [
+        _i for _i in data_set.get_waveform_list() if _i.startswith("XX.")]
+    st, inv = list(data_set.iterwaveforms(tag="synthetic"))[0]
+    assert st[0].id == "XX.113A..BHE"
+    assert inv is None
+
+    # Adding auxiliary data leaves the index alone.
+    names = data_set.get_waveform_list()
+    data_set.add_auxiliary_data(data=np.zeros(10), data_type="RandomArray",
+                                tag="test", parameters={})
+    assert data_set.get_waveform_list() == names
+    assert data_set.get_waveform_list(tag="test") == []
+
+
+def test_waveform_table(example_data_set):
+    """
+    Tests the table of all waveforms and reading waveforms selected with it.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+    event = data_set.events[0]
+
+    table = data_set.waveform_table
+    assert len(table) == 6
+    assert list(table["name"]) == data_set.get_waveform_list()
+    assert list(table["network"]) == ["AE"] * 3 + ["TA"] * 3
+    assert set(table["tag"]) == set(["raw_recording"])
+    assert set(table["event_id"]) == set([str(event.resource_id.id)])
+    assert "size" not in table.dtype.names
+    sizes = data_set.get_waveform_storage_sizes(table)
+    assert len(sizes) == 6 and (sizes > 0).all()
+    assert list(data_set.get_waveform_storage_sizes(table["name"][:2])) == \
+        list(sizes[:2])
+
+    st = data_set.read_waveforms(table)
+    assert len(st) == 6
+    for row, tr in zip(table, st):
+        assert tr.id == "%s.%s.%s.%s" % (row["network"], row["station"],
+                                         row["location"], row["channel"])
+        assert row["starttime"] == int(round(
+            tr.stats.starttime.timestamp * 1.0E9))
+        assert abs(row["endtime"] / 1.0E9 - tr.stats.endtime.timestamp) < \
+            1E-6
+        assert row["npts"] == tr.stats.npts
+        assert row["sampling_rate"] == tr.stats.sampling_rate
+        assert np.dtype(row["dtype"]) == tr.data.dtype
+
+    mask = (table["station"] == "POKR") & (table["channel"] != "BHZ")
+    st = data_set.read_waveforms(table[mask])
+    assert [_i.id for _i in st] == ["TA.POKR..BHE", "TA.POKR..BHN"]
+    assert data_set.read_waveforms(data_set.get_waveform_list(
+        station="POKR", channel="BH[EN]")) == st
+
+    # Adding waveforms updates the table.
+    tr = st[0].copy()
+    tr.stats.network = "XX"
+    del tr.stats.asdf
+    data_set.add_waveforms(tr, tag="synthetic")
+    assert len(data_set.waveform_table) == 7
+    assert data_set.waveform_table["event_id"][-1] == ""
+
+    # Auxiliary data does not end up in there.
+    data_set.add_auxiliary_data(data=np.zeros(10), data_type="RandomArray",
+                                tag="test", parameters={})
+    assert len(data_set.waveform_table) == 7
+    assert len(data_set.get_waveform_list()) == 7
+
+
+def test_stored_waveform_index(example_data_set):
+    """
+    Tests the index of all waveforms stored in the file.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+    expected_names = data_set.get_waveform_list()
+    expected_table = data_set.waveform_table
+    data_set.build_waveform_index()
+    del data_set
+
+    data_set = ASDFDataSet(example_data_set.filename)
+    assert "WaveformIndex" in data_set._ASDFDataSet__file
+    assert data_set.get_waveform_list() == expected_names
+    np.testing.assert_array_equal(data_set.waveform_table, expected_table)
+    event = data_set.events[0]
+    assert data_set.get_waveform_list(event_id=event) == expected_names
+    traces = data_set.read_waveforms(expected_names)
+    assert data_set.get_waveform_list(
+        starttime=max(_i.stats.endtime for _i in traces) + 0.001) == []
+
+    # New waveforms are added to the stored index.
+    tr = traces[0].copy()
+    tr.stats.network = "XX"
+    data_set.add_waveforms(tr, tag="synthetic")
+    del data_set
+    data_set = ASDFDataSet(example_data_set.filename)
+    assert len(data_set.get_waveform_list()) == 7
+    names = data_set.get_waveform_list(tag="synthetic", event_id=event)
+    assert data_set.read_waveforms(names)[0].id == "XX.113A..BHE"
+
+    # The processing output also gets an index.
+    output_filename = os.path.join(example_data_set.tmpdir, "output.h5")
+    data_set.process(lambda st, inv: st, output_filename,
+                     {"raw_recording": "processed"}, executor="serial")
+    output = ASDFDataSet(output_filename)
+    assert "WaveformIndex" in output._ASDFDataSet__file
+    assert len(output.get_waveform_list(tag="processed")) == 6
+
+    # Repair an index broken by deleting data behind the back of pyasdf.
+    del output._waveform_group["AE.113A"]
+    output.build_waveform_index()
+    del output
+    output = ASDFDataSet(output_filename)
+    assert len(output.get_waveform_list()) == 3
+
+
+def test_summary(example_data_set):
+    """
+    Tests the summary of a data set.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+    data_set.add_auxiliary_data(data=np.zeros(10), data_type="RandomArray",
+                                tag="test", parameters={})
+
+    summary = data_set.summary()
+    assert summary["file_size"] == os.path.getsize(example_data_set.filename)
+    assert summary["event_count"] == 1
+    assert summary["station_count"] == 2
+    assert summary["waveform_count"] == 6
+    assert summary["stations"] == {"AE.113A": 3, "TA.POKR": 3}
+    assert summary["tags"] == {"raw_recording": 6}
+    assert summary["channels"] == {"BHE": 2, "BHN": 2, "BHZ": 2}
+    assert summary["auxiliary_data"] == {"RandomArray": 1}
+    traces = data_set.read_waveforms(data_set.get_waveform_list())
+    assert summary["total_samples"] == sum(_i.stats.npts for _i in traces)
+    assert summary["waveform_bytes"] == sum(_i.data.nbytes for _i in traces)
+    assert summary["waveform_storage_bytes"] == sum(
+        data_set._waveform_group[_i].id.get_storage_size()
+        for _i in data_set.get_waveform_list())
+    assert 0 < summary["waveform_storage_bytes"] < summary["waveform_bytes"]
+
+    short_summary = data_set.summary(waveforms=False)
+    assert "waveform_count" not in short_summary
+    assert short_summary["event_count"] == 1
+
+    # Packed records are counted without parsing the index.
+    for _i in range(3):
+        data_set.add_auxiliary_data(data=np.zeros(2), data_type="Windows",
+                                    tag="w%i" % _i, parameters={},
+                                    packed=True)
+    data_set.remove_auxiliary_data("Windows", "w1")
+    data_set._ASDFDataSet__packed_indices.clear()
+    assert data_set.summary(waveforms=False)["auxiliary_data"] == \
+        {"RandomArray": 1, "Windows": 2}
+    assert not data_set._ASDFDataSet__packed_indices
+    del data_set._ASDFDataSet__file[
+        "AuxiliaryData/Windows/PackedIndex"].attrs["record_count"]
+    assert data_set._get_auxiliary_data_count("Windows") == 2
+    data_set.remove_auxiliary_data("Windows")
+
+    # Count the events of files without the stored count.
+    del data_set._ASDFDataSet__file["QuakeML"].attrs["event_count"]
+    assert data_set._get_event_count() == 1
+
+    assert "Contains 1 event(s)" in str(data_set)
+    assert "Contains waveform data from 2 station(s)" in str(data_set)
+    assert "1 type(s) of auxiliary data: RandomArray" in str(data_set)
+
+
+@pytest.mark.parametrize("executor", ["serial", "thread", "process"])
+def test_validate(example_data_set, executor):
+    """
+    Tests the validation of a data set.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+    report = data_set.validate(executor=executor)
+    assert report["is_valid"]
+    assert report["stations_checked"] == 2
+
+    # Waveforms without station information and outside of the channel
+    # epochs.
+    tr = data_set.waveforms.AE_113A.raw_recording[0]
+    tr.stats.network = "XX"
+    data_set.add_waveforms(tr, tag="synthetic")
+    tr = data_set.waveforms.AE_113A.raw_recording[0]
+    tr.stats.starttime = obspy.UTCDateTime(1970, 1, 1)
+    data_set.add_waveforms(tr, tag="synthetic")
+    old_name = [_i for _i in data_set.get_waveform_list()
+                if _i.startswith("AE.113A") and "synthetic" in _i][0]
+
+    # Broken waveform name.
+    data_set._waveform_group["TA.POKR"]["random"] = np.zeros(3)
+
+    quick_report = data_set.validate(quick=True)
+    assert not quick_report["is_valid"]
+    assert quick_report["no_station_information"] == ["XX.113A"]
+    assert quick_report["orphan_waveforms"] == ["TA.POKR/random"]
+    assert quick_report["no_channel_epoch"] == []
+
+    # Corrupt the data of one waveform on disc.
+    name = data_set.get_waveform_list(station="POKR", channel="BHZ")[0]
+    offset = data_set._waveform_group[name].id.get_chunk_info(0).byte_offset
+    del data_set
+    with io.open(example_data_set.filename, "r+b") as fh:
+        fh.seek(offset + 10)
+        value = fh.read(1)
+        fh.seek(offset + 10)
+        fh.write(bytes(bytearray([(ord(value) + 1) % 256])))
+
+    data_set = ASDFDataSet(example_data_set.filename)
+    report = data_set.validate(executor=executor)
+    assert not report["is_valid"]
+    assert report["no_station_information"] == ["XX.113A"]
+    assert report["orphan_waveforms"] == ["TA.POKR/random"]
+    assert report["no_channel_epoch"] == [old_name]
+    assert [_i[0] for _i in report["checksum_failures"]] == [
+        "Waveforms/" + name]
+    assert report["unreadable"] == []
+
+    # The data set is still usable.
+    assert len(data_set.get_waveform_list()) == 8
+
+
+def test_get_gather(tmpdir):
+    """
+    Tests reading waveforms of many stations into a single array.
+    """
+    data_set = ASDFDataSet(os.path.join(tmpdir.strpath, "test.h5"))
+    for station in ("B", "A", "C"):
+        for channel in ("BHZ", "BHN"):
+            tr = obspy.Trace(data=np.random.random(100))
+            tr.stats.network = "XX"
+            tr.stats.station = station
+            tr.stats.channel = channel
+            tr.stats.sampling_rate = 2.0
+            data_set.add_waveforms(tr, tag="synthetic")
+
+    data, meta = data_set.get_gather("synthetic", channel="BHZ")
+    assert data.shape == (3, 100)
+    assert data.dtype == np.float64
+    assert list(meta["station"]) == ["A", "B", "C"]
+    assert list(meta["channel"]) == ["BHZ"] * 3
+    assert list(meta["sampling_rate"]) == [2.0] * 3
+    assert list(meta["starttime"]) == [0] * 3
+    for row, station in zip(data, ("A", "B", "C")):
+        st = getattr(data_set.waveforms, "XX_" + station).synthetic
+        np.testing.assert_array_equal(row, st.select(channel="BHZ")[0].data)
+
+    data, meta = data_set.get_gather("synthetic", stations=["XX.A", "XX.C"])
+    assert data.shape == (4, 100)
+    assert list(meta["station"]) == ["A", "A", "C", "C"]
+
+    data, meta = data_set.get_gather("random")
+    assert data.shape == (0, 0)
+    assert len(meta) == 0
+
+    tr = obspy.Trace(data=np.random.random(50))
+    tr.stats.network = "XX"
+    tr.stats.station = "D"
+    tr.stats.channel = "BHZ"
+    data_set.add_waveforms(tr, tag="synthetic")
+    with pytest.raises(ValueError):
+        data_set.get_gather("synthetic")
+
 
 def test_processing_multiprocessing(example_data_set):
     """
@@ -492,3 +975,789 @@ def test_reading_and_writing_auxiliary_data(tmpdir):
     aux_data.data_type == data_type
     aux_data.tag == tag
     aux_data.parameters == parameters
+
+
+@pytest.mark.parametrize("executor", ["serial", "thread", "process"])
+def test_processing_with_different_executors(example_data_set, executor,
+                                             monkeypatch):
+    """
+    All executors produce the same output and results.
+    """
+    def null_processing(st, inv):
+        return st, len(st)
+
+    # The size of each job is only determined once.
+    sized = []
+    get_size = ASDFDataSet._get_waveform_data_size
+    monkeypatch.setattr(
+        ASDFDataSet, "_get_waveform_data_size",
+        lambda self, *args: sized.append(args) or get_size(self, *args))
+
+    data_set = ASDFDataSet(example_data_set.filename)
+    output_filename = os.path.join(example_data_set.tmpdir, "output.h5")
+    results = data_set.process(null_processing, output_filename,
+                               {"raw_recording": "raw_recording"},
+                               executor=executor)
+    assert results == {("AE.113A", "raw_recording"): 3,
+                       ("TA.POKR", "raw_recording"): 3}
+    assert sorted(sized) == sorted(results)
+
+    del data_set
+    data_set = ASDFDataSet(example_data_set.filename)
+    out_data_set = ASDFDataSet(output_filename)
+    assert data_set == out_data_set
+
+
+def test_processing_with_invalid_executor(example_data_set):
+    """
+    Unknown executors and the MPI executor without MPI raise.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+    output_filename = os.path.join(example_data_set.tmpdir, "output.h5")
+    with pytest.raises(ValueError):
+        data_set.process(lambda st, inv: st, output_filename,
+                         {"raw_recording": "raw_recording"},
+                         executor="random")
+    with pytest.raises(ASDFException):
+        data_set.process(lambda st, inv: st, output_filename,
+                         {"raw_recording": "raw_recording"},
+                         executor="mpi")
+    assert not os.path.exists(output_filename)
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_processing_without_futures_initializer(example_data_set,
+                                                monkeypatch, executor):
+    """
+    The pools of the multiprocessing module are used if the ones of
+    concurrent.futures do not support an initializer.
+    """
+    monkeypatch.setattr(executors, "HAS_FUTURES_INITIALIZER", False)
+
+    def null_processing(st, inv):
+        return st, len(st)
+
+    data_set = ASDFDataSet(example_data_set.filename)
+    output_filename = os.path.join(example_data_set.tmpdir, "output.h5")
+    results = data_set.process(null_processing, output_filename,
+                               {"raw_recording": "raw_recording"},
+                               executor=executor)
+    assert results == {("AE.113A", "raw_recording"): 3,
+                       ("TA.POKR", "raw_recording"): 3}
+    assert data_set.validate(executor=executor)["is_valid"]
+
+    del data_set
+    data_set = ASDFDataSet(example_data_set.filename)
+    out_data_set = ASDFDataSet(output_filename)
+    assert data_set == out_data_set
+
+
+@pytest.mark.parametrize("futures", [True, False])
+def test_processing_with_unpicklable_results(tmpdir, monkeypatch, futures):
+    """
+    Failures while writing the output, here due to results that cannot be
+    pickled, are raised and do not leave the workers waiting for shared
+    memory forever.
+    """
+    monkeypatch.setattr(executors, "HAS_FUTURES_INITIALIZER", futures)
+
+    data_set = ASDFDataSet(os.path.join(tmpdir.strpath, "test.h5"))
+    inv = obspy.read_inventory().select(station="RJOB")
+    # More jobs than the pool has blocks of shared memory.
+    for _i in range(12):
+        st = obspy.read()
+        inv = inv.copy()
+        for tr in st:
+            tr.stats.station = "S%02i" % _i
+        for station in inv[0]:
+            station.code = "S%02i" % _i
+        data_set.add_waveforms(st, tag="raw_recording")
+        data_set.add_stationxml(inv)
+
+    def unpicklable_result(st, inv):
+        return st, lambda: None
+
+    with pytest.raises(Exception):
+        data_set.process(unpicklable_result,
+                         os.path.join(tmpdir.strpath, "output.h5"),
+                         {"raw_recording": "raw_recording"},
+                         executor=executors.ProcessPoolExecutor(
+                             max_workers=2))
+
+    # The data set is still usable.
+    assert len(data_set.get_station_list()) == 12
+
+
+def test_processing_returns_results(example_data_set):
+    """
+    Processing functions can return a result object next to the stream.
+    These are gathered and returned by the process() method.
+    """
+    def processing_with_result(st, inv):
+        return st, {"npts": sum(tr.stats.npts for tr in st),
+                    "station": inv[0][0].code}
+
+    data_set = ASDFDataSet(example_data_set.filename)
+    output_filename = os.path.join(example_data_set.tmpdir, "output.h5")
+    results = data_set.process(processing_with_result, output_filename,
+                               {"raw_recording": "raw_recording"})
+
+    assert sorted(results.keys()) == [("AE.113A", "raw_recording"),
+                                      ("TA.POKR", "raw_recording")]
+    for (station, tag), result in results.items():
+        assert result["station"] == station.split(".")[1]
+        st = data_set.get_data_for_tag(station, tag)[0]
+        assert result["npts"] == sum(tr.stats.npts for tr in st)
+
+    # The output stream is still written.
+    del data_set
+    data_set = ASDFDataSet(example_data_set.filename)
+    out_data_set = ASDFDataSet(output_filename)
+    assert data_set == out_data_set
+
+
+def test_processing_can_be_resumed(example_data_set):
+    """
+    Finished jobs are recorded in the output file so an interrupted
+    processing run can be resumed.
+    """
+    def failing_processing(st, inv):
+        if st[0].stats.station == "POKR":
+            raise ValueError("Simulated failure.")
+        return st, st[0].stats.station
+
+    def null_processing(st, inv):
+        return st, st[0].stats.station
+
+    data_set = ASDFDataSet(example_data_set.filename)
+    output_filename = os.path.join(example_data_set.tmpdir, "output.h5")
+    tag_map = {"raw_recording": "raw_recording"}
+
+    results = data_set.process(failing_processing, output_filename, tag_map)
+    assert list(results.keys()) == [("AE.113A", "raw_recording")]
+
+    out_data_set = ASDFDataSet(output_filename)
+    assert out_data_set._get_completed_jobs() == \
+        set([("AE.113A", "raw_recording")])
+    del out_data_set
+
+    # Refuses to overwrite without resuming.
+    with pytest.raises(ValueError):
+        data_set.process(null_processing, output_filename, tag_map)
+
+    # Resuming only processes the missing job.
+    results = data_set.process(null_processing, output_filename, tag_map,
+                               resume=True)
+    assert results == {("TA.POKR", "raw_recording"): "POKR"}
+
+    del data_set
+    data_set = ASDFDataSet(example_data_set.filename)
+    out_data_set = ASDFDataSet(output_filename)
+    assert data_set == out_data_set
+    assert out_data_set._get_completed_jobs() == \
+        set([("AE.113A", "raw_recording"), ("TA.POKR", "raw_recording")])
+    del out_data_set
+
+    # Nothing left to do.
+    assert data_set.process(null_processing, output_filename, tag_map,
+                            resume=True) == {}
+
+
+def test_resuming_only_removes_output_of_unfinished_jobs(example_data_set):
+    """
+    Jobs with different input tags might write to the same output tag.
+    Resuming only removes what the unfinished jobs wrote.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+    st = data_set.waveforms.AE_113A.raw_recording
+    for tr in st:
+        tr.stats.channel = "BX" + tr.stats.channel[-1]
+    data_set.add_waveforms(st, tag="copy")
+    tag_map = {"raw_recording": "processed", "copy": "processed"}
+    output_filename = os.path.join(example_data_set.tmpdir, "output.h5")
+
+    def failing_processing(st, inv):
+        if st[0].stats.channel.startswith("BX"):
+            raise ValueError("Simulated failure.")
+        return st
+
+    def partial_processing(st, inv):
+        return st[1:]
+
+    data_set.process(failing_processing, output_filename, tag_map)
+    out_data_set = ASDFDataSet(output_filename)
+    assert ("AE.113A", "copy") not in out_data_set._get_completed_jobs()
+    expected = sorted(out_data_set.get_waveform_list())
+
+    # Simulate a job interrupted while writing its output.
+    job = ("AE.113A", "copy")
+    out_data_set._add_job_outputs([
+        (job, out_data_set._get_waveform_name(tr, "processed"))
+        for tr in st])
+    out_data_set.add_waveforms(st[:1], tag="processed")
+    del out_data_set
+
+    data_set.process(partial_processing, output_filename, tag_map,
+                     resume=True)
+    out_data_set = ASDFDataSet(output_filename)
+    expected += [ASDFDataSet._get_waveform_name(tr, "processed")
+                 for tr in st[1:]]
+    assert sorted(out_data_set.get_waveform_list()) == sorted(expected)
+
+
+def test_waveform_data_size_estimate(example_data_set):
+    """
+    The size estimate used to order the processing jobs does not read any
+    data.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+
+    for station in ("AE.113A", "TA.POKR"):
+        st = data_set.get_data_for_tag(station, "raw_recording")[0]
+        expected = sum(tr.data.nbytes for tr in st)
+        assert data_set._get_waveform_data_size(station) == expected
+        assert data_set._get_waveform_data_size(
+            station, tag="raw_recording") == expected
+        assert data_set._get_waveform_data_size(
+            station, tag="random") == 0
+    assert data_set._get_waveform_data_size("XX.YYY") == 0
+
+
+@pytest.mark.parametrize("executor", ["serial", "thread", "process"])
+def test_process_two_files_without_parallel_output(example_data_set,
+                                                   executor):
+    """
+    Tests processing two files without MPI.
+    """
+    filename_1 = example_data_set.filename
+    filename_2 = os.path.join(example_data_set.tmpdir, "other.h5")
+    shutil.copyfile(filename_1, filename_2)
+
+    def compare(this_station, other_station):
+        if this_station.StationXML[0][0].code == "POKR":
+            raise ValueError("Simulated failure.")
+        return sorted(dir(this_station)), \
+            this_station.raw_recording == other_station.raw_recording
+
+    data_set_1 = ASDFDataSet(filename_1, compression=None)
+    data_set_2 = ASDFDataSet(filename_2, mode="r")
+
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        results = data_set_1.process_two_files_without_parallel_output(
+            data_set_2, compare, executor=executor)
+    assert any("TA.POKR" in str(_i.message) for _i in w)
+
+    assert results == {"AE.113A": (["StationXML", "raw_recording"], True)}
+
+    # Both data sets are still usable afterwards and keep their settings.
+    assert data_set_1 == data_set_2
+    with pytest.raises(Exception):
+        data_set_2.add_waveforms(obspy.read(), tag="random")
+    data_set_1.add_waveforms(obspy.read(), tag="random")
+    name = data_set_1.get_waveform_list(tag="random")[0]
+    assert data_set_1._waveform_group[name].compression is None
+
+
+def test_process_two_files_with_unpicklable_results(example_data_set):
+    """
+    Results that cannot be sent back from the worker processes are raised.
+    """
+    other_filename = os.path.join(example_data_set.tmpdir, "other.h5")
+    shutil.copyfile(example_data_set.filename, other_filename)
+    data_set = ASDFDataSet(example_data_set.filename)
+
+    def unpicklable_result(this_station, other_station):
+        return lambda: None
+
+    with pytest.raises(Exception):
+        data_set.process_two_files_without_parallel_output(
+            ASDFDataSet(other_filename), unpicklable_result,
+            executor=executors.ProcessPoolExecutor(max_workers=2))
+
+    assert data_set.get_station_list() == ["AE.113A", "TA.POKR"]
+
+
+def test_read_only_mode(example_data_set):
+    """
+    Files can be opened read-only, also by multiple data sets at once.
+    """
+    data_set_1 = ASDFDataSet(example_data_set.filename, mode="r")
+    data_set_2 = ASDFDataSet(example_data_set.filename, mode="r")
+    assert data_set_1 == data_set_2
+
+    with pytest.raises(ValueError):
+        ASDFDataSet(example_data_set.filename, mode="w")
+
+
+def test_asynchronous_reading(example_data_set):
+    """
+    Tests the asyncio based read API.
+    """
+    asyncio = pytest.importorskip("asyncio")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    data_set = ASDFDataSet(example_data_set.filename)
+
+    try:
+        st, inv = loop.run_until_complete(
+            data_set.aget_data_for_tag("AE.113A", "raw_recording"))
+        assert st == data_set.waveforms.AE_113A.raw_recording
+        assert inv == data_set.waveforms.AE_113A.StationXML
+
+        st = loop.run_until_complete(
+            data_set.aget_waveforms("TA.POKR", "raw_recording"))
+        assert st == data_set.waveforms.TA_POKR.raw_recording
+
+        def collect(tag, prefetch):
+            result = []
+            iterator = data_set.aitertag(tag, prefetch=prefetch).__aiter__()
+            while True:
+                try:
+                    result.append(loop.run_until_complete(
+                        iterator.__anext__()))
+                except StopAsyncIteration:  # NOQA
+                    return result
+
+        for prefetch in (0, 1, 5):
+            items = collect("raw_recording", prefetch)
+            assert items == [
+                data_set.get_data_for_tag(_i, "raw_recording")
+                for _i in ("AE.113A", "TA.POKR")]
+        assert collect("random", 2) == []
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def test_extract(example_data_set, tmpdir):
+    """
+    Tests extracting a subset of a data set to a new file.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+    event = data_set.events[0]
+
+    # Complete waveforms are copied as they are.
+    filename = os.path.join(tmpdir.strpath, "subset.h5")
+    data_set.extract(filename, stations="AE.*")
+    with pytest.raises(ValueError):
+        data_set.extract(filename)
+    subset = ASDFDataSet(filename)
+    assert subset.get_station_list() == ["AE.113A"]
+    assert subset.get_data_for_tag("AE.113A", "raw_recording") == \
+        data_set.get_data_for_tag("AE.113A", "raw_recording")
+    assert subset.events == data_set.events
+    assert subset.diff(data_set)["changed"] == []
+
+    # Waveforms are cut to the time range.
+    st = data_set.waveforms.TA_POKR.raw_recording
+    starttime = st[0].stats.starttime + 100 * st[0].stats.delta
+    endtime = starttime + 20.0
+    filename = os.path.join(tmpdir.strpath, "time_range.h5")
+    data_set.extract(filename, stations=["TA.*", "XX.*"],
+                     tags="raw_recording", starttime=starttime,
+                     endtime=endtime, events=[event])
+    subset = ASDFDataSet(filename)
+    assert subset.get_station_list() == ["TA.POKR"]
+    assert subset.waveforms.TA_POKR.StationXML == \
+        data_set.waveforms.TA_POKR.StationXML
+    expected = st.slice(starttime, endtime, nearest_sample=False)
+    st = subset.waveforms.TA_POKR.raw_recording
+    st.sort()
+    expected.sort()
+    assert len(st) == 3
+    for tr, expected_tr in zip(st, expected):
+        np.testing.assert_equal(tr.data, expected_tr.data)
+        assert tr.stats.starttime == expected_tr.stats.starttime
+        assert tr.stats.asdf.event_id == event.resource_id
+    assert len(st[0]) == 20 * st[0].stats.sampling_rate + 1
+
+    # Waveforms of other events are not extracted.
+    filename = os.path.join(tmpdir.strpath, "other_event.h5")
+    data_set.extract(filename, events=["smi:local/other"])
+    subset = ASDFDataSet(filename)
+    assert subset.get_waveform_list() == []
+    assert len(subset.events) == 0
+    assert len(subset.get_station_list()) == 2
+
+
+def test_repack(example_data_set, tmpdir):
+    """
+    Tests writing a compact copy of a data set.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+    data_set.add_auxiliary_data(data=np.random.random(1000),
+                                data_type="RandomArrays", tag="test_data",
+                                parameters={"a": 1})
+    # Growing and replacing the station information and events leaves
+    # unused space in the file.
+    inv = data_set.waveforms.AE_113A.StationXML
+    cat = data_set.events
+    for _ in range(3):
+        data_set.events = cat + cat.copy()
+        data_set._add_inventory_object(inv + inv, "AE", "113A")
+        data_set.events = cat
+        data_set._add_inventory_object(inv, "AE", "113A")
+    data_set._flush()
+
+    filename = os.path.join(tmpdir.strpath, "repacked.h5")
+    data_set.repack(filename)
+    with pytest.raises(ValueError):
+        data_set.repack(filename)
+    with pytest.raises(ValueError):
+        data_set.repack(os.path.join(tmpdir.strpath, "a.h5"),
+                        compression="random")
+    assert os.path.getsize(filename) < \
+        os.path.getsize(example_data_set.filename)
+    repacked = ASDFDataSet(filename)
+    assert repacked == data_set
+    assert repacked.diff(data_set)["changed"] == []
+    assert repacked.auxiliary_data.RandomArrays.test_data.parameters == \
+        {"a": 1}
+
+    # The waveforms are stored ordered by station and time.
+    names = sorted(repacked.get_waveform_list(), key=lambda x: (
+        x.split("/")[0], repacked._waveform_group[x].attrs["starttime"]))
+    offsets = [repacked._waveform_group[_i].id.get_chunk_info(0).byte_offset
+               for _i in names]
+    assert offsets == sorted(offsets)
+
+    # Changing the compression and chunking.
+    filename = os.path.join(tmpdir.strpath, "lzf.h5")
+    data_set.repack(filename, compression="lzf", chunking=100)
+    repacked = ASDFDataSet(filename)
+    assert repacked == data_set
+    for name in repacked.get_waveform_list():
+        assert repacked._waveform_group[name].compression == "lzf"
+        assert repacked._waveform_group[name].chunks == (100,)
+    data = repacked._auxiliary_data_group["RandomArrays/test_data"]
+    assert data.compression == "lzf"
+
+
+def test_removing_and_overwriting_data(example_data_set, tmpdir):
+    """
+    Tests removing and replacing waveforms and auxiliary data.
+    """
+    data_set = ASDFDataSet(example_data_set.filename)
+    data_set.build_waveform_index()
+    st = data_set.waveforms.AE_113A.raw_recording
+
+    # Removing waveforms.
+    names = data_set.get_waveform_list(station="113A", channel="BHZ")
+    data_set.remove_waveforms(names)
+    assert len(data_set.get_waveform_list()) == 5
+    assert len(data_set.waveforms.AE_113A.raw_recording) == 2
+    with pytest.raises(ValueError):
+        data_set.remove_waveforms(names)
+    with pytest.raises(ValueError):
+        data_set.remove_waveforms(["AE.113A/StationXML"])
+    data_set.remove_waveforms(data_set.waveform_table[
+        data_set.waveform_table["station"] == "POKR"])
+    assert data_set.get_station_list() == ["AE.113A", "TA.POKR"]
+    assert dir(data_set.waveforms.TA_POKR) == ["StationXML"]
+
+    # Overwriting waveforms.
+    for tr in st:
+        tr.data = tr.data * 2
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        data_set.add_waveforms(st, tag="raw_recording")
+    assert len(w) == 2
+    assert data_set.waveforms.AE_113A.raw_recording.select(
+        channel="BHZ") == st.select(channel="BHZ")
+    data_set.add_waveforms(st, tag="raw_recording", overwrite=True)
+    del data_set
+    data_set = ASDFDataSet(example_data_set.filename)
+    assert data_set.waveforms.AE_113A.raw_recording == st
+    assert len(data_set.get_waveform_list()) == 3
+    assert data_set.diff(data_set)["changed"] == []
+
+    # Stations without any data left are removed.
+    obspy_st = obspy.read()
+    data_set.add_waveforms(obspy_st, tag="example")
+    data_set.remove_waveforms(data_set.get_waveform_list(tag="example"))
+    assert "BW.RJOB" not in data_set.get_station_list()
+
+    # Auxiliary data.
+    for tag in ("a", "b"):
+        data_set.add_auxiliary_data(data=np.arange(10), data_type="Test",
+                                    tag=tag, parameters={})
+    data_set.add_auxiliary_data(data=np.arange(5), data_type="Test",
+                                tag="a", parameters={"b": 1},
+                                overwrite=True)
+    assert data_set.auxiliary_data.Test.a.parameters == {"b": 1}
+    np.testing.assert_equal(data_set.auxiliary_data.Test.a.data,
+                            np.arange(5))
+    data_set.remove_auxiliary_data("Test", "a")
+    assert dir(data_set.auxiliary_data.Test) == ["b"]
+    with pytest.raises(ValueError):
+        data_set.remove_auxiliary_data("Test", "a")
+    data_set.remove_auxiliary_data("Test")
+    assert len(data_set.auxiliary_data) == 0
+
+    # Files keep track of the space of deleted data only if asked to as
+    # this requires the file format of HDF5 1.10.
+    def persists_free_space(data_set):
+        plist = data_set._ASDFDataSet__file.id.get_create_plist()
+        return bool(plist.get_file_space_strategy()[1])
+
+    supported = bool(get_free_space_settings())
+    if supported:
+        assert not persists_free_space(data_set)
+    filename = os.path.join(tmpdir.strpath, "reuse.h5")
+    data_set = ASDFDataSet(filename, compression=None,
+                           track_free_space=True)
+    if supported:
+        assert persists_free_space(data_set)
+    data_set.add_waveforms(obspy_st, tag="example")
+    del data_set
+    size = os.path.getsize(filename)
+    for _ in range(5):
+        data_set = ASDFDataSet(filename)
+        data_set.remove_waveforms(data_set.get_waveform_list())
+        del data_set
+        data_set = ASDFDataSet(filename)
+        data_set.add_waveforms(obspy_st, tag="example")
+        del data_set
+    if supported:
+        assert os.path.getsize(filename) < 2 * size
+
+
+def test_auxiliary_data_writer(tmpdir, monkeypatch):
+    """
+    Tests writing auxiliary data block by block.
+    """
+    filename = os.path.join(tmpdir.strpath, "test.h5")
+    data_set = ASDFDataSet(filename)
+    data = np.random.random((1000, 20))
+
+    # The content hash of data written in order is computed on the fly.
+    hashed = []
+    monkeypatch.setattr(pyasdf.asdf_data_set, "get_content_hash",
+                        lambda x: hashed.append(x) or get_content_hash(x))
+    with data_set.auxiliary_data_writer(
+            "Stacks", "test", shape=data.shape, dtype=data.dtype,
+            parameters={"a": 1}, chunks=(100, 20)) as writer:
+        for i in range(0, 1000, 100):
+            writer.write(slice(i, i + 100), data[i:i + 100])
+    assert hashed == []
+    aux_data = data_set.auxiliary_data.Stacks.test
+    np.testing.assert_equal(aux_data.data[:], data)
+    assert aux_data.parameters == {"a": 1}
+    assert aux_data.data.chunks == (100, 20)
+    assert get_stored_content_hash(aux_data.data) == get_content_hash(data)
+
+    # Same result as writing all data at once.
+    data_set.add_auxiliary_data(data, data_type="Stacks", tag="at_once",
+                                parameters={"a": 1})
+    assert get_content_hash(data_set.auxiliary_data.Stacks.at_once.data) == \
+        get_content_hash(data)
+    hashed = []
+
+    # Data written out of order is read again.
+    with data_set.auxiliary_data_writer(
+            "Stacks", "reversed", shape=data.shape, dtype=np.float32,
+            parameters={}) as writer:
+        for i in range(900, -1, -100):
+            writer.write(slice(i, i + 100), data[i:i + 100])
+    assert len(hashed) == 1
+    assert get_stored_content_hash(
+        data_set.auxiliary_data.Stacks.reversed.data) == \
+        get_content_hash(data.astype(np.float32))
+
+    with pytest.raises(ValueError):
+        data_set.auxiliary_data_writer("Stacks", "test", shape=(10,),
+                                       dtype=np.int32, parameters={})
+
+    # Incomplete data is removed and does not replace existing data.
+    with pytest.raises(ZeroDivisionError):
+        with data_set.auxiliary_data_writer(
+                "Stacks", "test", shape=(10,), dtype=np.int32,
+                parameters={}, overwrite=True) as writer:
+            writer.write(slice(0, 5), np.arange(5))
+            1 / 0
+    assert dir(data_set.auxiliary_data.Stacks) == [
+        "at_once", "reversed", "test"]
+    np.testing.assert_equal(data_set.auxiliary_data.Stacks.test.data[:],
+                            data)
+
+    with data_set.auxiliary_data_writer(
+            "Stacks", "test", shape=(10,), dtype=np.int32,
+            parameters={"b": 2}, overwrite=True) as writer:
+        writer.write(slice(None), np.arange(10))
+    assert dir(data_set.auxiliary_data.Stacks) == [
+        "at_once", "reversed", "test"]
+    aux_data = data_set.auxiliary_data.Stacks.test
+    np.testing.assert_equal(aux_data.data[:], np.arange(10))
+    assert aux_data.parameters == {"b": 2}
+    assert get_stored_content_hash(aux_data.data) == \
+        get_content_hash(np.arange(10, dtype=np.int32))
+
+
+def test_auxiliary_data_writer_failing_with_mpi(tmpdir, monkeypatch):
+    """
+    With MPI, incomplete data is removed if writing failed on any rank and
+    does not replace existing data.
+    """
+    MPI = pytest.importorskip("mpi4py.MPI")
+    filename = os.path.join(tmpdir.strpath, "test.h5")
+    data_set = ASDFDataSet(filename)
+    data_set.add_auxiliary_data(np.arange(10), data_type="Stacks",
+                                tag="test", parameters={})
+
+    # Run the MPI code paths on a single rank.
+    comm = MPI.COMM_WORLD
+    mpi_ns = collections.namedtuple("mpi_ns", ["comm", "rank", "size",
+                                               "MPI"])
+    monkeypatch.setattr(ASDFDataSet, "mpi", mpi_ns(
+        comm=comm, rank=comm.rank, size=comm.size, MPI=MPI))
+
+    for tag in ("test", "new"):
+        with pytest.raises(ZeroDivisionError):
+            with data_set.auxiliary_data_writer(
+                    "Stacks", tag, shape=(10,), dtype=np.int64,
+                    parameters={}, overwrite=True) as writer:
+                writer.write(slice(0, 5), np.ones(5, dtype=np.int64))
+                1 / 0
+        assert dir(data_set.auxiliary_data.Stacks) == ["test"]
+        np.testing.assert_equal(data_set.auxiliary_data.Stacks.test.data[:],
+                                np.arange(10))
+
+    with data_set.auxiliary_data_writer(
+            "Stacks", "test", shape=(10,), dtype=np.int64, parameters={},
+            overwrite=True) as writer:
+        writer.write(slice(None), np.ones(10, dtype=np.int64))
+    assert dir(data_set.auxiliary_data.Stacks) == ["test"]
+    np.testing.assert_equal(data_set.auxiliary_data.Stacks.test.data[:],
+                            np.ones(10))
+
+
+def test_packed_auxiliary_data(tmpdir):
+    """
+    Tests storing many small auxiliary data records in a single dataset.
+    """
+    filename = os.path.join(tmpdir.strpath, "test.h5")
+    data_set = ASDFDataSet(filename)
+
+    records = {}
+    for station in ("AE_113A", "TA_POKR"):
+        for component in "ZRT":
+            tag = "%s_%s" % (station, component)
+            records[tag] = np.random.random((np.random.randint(1, 5), 2))
+            data_set.add_auxiliary_data(
+                data=records[tag], data_type="Windows", tag=tag,
+                parameters={"component": component, "count": 2,
+                            "weight": np.float64(0.5)},
+                packed=True)
+    data_set.add_auxiliary_data(data=np.arange(3.0), data_type="Windows",
+                                tag="scalar.tag", parameters={},
+                                packed=True)
+
+    # All records are in a single dataset.
+    group = data_set._auxiliary_data_group["Windows"]
+    assert sorted(group.keys()) == ["PackedData", "PackedIndex"]
+
+    del data_set
+    data_set = ASDFDataSet(filename)
+    assert len(data_set.auxiliary_data) == 1
+    assert dir(data_set.auxiliary_data.Windows) == sorted(
+        list(records.keys()) + ["scalar___tag"])
+    for tag, data in records.items():
+        aux_data = getattr(data_set.auxiliary_data.Windows, tag)
+        np.testing.assert_equal(aux_data.data, data)
+        assert aux_data.tag == tag
+        assert aux_data.parameters == {
+            "component": tag[-1], "count": 2, "weight": 0.5}
+    np.testing.assert_equal(
+        data_set.auxiliary_data.Windows.scalar___tag.data, np.arange(3.0))
+    assert data_set.summary(waveforms=False)["auxiliary_data"] == \
+        {"Windows": 7}
+
+    # Mixing packed and unpacked data or incompatible types fails.
+    with pytest.raises(ValueError):
+        data_set.add_auxiliary_data(data=np.arange(3), data_type="Windows",
+                                    tag="a", parameters={})
+    with pytest.raises(ValueError):
+        data_set.add_auxiliary_data(data=np.array(["a"]),
+                                    data_type="Windows", tag="a",
+                                    parameters={}, packed=True)
+    # Data would not read back as written.
+    with pytest.raises(ValueError):
+        data_set.add_auxiliary_data(data=np.arange(3, dtype=np.int32),
+                                    data_type="Windows", tag="a",
+                                    parameters={}, packed=True)
+    data_set.add_auxiliary_data(data=np.arange(3), data_type="Other",
+                                tag="a", parameters={})
+    with pytest.raises(ValueError):
+        data_set.add_auxiliary_data(data=np.arange(3), data_type="Other",
+                                    tag="b", parameters={}, packed=True)
+
+    # Overwriting and removing records.
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        data_set.add_auxiliary_data(data=np.ones(2), data_type="Windows",
+                                    tag="AE_113A_Z", parameters={},
+                                    packed=True)
+    assert len(w) == 1
+    data_set.add_auxiliary_data(data=np.ones(2), data_type="Windows",
+                                tag="AE_113A_Z", parameters={"a": 1},
+                                packed=True, overwrite=True)
+    index_size = data_set._auxiliary_data_group["Windows/PackedIndex"].size
+    data_set.remove_auxiliary_data("Windows", "TA_POKR_Z")
+    with pytest.raises(ValueError):
+        data_set.remove_auxiliary_data("Windows", "TA_POKR_Z")
+    # Removed records are only marked in the index.
+    index = data_set._auxiliary_data_group["Windows/PackedIndex"]
+    assert index.value.tostring().decode().endswith("\nTA_POKR_Z\n")
+    assert index.size == index_size + len("TA_POKR_Z\n")
+    del data_set
+    data_set = ASDFDataSet(filename)
+    assert data_set.summary(waveforms=False)["auxiliary_data"] == \
+        {"Other": 1, "Windows": 6}
+    aux_data = data_set.auxiliary_data.Windows.AE_113A_Z
+    np.testing.assert_equal(aux_data.data, np.ones(2))
+    assert aux_data.parameters == {"a": 1}
+    assert "TA_POKR_Z" not in dir(data_set.auxiliary_data.Windows)
+    assert len(dir(data_set.auxiliary_data.Windows)) == 6
+
+    # Repacking drops the data of removed and replaced records.
+    repacked_filename = os.path.join(tmpdir.strpath, "repacked.h5")
+    data_set.repack(repacked_filename)
+    repacked = ASDFDataSet(repacked_filename)
+    for tag in dir(data_set.auxiliary_data.Windows):
+        aux_data = getattr(data_set.auxiliary_data.Windows, tag)
+        repacked_aux_data = getattr(repacked.auxiliary_data.Windows, tag)
+        np.testing.assert_equal(repacked_aux_data.data, aux_data.data)
+        assert repacked_aux_data.parameters == aux_data.parameters
+    assert repacked._auxiliary_data_group["Windows/PackedData"].shape[0] == \
+        sum(getattr(data_set.auxiliary_data.Windows, _i).data.size
+            for _i in dir(data_set.auxiliary_data.Windows))
+    assert data_set._auxiliary_data_group["Windows/PackedData"].shape[0] > \
+        repacked._auxiliary_data_group["Windows/PackedData"].shape[0]
+    assert repacked.summary(waveforms=False)["auxiliary_data"] == \
+        data_set.summary(waveforms=False)["auxiliary_data"]
+    assert "TA_POKR_Z" not in repacked._auxiliary_data_group[
+        "Windows/PackedIndex"].value.tostring().decode()
+
+    # Packed records are compared one by one, independent of their
+    # position in the packed data.
+    assert repacked == data_set
+    assert data_set.compare(repacked)["is_equal"]
+    assert data_set.diff(repacked) == {
+        "added": [], "removed": [], "changed": [], "unknown": []}
+    repacked.add_auxiliary_data(data=np.zeros(2), data_type="Windows",
+                                tag="TA_POKR_R", parameters={}, packed=True,
+                                overwrite=True)
+    repacked.remove_auxiliary_data("Windows", "AE_113A_R")
+    assert repacked != data_set
+    report = data_set.compare(repacked)
+    assert report["only_in_self"] == ["AuxiliaryData/Windows/AE_113A_R"]
+    assert [_i[0] for _i in report["different"]] == [
+        "AuxiliaryData/Windows/TA_POKR_R"]
+    assert data_set.diff(repacked) == {
+        "added": [], "removed": ["AuxiliaryData/Windows/AE_113A_R"],
+        "changed": ["AuxiliaryData/Windows/TA_POKR_R"], "unknown": []}
+    del repacked
+    data_set.remove_auxiliary_data("Windows")
+    assert dir(data_set.auxiliary_data) == ["Other"]
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Test cases for the tools dealing with more than one file.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2015
+:license:
+    BSD 3-Clause ("BSD New" or "BSD Simplified")
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import inspect
+import os
+import warnings
+
+import h5py
+import numpy as np
+import obspy
+import pytest
+
+from pyasdf import ASDFDataSet, ASDFWarning, create_master_file, merge
+
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe()))), "data", "small_sample_data_set")
+
+
+@pytest.fixture
+def member_files(tmpdir):
+    """
+    Two files with one station each. Both contain the same event, part of
+    the station information of the second station, and some auxiliary
+    data.
+    """
+    filenames = [os.path.join(tmpdir.strpath, "members", _i)
+                 for _i in ("a.h5", "b.h5")]
+    os.makedirs(os.path.dirname(filenames[0]))
+    inv = obspy.read_inventory(os.path.join(data_dir, "TA.POKR..BH*.xml"))
+    inv[0][0].channels = inv[0][0].channels[:1]
+
+    for filename, station in zip(filenames, ("AE.113A", "TA.POKR")):
+        data_set = ASDFDataSet(filename)
+        data_set.add_quakeml(os.path.join(data_dir, "quake.xml"))
+        data_set.add_stationxml(os.path.join(data_dir, station + "..BH*.xml"))
+        if station == "AE.113A":
+            data_set.add_stationxml(inv)
+        data_set.add_waveforms(os.path.join(data_dir, station + "*.mseed"),
+                               tag="raw_recording")
+        data_set.add_auxiliary_data(
+            data=np.arange(10), data_type="Counts", tag=station.replace(
+                ".", "_"), parameters={"station": station})
+        del data_set
+    return filenames
+
+
+def test_master_file(tmpdir, member_files):
+    """
+    Tests exposing many files as a single data set with external links.
+    """
+    filename = os.path.join(tmpdir.strpath, "master.h5")
+    create_master_file(member_files, filename)
+    with pytest.raises(ValueError):
+        create_master_file(member_files, filename)
+
+    master = ASDFDataSet(filename, mode="r")
+    members = [ASDFDataSet(_i, mode="r") for _i in member_files]
+
+    assert len(master.events) == 1
+    assert master.events == members[0].events
+    assert master.get_station_list() == ["AE.113A", "TA.POKR"]
+    assert sorted(master.get_waveform_list()) == sorted(
+        members[0].get_waveform_list() + members[1].get_waveform_list())
+    assert master.waveforms.AE_113A.raw_recording == \
+        members[0].waveforms.AE_113A.raw_recording
+    assert master.get_data_for_tag("TA.POKR", "raw_recording") == \
+        members[1].get_data_for_tag("TA.POKR", "raw_recording")
+    assert master.auxiliary_data.Counts.AE_113A.parameters == \
+        {"station": "AE.113A"}
+    np.testing.assert_equal(master.auxiliary_data.Counts.TA_POKR.data,
+                            np.arange(10))
+
+    # No samples are copied. Station information only differing in one
+    # file is linked, the rest is merged.
+    group = master._waveform_group
+    for name in master.get_waveform_list() + ["AE.113A/StationXML"]:
+        assert isinstance(group.get(name, getlink=True), h5py.ExternalLink)
+    assert isinstance(group.get("TA.POKR/StationXML", getlink=True),
+                      h5py.HardLink)
+    assert len(members[0].waveforms.TA_POKR.StationXML[0][0]) == 1
+    assert master.waveforms.TA_POKR.StationXML == \
+        members[1].waveforms.TA_POKR.StationXML
+
+    # Member files can be moved together with the master file.
+    del master
+    del members
+    new_directory = os.path.join(tmpdir.strpath, "moved")
+    os.makedirs(new_directory)
+    os.rename(os.path.join(tmpdir.strpath, "members"),
+              os.path.join(new_directory, "members"))
+    os.rename(filename, os.path.join(new_directory, "master.h5"))
+    master = ASDFDataSet(os.path.join(new_directory, "master.h5"), mode="r")
+    assert len(master.waveforms.AE_113A.raw_recording) == 3
+
+    # Data in more than one file.
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        create_master_file(
+            [os.path.join(new_directory, "members", "a.h5")] * 2,
+            os.path.join(new_directory, "master_2.h5"))
+    assert w and all(_i.category is ASDFWarning for _i in w)
+
+    # Validation also verifies the data in the member files.
+    assert master.validate(executor="serial")["is_valid"]
+    missing = ["AuxiliaryData/Counts/TA_POKR"] + [
+        "Waveforms/" + _i for _i in master.get_waveform_list(
+            station="POKR")]
+    del master
+    os.remove(os.path.join(new_directory, "members", "b.h5"))
+    master = ASDFDataSet(os.path.join(new_directory, "master.h5"), mode="r")
+    report = master.validate(executor="thread")
+    assert not report["is_valid"]
+    assert sorted(_i[0] for _i in report["unreadable"]) == sorted(missing)
+
+
+def test_merge(tmpdir, member_files):
+    """
+    Tests merging files by copying the data on the HDF5 level.
+    """
+    filename = os.path.join(tmpdir.strpath, "merged.h5")
+    merge(member_files, filename)
+    with pytest.raises(ValueError):
+        merge(member_files, filename)
+
+    merged = ASDFDataSet(filename, mode="r")
+    members = [ASDFDataSet(_i, mode="r") for _i in member_files]
+
+    assert len(merged.events) == 1
+    assert merged.get_station_list() == ["AE.113A", "TA.POKR"]
+    assert sorted(merged.get_waveform_list()) == sorted(
+        members[0].get_waveform_list() + members[1].get_waveform_list())
+    assert merged.get_data_for_tag("AE.113A", "raw_recording") == \
+        members[0].get_data_for_tag("AE.113A", "raw_recording")
+    assert merged.waveforms.TA_POKR.raw_recording == \
+        members[1].waveforms.TA_POKR.raw_recording
+    assert merged.waveforms.TA_POKR.StationXML == \
+        members[1].waveforms.TA_POKR.StationXML
+    assert merged.auxiliary_data.Counts.TA_POKR.parameters == \
+        {"station": "TA.POKR"}
+    assert merged.diff(members[0])["changed"] == \
+        ["Waveforms/TA.POKR/StationXML"]
+
+    # The data is copied as is.
+    name = merged.get_waveform_list()[0]
+    assert merged._waveform_group[name].compression == "gzip"
+    assert merged._waveform_group[name].id.get_storage_size() == \
+        members[0]._waveform_group[name].id.get_storage_size()
+
+    # Same result when merging a master file.
+    master_filename = os.path.join(tmpdir.strpath, "master.h5")
+    create_master_file(member_files, master_filename)
+    merge([master_filename], os.path.join(tmpdir.strpath, "merged_2.h5"))
+    assert ASDFDataSet(os.path.join(tmpdir.strpath, "merged_2.h5"),
+                       mode="r") == merged
+
+    # Hard links are kept.
+    del members
+    data_set = ASDFDataSet(member_files[0], deduplicate=True)
+    data_set.add_waveforms(data_set.waveforms.AE_113A.raw_recording,
+                           tag="copy")
+    del data_set
+    merge(member_files[:1], os.path.join(tmpdir.strpath, "dedup.h5"))
+    data_set = ASDFDataSet(os.path.join(tmpdir.strpath, "dedup.h5"))
+    for name in data_set.get_waveform_list(tag="copy"):
+        assert h5py.h5o.get_info(data_set._waveform_group[name].id).rc == 2
+
+
+@pytest.mark.parametrize("combine", [merge, create_master_file])
+def test_packed_auxiliary_data(tmpdir, combine):
+    """
+    The records of packed auxiliary data of all files are combined.
+    """
+    filenames = [os.path.join(tmpdir.strpath, _i) for _i in ("a.h5", "b.h5")]
+    records = {}
+    for filename, station in zip(filenames, ("AE_113A", "TA_POKR")):
+        data_set = ASDFDataSet(filename)
+        for component in "ZNE":
+            tag = "%s_%s" % (station, component)
+            records[tag] = np.random.random((3, 2))
+            data_set.add_auxiliary_data(
+                data=records[tag], data_type="Windows", tag=tag,
+                parameters={"component": component}, packed=True)
+        # Also in the first file and thus skipped.
+        if station == "TA_POKR":
+            data_set.add_auxiliary_data(
+                data=np.ones(2), data_type="Windows", tag="AE_113A_Z",
+                parameters={}, packed=True)
+        data_set.remove_auxiliary_data("Windows", "%s_E" % station)
+        del records["%s_E" % station]
+        # Packed in one file but not in the other.
+        data_set.add_auxiliary_data(
+            data=np.arange(3.0), data_type="Mixed", tag=station,
+            parameters={}, packed=station == "AE_113A")
+        del data_set
+
+    output_filename = os.path.join(tmpdir.strpath, "output.h5")
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        combine(filenames, output_filename)
+    assert sorted(str(_i.message).split("'")[1] for _i in w) == [
+        "/AuxiliaryData/Mixed/TA_POKR", "/AuxiliaryData/Windows/AE_113A_Z"]
+    assert all(_i.category is ASDFWarning for _i in w)
+
+    output = ASDFDataSet(output_filename, mode="r")
+    group = output._auxiliary_data_group["Windows"]
+    assert sorted(group.keys()) == ["PackedData", "PackedIndex"]
+    assert isinstance(group.get("PackedData", getlink=True), h5py.HardLink)
+    assert group["PackedData"].shape == (24,)
+    assert dir(output.auxiliary_data.Windows) == sorted(records)
+    for tag, data in records.items():
+        aux_data = getattr(output.auxiliary_data.Windows, tag)
+        np.testing.assert_equal(aux_data.data, data)
+        assert aux_data.parameters == {"component": tag[-1]}
+    assert dir(output.auxiliary_data.Mixed) == ["AE_113A"]
+    assert output.summary(waveforms=False)["auxiliary_data"] == {
+        "Mixed": 1, "Windows": 4}
+
+    # Records are compared one by one.
+    first = ASDFDataSet(filenames[0], mode="r")
+    assert output.diff(first) == {
+        "added": [], "removed": ["AuxiliaryData/Windows/TA_POKR_N",
+                                 "AuxiliaryData/Windows/TA_POKR_Z"],
+        "changed": [], "unknown": []}
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Test cases for the utils.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2015
+:license:
+    BSD 3-Clause ("BSD New" or "BSD Simplified")
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+import obspy
+
+from ..utils import get_multiprocessing, SharedMemoryPool, \
+    SharedMemoryStream, shared_memory
+
+
+def test_shared_memory_pool():
+    """
+    Streams survive a round trip through the shared memory pool.
+    """
+    st = obspy.read()
+    st[1].data = np.require(st[1].data, dtype=np.float64)
+    st[2].data = st[2].data[:1001]
+
+    pool = SharedMemoryPool(get_multiprocessing(), block_count=2,
+                            block_size=100000)
+    try:
+        packed = pool.pack_stream(st)
+        if shared_memory is not None:
+            assert isinstance(packed, SharedMemoryStream)
+        new_st = pool.unpack_stream(packed)
+        assert new_st == st
+        for tr, new_tr in zip(st, new_st):
+            assert tr.data.dtype == new_tr.data.dtype
+        del new_st
+        pool.release(packed)
+
+        # Too large streams and None are passed through.
+        st[0].data = np.zeros(100001, dtype=np.float64)
+        assert pool.pack_stream(st) is st
+        assert pool.pack_stream(None) is None
+    finally:
+        pool.close()
@@ -9,23 +9,267 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import calendar
 import collections
+import fnmatch
+import hashlib
+import inspect
+import json
+import math
 import os
+import re
 import sys
 import time
 import warnings
 import weakref
 
+import h5py
 import numpy as np
 import obspy
 
-from .header import MSG_TAGS
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+from .header import ASDFException, MSG_TAGS, MAX_MEMORY_PER_WORKER_IN_MB, \
+    CONTENT_HASH_ATTRIBUTE
 
 # Tuple holding a the body of a received message.
 ReceivedMessage = collections.namedtuple("ReceivedMessage", ["data"])
 # Tuple denoting a single worker.
 Worker = collections.namedtuple("Worker", ["active_jobs",
                                            "completed_jobs_count"])
+# A single waveform in the index of a data set. The times are the ones
+# encoded in the name of the waveform, e.g. seconds since the epoch rounded
+# down to full seconds.
+WaveformIndexEntry = collections.namedtuple("WaveformIndexEntry", [
+    "name", "network", "station", "location", "channel", "starttime",
+    "endtime", "tag"])
+
+# The attributes of a single waveform stored in the index of a data set.
+# The start time is in nanoseconds since the epoch.
+WaveformDetails = collections.namedtuple("WaveformDetails", [
+    "starttime", "sampling_rate", "npts", "dtype", "event_id"])
+# A single record of a packed auxiliary data type. The offset is in elements
+# of the flat packed data. The content hash is None for records written
+# without one.
+PackedRecord = collections.namedtuple("PackedRecord", [
+    "offset", "shape", "parameters", "content_hash"])
+
+
+def get_endtime_ns(starttime, sampling_rate, npts):
+    """
+    Returns the time of the last sample of a waveform in nanoseconds since
+    the epoch.
+
+    :param starttime: The time of the first sample in nanoseconds.
+    :type starttime: int
+    :param sampling_rate: The sampling rate in Hz.
+    :type sampling_rate: float
+    :param npts: The number of samples.
+    :type npts: int
+    """
+    if npts < 2:
+        return starttime
+    return starttime + int(round((npts - 1) / sampling_rate * 1.0E9))
+
+
+def get_sample_range(details, starttime=None, endtime=None):
+    """
+    Returns the index of the first and one past the last sample of a
+    waveform within the given time range. Both are equal if no sample is
+    within the time range.
+
+    :param details: The attributes of the waveform.
+    :type details: :class:`~pyasdf.utils.WaveformDetails`
+    :type starttime: :class:`~obspy.core.utcdatetime.UTCDateTime`
+    :type endtime: :class:`~obspy.core.utcdatetime.UTCDateTime`
+    """
+    def get_offset(time):
+        # In samples, rounded to not lose samples exactly at the boundaries
+        # to floating point errors.
+        return round((int(round(time.timestamp * 1.0E9)) -
+                      details.starttime) * details.sampling_rate / 1.0E9, 6)
+
+    first, stop = 0, details.npts
+    if starttime is not None:
+        first = max(first, int(np.ceil(get_offset(starttime))))
+    if endtime is not None:
+        stop = min(stop, int(np.floor(get_offset(endtime))) + 1)
+    return first, max(first, stop)
+
+
+def format_waveform_index_line(name, details):
+    """
+    Formats a single line of the index of waveforms stored in a file.
+
+    :param name: The full name of the waveform.
+    :type name: str
+    :param details: The attributes of the waveform.
+    :type details: :class:`WaveformDetails`
+    """
+    return "%s\t%i\t%r\t%i\t%s\t%s\n" % (
+        name, details.starttime, float(details.sampling_rate),
+        details.npts, details.dtype, details.event_id)
+
+
+def parse_waveform_index(text):
+    """
+    Parse the index of waveforms stored in a file. Much faster than
+    traversing the file and parsing the names as all times are already
+    contained in the index.
+
+    Returns a list of :class:`WaveformIndexEntry` objects and a dictionary
+    mapping the names of the waveforms to :class:`WaveformDetails` objects.
+
+    :param text: The index as written by :func:`format_waveform_index_line`.
+    :type text: str
+    """
+    entries = []
+    details = {}
+    for line in text.splitlines():
+        name, starttime, sampling_rate, npts, dtype, event_id = \
+            line.split("\t")
+        info = WaveformDetails(
+            starttime=int(starttime), sampling_rate=float(sampling_rate),
+            npts=int(npts), dtype=dtype, event_id=event_id)
+        code, _, _, tag = name.split("/")[1].split("__", 3)
+        network, station, location, channel = code.split(".")
+        endtime = get_endtime_ns(info.starttime, info.sampling_rate,
+                                 info.npts)
+        entries.append(WaveformIndexEntry(
+            name=name, network=network, station=station, location=location,
+            channel=channel, starttime=info.starttime // 10 ** 9,
+            endtime=endtime // 10 ** 9, tag=tag))
+        details[name] = info
+    return entries, details
+
+
+def format_packed_index_line(tag, record=None):
+    """
+    Formats a single line of the index of a packed auxiliary data type.
+
+    :param tag: The tag of the record.
+    :type tag: str
+    :param record: The record. A line marking the record as removed is
+        returned if not given.
+    :type record: :class:`PackedRecord`
+    """
+    if record is None:
+        return "%s\n" % tag
+    return "%s\t%i\t%s\t%s\t%s\n" % (
+        tag, record.offset, ",".join(str(_i) for _i in record.shape),
+        record.content_hash or "",
+        json.dumps(record.parameters, sort_keys=True,
+                   default=_to_json_value))
+
+
+def _to_json_value(value):
+    """
+    Converts numpy values and byte strings, e.g. read from HDF5 attributes,
+    to something JSON serializable.
+    """
+    if isinstance(value, bytes):
+        return value.decode()
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError("%r is not JSON serializable." % (value,))
+
+
+def parse_packed_index(text):
+    """
+    Parse the index of a packed auxiliary data type. Returns an ordered
+    dictionary mapping the tags to :class:`PackedRecord` objects.
+
+    Records are only ever appended to the index. Later lines replace
+    earlier ones with the same tag and lines with only a tag mark the
+    record as removed.
+
+    :param text: The index as written by :func:`format_packed_index_line`.
+    :type text: str
+    """
+    records = collections.OrderedDict()
+    for line in text.splitlines():
+        # The JSON encoded parameters never contain raw tabs.
+        fields = line.split("\t")
+        records.pop(fields[0], None)
+        if len(fields) == 1:
+            continue
+        # Written without a content hash.
+        if len(fields) == 4:
+            fields.insert(3, "")
+        tag, offset, shape, content_hash, parameters = fields
+        records[tag] = PackedRecord(
+            offset=int(offset),
+            shape=tuple(int(_i) for _i in shape.split(",") if _i),
+            parameters=json.loads(parameters),
+            content_hash=content_hash or None)
+    return records
+
+
+def parse_waveform_name(name):
+    """
+    Parse the full name of a waveform, e.g.
+    ``"AE.113A/AE.113A..BHE__2013-05-24T05:40:00__2013-05-24T06:50:00__tag"``
+    into a :class:`WaveformIndexEntry`.
+
+    Returns ``None`` if the name is not the name of a waveform.
+
+    :param name: The name of the waveform relative to the waveform group.
+    :type name: str
+    """
+    try:
+        _, data_name = name.split("/")
+        code, starttime, endtime, tag = data_name.split("__", 3)
+        network, station, location, channel = code.split(".")
+    except ValueError:
+        return None
+    return WaveformIndexEntry(
+        name=name, network=network, station=station, location=location,
+        channel=channel, starttime=_parse_name_time(starttime),
+        endtime=_parse_name_time(endtime), tag=tag)
+
+
+def _parse_name_time(value):
+    """
+    Parse the times in waveform names to seconds since the epoch. Much
+    faster than creating UTCDateTime objects.
+    """
+    return calendar.timegm(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+
+
+def matches_pattern(value, pattern):
+    """
+    Returns True if the value matches the pattern. ``None`` matches
+    everything, otherwise UNIX style wildcards are supported as well as a
+    list of patterns of which at least one must match.
+
+    :param value: The value to test.
+    :type value: str
+    :param pattern: The pattern.
+    """
+    if pattern is None:
+        return True
+    if isinstance(pattern, (list, tuple, set)):
+        return any(matches_pattern(value, _i) for _i in pattern)
+    return fnmatch.fnmatchcase(value, pattern)
+
+
+def escape_pattern(value):
+    """
+    Escapes all wildcards in a value so that it is matched literally by
+    :func:`matches_pattern`.
+
+    :param value: The value.
+    :type value: str
+    """
+    return re.sub(r"([*?[])", r"[\1]", value)
 
 
 def get_multiprocessing():
@@ -71,6 +315,294 @@ def is_multiprocessing_problematic():
         return False
 
 
+def get_free_space_settings():
+    """
+    Returns the keyword arguments for :class:`h5py.File` to create a file
+    that keeps track of the space of deleted data, also after closing it,
+    and reuses it for new data. Empty if h5py or HDF5 are too old.
+    """
+    if h5py.version.hdf5_version_tuple < (1, 10, 1):
+        return {}
+    try:
+        parameters = inspect.signature(h5py.File.__init__).parameters
+    except AttributeError:
+        # Python 2 which is not supported by h5py versions offering it.
+        return {}
+    if "fs_strategy" not in parameters:
+        return {}
+    return {"fs_strategy": "fsm", "fs_persist": True}
+
+
+def split_processing_output(output):
+    """
+    Split whatever a processing function returned into the stream that
+    should be written and an optional result object.
+
+    Processing functions can either return a stream (or None) or a tuple of
+    a stream and a small, picklable result object.
+
+    :param output: The return value of a processing function.
+    """
+    if isinstance(output, tuple) and len(output) == 2:
+        return output[0], output[1]
+    return output, None
+
+
+def to_structured_array(rows, fields):
+    """
+    Convert a list of tuples to a numpy structured array.
+
+    String fields are given as ``str`` and will be as wide as their longest
+    value.
+
+    :param rows: The rows of the array.
+    :type rows: list of tuple
+    :param fields: The names and types of the fields.
+    :type fields: list of (str, type) tuples
+    """
+    dtype = []
+    for _i, (name, type_) in enumerate(fields):
+        if type_ is str:
+            width = max([len(_j[_i]) for _j in rows] or [0])
+            type_ = "U%i" % max(width, 1)
+        dtype.append((str(name), type_))
+    return np.array(rows, dtype=dtype)
+
+
+def get_block_slices(dataset, max_bytes=None):
+    """
+    Split a dataset into blocks along its first axis to read it with bounded
+    memory. Blocks of chunked datasets consist of whole chunks.
+
+    Returns a list of slices or ``[()]`` for scalar datasets.
+
+    :param dataset: The dataset.
+    :type dataset: :class:`h5py.Dataset`
+    :param max_bytes: The maximum size of a block in bytes. Always at
+        least one chunk or row. Defaults to half the memory budget of a
+        worker.
+    :type max_bytes: int
+    """
+    if not dataset.shape:
+        return [()]
+    if max_bytes is None:
+        max_bytes = MAX_MEMORY_PER_WORKER_IN_MB * 1024 ** 2 // 2
+    row_size = max(dataset.dtype.itemsize *
+                   int(np.prod(dataset.shape[1:])), 1)
+    step = max(max_bytes // row_size, 1)
+    if dataset.chunks:
+        step = max(step // dataset.chunks[0], 1) * dataset.chunks[0]
+    return [slice(_i, _i + step) for _i in range(0, dataset.shape[0], step)]
+
+
+def get_dataset_names(group, broken_links=False):
+    """
+    Recursively collect the names of all datasets in a group relative to
+    it. Unlike with :meth:`h5py.Group.visit`, datasets reachable via
+    multiple hard links are listed once for every link and external links
+    are followed.
+
+    :type group: :class:`h5py.Group`
+    :param broken_links: Also list links that cannot be resolved, e.g.
+        external links to missing files. These are skipped otherwise.
+    :type broken_links: bool
+    """
+    names = []
+    for name, obj in group.items():
+        if isinstance(obj, h5py.Dataset) or (obj is None and broken_links):
+            names.append(name)
+        elif isinstance(obj, h5py.Group):
+            names.extend("%s/%s" % (name, _i) for _i in
+                         get_dataset_names(obj, broken_links=broken_links))
+    return names
+
+
+def copy_dataset(dataset, group, name, copies, **kwargs):
+    """
+    Copies a dataset to a group in another file. Datasets with more than
+    one hard link are only copied once and then hard linked.
+
+    The dataset is copied as it is, e.g. without decompressing it, unless
+    any storage settings are changed.
+
+    :type dataset: :class:`h5py.Dataset`
+    :param group: The group to copy to.
+    :type group: :class:`h5py.Group`
+    :param name: The name of the copy in the group.
+    :type name: str
+    :param copies: Maps the filenames and addresses of copied datasets with
+        more than one hard link to the names of the copies. Pass the same
+        dictionary for all datasets copied to the same file.
+    :type copies: dict
+    :param kwargs: Storage settings of the copy, e.g. ``chunks`` or
+        ``compression``, overwriting the ones of the dataset. Ignored for
+        scalar datasets.
+    """
+    info = h5py.h5o.get_info(dataset.id)
+    key = (dataset.file.filename, info.addr)
+    if key in copies:
+        group[name] = group.file[copies[key]]
+        return
+    if not kwargs or not dataset.shape:
+        dataset.parent.copy(dataset, group, name=name)
+    else:
+        params = {
+            "shape": dataset.shape,
+            "dtype": dataset.dtype,
+            "maxshape": dataset.maxshape,
+            "chunks": dataset.chunks,
+            "compression": dataset.compression,
+            "compression_opts": dataset.compression_opts,
+            "shuffle": dataset.shuffle,
+            "fletcher32": dataset.fletcher32}
+        params.update(kwargs)
+        copy = group.create_dataset(name, **params)
+        for attr, value in dataset.attrs.items():
+            copy.attrs[attr] = value
+        for block in get_block_slices(dataset):
+            copy[block] = dataset[block]
+    if info.rc > 1:
+        copies[key] = group[name].name
+
+
+def get_content_hash(data):
+    """
+    Returns the content hash of an array as a hex string. It covers the
+    shape, the data type, and the values. The byte order does not matter.
+
+    :param data: The data. Datasets are read block by block with bounded
+        memory.
+    :type data: :class:`numpy.ndarray` or :class:`h5py.Dataset`
+    """
+    content_hash, dtype = start_content_hash(data.shape, data.dtype)
+    if isinstance(data, h5py.Dataset):
+        blocks = (data[_i] for _i in get_block_slices(data))
+    else:
+        blocks = [data]
+    for block in blocks:
+        content_hash.update(
+            np.ascontiguousarray(block, dtype=dtype).tobytes())
+    return content_hash.hexdigest()
+
+
+def start_content_hash(shape, dtype):
+    """
+    Returns a SHA-1 object set up for the content hash of an array, see
+    :func:`get_content_hash`, and the data type the values have to be
+    converted to before updating it with them in order.
+
+    :param shape: The shape of the array.
+    :type shape: tuple
+    :param dtype: The data type of the array.
+    """
+    dtype = np.dtype(dtype).newbyteorder(str("="))
+    content_hash = hashlib.sha1()
+    content_hash.update(("%s%s" % (
+        dtype.str, tuple(int(_i) for _i in shape))).encode())
+    return content_hash, dtype
+
+
+def get_stored_content_hash(dataset):
+    """
+    Returns the content hash stored with a dataset or ``None`` if it has
+    none.
+
+    :type dataset: :class:`h5py.Dataset`
+    """
+    if CONTENT_HASH_ATTRIBUTE not in dataset.attrs:
+        return None
+    return bytes(dataset.attrs[CONTENT_HASH_ATTRIBUTE]).decode()\
+        .rstrip("\x00")
+
+
+def compare_dataset_metadata(first, second):
+    """
+    Compare the shape, data type, and attributes of two datasets. Returns a
+    message describing the first difference or ``None`` if they match.
+
+    The content hashes are not compared as they are different for data
+    that is only almost equal.
+
+    :type first: :class:`h5py.Dataset`
+    :type second: :class:`h5py.Dataset`
+    """
+    if first.shape != second.shape:
+        return "Shapes differ: %s != %s" % (first.shape, second.shape)
+    if first.dtype != second.dtype:
+        return "Data types differ: %s != %s" % (first.dtype, second.dtype)
+    keys = set(first.attrs.keys()) - set([CONTENT_HASH_ATTRIBUTE])
+    other_keys = set(second.attrs.keys()) - set([CONTENT_HASH_ATTRIBUTE])
+    if keys != other_keys:
+        return "Attributes differ: %s != %s" % (
+            sorted(keys), sorted(other_keys))
+    for key in keys:
+        if not np.array_equal(np.asarray(first.attrs[key]),
+                              np.asarray(second.attrs[key])):
+            return "Attribute '%s' differs." % key
+    return None
+
+
+def compare_dataset_contents(first, second, approximate=False):
+    """
+    Compare the data of two datasets with the same shape block by block
+    with bounded memory. Returns a message describing the first difference
+    or ``None`` if they match.
+
+    :type first: :class:`h5py.Dataset`
+    :type second: :class:`h5py.Dataset`
+    :param approximate: Only require the data to be almost equal.
+    :type approximate: bool
+    """
+    for block in get_block_slices(first):
+        a = first[block]
+        b = second[block]
+        if approximate:
+            equal = np.allclose(a, b, rtol=1E-7, atol=0, equal_nan=True)
+        else:
+            equal = np.array_equal(a, b)
+        if not equal:
+            if block == ():
+                return "Data differs."
+            return "Data differs in the block starting at index %i." % \
+                block.start
+    return None
+
+
+def fletcher32_matches(chunk):
+    """
+    Returns True if the fletcher32 checksum HDF5 appends to a raw chunk
+    matches its contents.
+
+    Follows the implementation in the HDF5 library which also accepts
+    checksums with swapped bytes written by old versions.
+
+    :param chunk: The raw, still filtered bytes of a chunk including the
+        checksum.
+    :type chunk: bytes
+    """
+    data = np.frombuffer(chunk[:-4], dtype=np.uint8)
+    if len(data) % 2:
+        data = np.append(data, np.uint8(0))
+    words = data[0::2].astype(np.uint64) * 256 + data[1::2]
+
+    # Sum in blocks to not overflow.
+    sum1 = sum2 = 0
+    for _i in range(0, len(words), 2 ** 16):
+        partial = np.cumsum(words[_i:_i + 2 ** 16]) + sum1
+        sum2 = (sum2 + int(partial.sum())) % 65535
+        sum1 = int(partial[-1]) % 65535
+
+    stored = np.frombuffer(chunk[-4:], dtype="<u4")[0]
+    stored_sum1 = int(stored) & 0xffff
+    stored_sum2 = int(stored) >> 16
+    swapped_sum1 = ((stored_sum1 & 0xff) << 8) | (stored_sum1 >> 8)
+    swapped_sum2 = ((stored_sum2 & 0xff) << 8) | (stored_sum2 >> 8)
+    # HDF5 does not always reduce 65535 to 0.
+    return any(_i % 65535 == sum1 and _j % 65535 == sum2
+               for _i, _j in ((stored_sum1, stored_sum2),
+                              (swapped_sum1, swapped_sum2)))
+
+
 def sizeof_fmt(num):
     """
     Handy formatting for human readable filesize.
@@ -104,6 +636,78 @@ class AuxiliaryDataContainer(object):
                         sorted(self.parameters.items(), key=lambda x: x[0])])))
 
 
+class AuxiliaryDataWriter(object):
+    """
+    Writes auxiliary data block by block. Use it as a context manager, see
+    :meth:`~pyasdf.asdf_data_set.ASDFDataSet.auxiliary_data_writer`.
+
+    The content hash is computed on the fly as long as whole rows are
+    written in order. Otherwise the data is read again once it is complete.
+    """
+    def __init__(self, data_name, asdf_data_set, shape, dtype,
+                 final_name=None):
+        """
+        :param data_name: The name of the data in the auxiliary data group.
+        :param shape: The shape of the data.
+        :param dtype: The data type of the data.
+        :param final_name: If given, the data is moved to this name once it
+            has been written successfully.
+        """
+        # Use weak references to not have any dangling references to the HDF5
+        # file around.
+        self.__data_name = data_name
+        self.__data_set = weakref.ref(asdf_data_set)
+        self.__shape = tuple(shape)
+        self.__final_name = final_name
+        # Rows written in order so far.
+        self.__next_row = 0
+        if self.__shape:
+            self.__content_hash, self.__dtype = start_content_hash(shape,
+                                                                   dtype)
+        else:
+            self.__content_hash = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        content_hash = None
+        if self.__content_hash is not None and \
+                self.__next_row == self.__shape[0]:
+            content_hash = self.__content_hash.hexdigest()
+        self.__data_set()._finish_auxiliary_data_writer(
+            self.__data_name, success=exc_type is None,
+            content_hash=content_hash, final_name=self.__final_name)
+
+    def write(self, selection, block):
+        """
+        Write a block of data.
+
+        :param selection: The part of the data the block is written to,
+            e.g. a slice along the first axis or a tuple of slices.
+        :param block: The data.
+        :type block: :class:`numpy.ndarray`
+        """
+        self.__data_set()._auxiliary_data_group[self.__data_name][
+            selection] = block
+        if self.__content_hash is not None:
+            self.__update_content_hash(selection, np.asarray(block))
+
+    def __update_content_hash(self, selection, block):
+        if isinstance(selection, tuple) and len(selection) == 1:
+            selection = selection[0]
+        if isinstance(selection, slice):
+            start, stop, step = selection.indices(self.__shape[0])
+            if step == 1 and start == self.__next_row and \
+                    block.shape == (stop - start,) + self.__shape[1:]:
+                self.__content_hash.update(np.ascontiguousarray(
+                    block, dtype=self.__dtype).tobytes())
+                self.__next_row = stop
+                return
+        # Not in order, the data has to be read again at the end.
+        self.__content_hash = None
+
+
 class AuxiliaryDataAccessor(object):
     """
     Helper class facilitating access to the actual waveforms and stations.
@@ -119,9 +723,9 @@ class AuxiliaryDataAccessor(object):
             self.__auxiliary_data_type, item.replace("___", "."))
 
     def __dir__(self):
-        __group = self.__data_set()._auxiliary_data_group[
-            self.__auxiliary_data_type]
-        return sorted([_i.replace(".", "___") for _i in __group.keys()])
+        __tags = self.__data_set()._get_auxiliary_data_tags(
+            self.__auxiliary_data_type)
+        return sorted([_i.replace(".", "___") for _i in __tags])
 
 
 class AuxiliaryDataGroupAccessor(object):
@@ -202,6 +806,110 @@ class WaveformAccessor(object):
         return sorted(set(directory))
 
 
+class InMemoryWaveformAccessor(object):
+    """
+    In-memory counterpart of the :class:`WaveformAccessor` holding the
+    already read waveforms and station information of a single station.
+    """
+    def __init__(self, contents):
+        """
+        :param contents: Dictionary mapping the tags and ``"StationXML"`` to
+            the corresponding stream and inventory objects.
+        :type contents: dict
+        """
+        self.__contents = contents
+
+    def __getattr__(self, item):
+        if item.startswith("__"):
+            raise AttributeError(item)
+        # Mimic the behaviour of the WaveformAccessor for missing items.
+        if item in self.__contents:
+            return self.__contents[item]
+        elif item == "StationXML":
+            return None
+        return obspy.Stream()
+
+    def __dir__(self):
+        return sorted(self.__contents.keys())
+
+
+def prefetch_items(get_next_item, load_function, prefetch=1):
+    """
+    Generator yielding ``(item, load_function(item))`` tuples while up to
+    ``prefetch`` of the following items are already being loaded in a
+    background thread.
+
+    New items are requested in the calling thread so ``get_next_item``
+    might safely communicate via MPI.
+
+    :param get_next_item: Function returning the next item or ``None`` if
+        no more items are available.
+    :param load_function: Function loading a single item. Will be called in
+        a background thread.
+    :param prefetch: The number of items loaded ahead.
+    :type prefetch: int
+    """
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(1)
+    pending = collections.deque()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) <= prefetch:
+                item = get_next_item()
+                if item is None:
+                    exhausted = True
+                    break
+                pending.append(
+                    (item, pool.apply_async(load_function, (item,))))
+            if not pending:
+                break
+            item, async_result = pending.popleft()
+            yield item, async_result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+class AsyncReadAheadIterator(object):
+    """
+    Asynchronous iterator loading items in an executor while reading ahead
+    a number of items. For use with ``async for`` loops.
+    """
+    def __init__(self, load_function, items, executor, prefetch=2):
+        """
+        :param load_function: Blocking function loading a single item.
+        :param items: The items to load.
+        :type items: list
+        :param executor: The executor running the load function.
+        :type executor: :class:`concurrent.futures.Executor`
+        :param prefetch: The number of items loaded ahead.
+        :type prefetch: int
+        """
+        self.__load_function = load_function
+        self.__items = collections.deque(items)
+        self.__executor = executor
+        self.__prefetch = max(int(prefetch), 0)
+        self.__pending = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        while self.__items and len(self.__pending) <= self.__prefetch:
+            self.__pending.append(loop.run_in_executor(
+                self.__executor, self.__load_function,
+                self.__items.popleft()))
+        if self.__pending:
+            return self.__pending.popleft()
+        future = loop.create_future()
+        future.set_exception(StopAsyncIteration())  # NOQA
+        return future
+
+
 def is_mpi_env():
     """
     Returns True if the current environment is an MPI environment.
@@ -266,6 +974,122 @@ class StreamBuffer(collections.MutableMapping):
         return cum_size * 1.01
 
 
+# A stream whose sample arrays live in a block of a SharedMemoryPool.
+SharedMemoryStream = collections.namedtuple("SharedMemoryStream",
+                                            ["block", "headers"])
+
+
+class SharedMemoryPool(object):
+    """
+    A bounded pool of shared memory blocks used to hand over the sample
+    arrays of streams from one process to another without pickling them.
+
+    Only the trace headers and the location of the data in the shared
+    memory travel through the queues. A process packing a stream has to
+    wait for a free block which provides backpressure until the pool is
+    closed. Streams larger than
+    a single block and platforms without :mod:`multiprocessing.shared_memory`
+    (Python < 3.8) fall back to passing the stream object itself.
+    """
+    def __init__(self, multiprocessing, block_count, block_size):
+        """
+        :param multiprocessing: The multiprocessing module to use, as
+            returned by :func:`get_multiprocessing`.
+        :param block_count: The number of blocks in the pool.
+        :type block_count: int
+        :param block_size: The size of each block in bytes.
+        :type block_size: int
+        """
+        self.block_size = int(block_size)
+        self._blocks = []
+        self._free_blocks = multiprocessing.Queue()
+        self._closed = multiprocessing.Event()
+        if shared_memory is None or self.block_size <= 0:
+            return
+        for _i in range(block_count):
+            self._blocks.append(shared_memory.SharedMemory(
+                create=True, size=self.block_size))
+            self._free_blocks.put(_i)
+
+    def pack_stream(self, stream):
+        """
+        Copy the data of all traces of a stream to a free block. Blocks
+        until a block is available and raises if the pool is closed in the
+        meantime, e.g. because the consumer of the streams failed.
+
+        :param stream: The stream to pack. Might be ``None``.
+        :type stream: :class:`~obspy.core.stream.Stream`
+        """
+        if not self._blocks or not stream:
+            return stream
+        # Keep each array aligned to 8 bytes.
+        sizes = [int(math.ceil(tr.data.nbytes / 8.0)) * 8 for tr in stream]
+        if sum(sizes) > self.block_size:
+            return stream
+
+        block = None
+        while block is None:
+            try:
+                block = self._free_blocks.get(timeout=0.1)
+            except queue.Empty:
+                if self._closed.is_set():
+                    raise ASDFException("The shared memory pool is closed.")
+        buf = self._blocks[block].buf
+        headers = []
+        offset = 0
+        for tr, size in zip(stream, sizes):
+            data = np.require(tr.data, requirements=["C"])
+            np.ndarray(data.shape, dtype=data.dtype, buffer=buf,
+                       offset=offset)[:] = data
+            headers.append((tr.stats, data.dtype.str, data.shape, offset))
+            offset += size
+        return SharedMemoryStream(block=block, headers=headers)
+
+    def unpack_stream(self, packed):
+        """
+        Returns a stream whose traces directly reference the shared memory.
+        The block has to be released with :meth:`release` once the stream
+        is no longer needed.
+
+        :param packed: Whatever :meth:`pack_stream` returned.
+        """
+        if not isinstance(packed, SharedMemoryStream):
+            return packed
+        buf = self._blocks[packed.block].buf
+        traces = []
+        for stats, dtype, shape, offset in packed.headers:
+            data = np.ndarray(shape, dtype=np.dtype(dtype), buffer=buf,
+                              offset=offset)
+            traces.append(obspy.Trace(data=data, header=stats))
+        return obspy.Stream(traces=traces)
+
+    def release(self, packed):
+        """
+        Return the block used by a packed stream to the pool.
+
+        :param packed: Whatever :meth:`pack_stream` returned.
+        """
+        if isinstance(packed, SharedMemoryStream):
+            self._free_blocks.put(packed.block)
+
+    def close(self):
+        """
+        Free all shared memory and make all processes waiting for a free
+        block raise. Only call from the process that created the pool.
+        """
+        self._closed.set()
+        for block in self._blocks:
+            block.unlink()
+            try:
+                block.close()
+            except BufferError:
+                # Unpacked streams still reference the memory, e.g. in the
+                # traceback of an exception. It is released once they are
+                # garbage collected.
+                pass
+        self._blocks = []
+
+
 # Two objects describing a job and a worker.
 class Job(object):
     __slots__ = "arguments", "result"
@@ -357,6 +1181,14 @@ class JobQueueHelper(object):
                         len(self._finished_jobs), len(self._all_jobs),
                         workers))
 
+    @property
+    def results(self):
+        """
+        Dictionary mapping the arguments of all finished jobs to their
+        results.
+        """
+        return {job.arguments: job.result for job in self._finished_jobs}
+
     @property
     def queue_empty(self):
         return not bool(self._in_queue)